@@ -1,22 +1,64 @@
-from flask import Flask
-from database import init_db
+from flask import Flask, request
+from database import init_db, enable_write_behind, start_region_reloader, WRITE_BEHIND_ENABLED
+from feature_store import FEATURE_STORE_ENABLED, enable_feature_store
 from app.routes import main_bp
+from app.model import FEATURE_KEYS, start_model_reloader
+from app.policy import start_policy_reloader
+from metrics import begin_request, end_request
+
+def init_services():
+    """
+    تهيئة مشتركة بين Flask (create_app) وخدمة ASGI (app/asgi.py).
+    """
+    init_db()  # مهم
+
+    # كتابة مؤجلة على دفعات (SND_WRITE_BEHIND=1)
+    if WRITE_BEHIND_ENABLED:
+        enable_write_behind()
+
+    # مخزن الميزات العمودي (SND_FEATURE_STORE=1)
+    if FEATURE_STORE_ENABLED:
+        enable_feature_store(FEATURE_KEYS)
+
+    # تحميل النموذج الآن (وليس في أول طلب) + التقاط النسخ الجديدة بدون إعادة تشغيل
+    start_model_reloader()
+    # سياسة القرار (policy.json) + التقاط تعديلاتها بدون إعادة تشغيل
+    start_policy_reloader()
+    # جدول المدن → المناطق (city_region) + التقاط gazetteer جديد بدون إعادة تشغيل
+    start_region_reloader()
+
+
+# نفس الـ headers في Flask وفي خدمة ASGI
+SECURITY_HEADERS = {
+    "X-Content-Type-Options": "nosniff",
+    "X-Frame-Options": "DENY",
+    "X-XSS-Protection": "1; mode=block",
+}
+
 
 def create_app():
     app = Flask(__name__)
 
-    init_db()  # مهم
+    init_services()
 
     app.register_blueprint(main_bp)
 
+    # قياس زمن الطلب + عدد استعلامات SQL لكل طلب (/metrics)
+    @app.before_request
+    def start_request_metrics():
+        begin_request()
+
+    @app.after_request
+    def finish_request_metrics(response):
+        end_request(request.endpoint)
+        return response
+
     # ----------------------------------------
     # 🔐 إضافة Security Headers بشكل آمن
     # ----------------------------------------
     @app.after_request
     def apply_security_headers(response):
-        response.headers["X-Content-Type-Options"] = "nosniff"
-        response.headers["X-Frame-Options"] = "DENY"
-        response.headers["X-XSS-Protection"] = "1; mode=block"
+        response.headers.update(SECURITY_HEADERS)
         return response
 
     return app
@@ -0,0 +1,288 @@
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+from urllib.parse import parse_qs
+
+from app import SECURITY_HEADERS, init_services
+from app.model import evaluate_event, model_info
+from app.policy import get_policy
+from app.processing import build_features, parse_event
+from app.routes import (
+    STREAM_KEEPALIVE_SECONDS,
+    _finalize_event,
+    list_events,
+    sse_frames,
+    stream_backlog,
+    stream_start_id,
+)
+from database import disable_write_behind, resolve_region, start_event_feed
+from feature_store import disable_feature_store
+from metrics import observe_request, render_prometheus, stage_timer
+
+# ---------------------- خدمة التقييم غير المتزامنة (ASGI) ---------------------- #
+#
+# نفس /score (نفس الطلب ونفس الرد) لكن على ASGI:
+# - الـ event loop لا ينتظر أي I/O: التخزين (البصمة، الحفظ) في pool محدود للقاعدة،
+#   واستدعاء النموذج في pool محدود آخر، فآلاف الاتصالات المفتوحة = coroutines فقط
+# - عدد المهام المعلّقة في كل pool محدود (backpressure) بدل طابور بلا نهاية
+# - ASGI خام بدون framework: يعمل على uvicorn / hypercorn / أي خادم ASGI
+#
+# - /events/stream: كل مشترك coroutine ينتظر حلقة البث (event_feed)، بدون thread لكل محلل
+#
+# التشغيل: python serve.py --workers 4 (أو uvicorn app.asgi:application)
+
+# عدد threads استدعاء النموذج (NumPy يحرر الـ GIL أثناء الحساب)
+ASGI_MODEL_THREADS = int(os.environ.get("SND_ASGI_MODEL_THREADS", str(min(4, os.cpu_count() or 1))))
+# عدد threads التخزين (SQLite: قارئ لكل thread مع WAL؛ PostgreSQL: حتى حجم الـ pool)
+ASGI_DB_THREADS = int(os.environ.get("SND_ASGI_DB_THREADS", "8"))
+# أقصى عدد مهام تنتظر في كل pool قبل أن ينتظر الطلب نفسه
+ASGI_MAX_PENDING = int(os.environ.get("SND_ASGI_MAX_PENDING", "256"))
+# أقصى حجم لجسم الطلب
+ASGI_MAX_BODY_BYTES = int(os.environ.get("SND_ASGI_MAX_BODY_BYTES", str(1024 * 1024)))
+
+
+class _Offload:
+    """
+    ThreadPoolExecutor محدود + semaphore للمهام المعلّقة.
+    """
+
+    def __init__(self, name: str, workers: int, max_pending: int = ASGI_MAX_PENDING):
+        self.name = name
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._slots: Optional[asyncio.Semaphore] = None
+
+    def start(self) -> None:
+        self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.name)
+        self._slots = asyncio.Semaphore(self.workers + self.max_pending)
+
+    async def run(self, fn: Callable, *args) -> Any:
+        async with self._slots:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, fn, *args)
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+
+db_pool = _Offload("snd-db", ASGI_DB_THREADS)
+model_pool = _Offload("snd-model", ASGI_MODEL_THREADS)
+
+
+# ---------------------- خطوات /score ---------------------- #
+
+async def score_event(data: Any) -> Tuple[int, Dict[str, Any]]:
+    """
+    نفس خطوات app.routes.score، مع نقل كل خطوة فيها I/O أو حساب ثقيل خارج الـ loop.
+    ترجع (status, body).
+    """
+    timer = stage_timer()
+
+    # -------- 1 + 2) التحقق + التطبيع (المدينة → المنطقة من الذاكرة) في خطوة واحدة --------
+    data = data or {}
+    event, message = parse_event(data)
+    timer.lap("validate")
+    if event is None:
+        return 400, {"error": message}
+
+    # -------- 3) الميزات: البصمة من الكاش أو تحميلها من القاعدة --------
+    features = await db_pool.run(build_features, event)
+    timer.lap("features")
+
+    # -------- 4) النموذج --------
+    raw_score = await model_pool.run(evaluate_event, features)
+    timer.lap("model")
+
+    # -------- 5 → 11) القواعد + القرار + الحفظ --------
+    response = await db_pool.run(_finalize_event, event, features, raw_score, timer)
+    return 200, response
+
+
+async def _events(query: Dict[str, str]) -> Tuple[int, Dict[str, Any]]:
+    body = await db_pool.run(list_events, query.get("since_id"), query.get("limit"))
+    return 200, body
+
+
+async def _events_stream(scope, receive, send, query: Dict[str, str]) -> None:
+    """
+    نفس /events/stream في Flask: المشتركون coroutines تنتظر الحلقة (wait_async)،
+    والتخزين لا يُقرأ إلا لإكمال فجوة.
+    """
+    feed = await db_pool.run(start_event_feed)
+    last_id = await db_pool.run(stream_start_id, query.get("since_id"), _header(scope, b"last-event-id"))
+
+    headers = [
+        (b"content-type", b"text/event-stream; charset=utf-8"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),
+    ]
+    headers += [(k.lower().encode(), v.encode()) for k, v in SECURITY_HEADERS.items()]
+    await send({"type": "http.response.start", "status": 200, "headers": headers})
+    await send({"type": "http.response.body", "body": b"retry: 3000\n\n", "more_body": True})
+
+    async def watch_disconnect():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    disconnected = asyncio.ensure_future(watch_disconnect())
+    try:
+        while not disconnected.done():
+            items, gap = feed.since(last_id)
+            if gap:
+                items = await db_pool.run(stream_backlog, feed, last_id)
+            if items:
+                last_id = items[-1][0]
+                chunk = sse_frames(items)
+            else:
+                waiting = asyncio.ensure_future(feed.wait_async(last_id, STREAM_KEEPALIVE_SECONDS))
+                await asyncio.wait((waiting, disconnected), return_when=asyncio.FIRST_COMPLETED)
+                if disconnected.done():
+                    waiting.cancel()
+                    break
+                if waiting.result():
+                    continue
+                chunk = ": keep-alive\n\n"
+            await send({"type": "http.response.body", "body": chunk.encode(), "more_body": True})
+    finally:
+        disconnected.cancel()
+
+
+# ---------------------- ASGI ---------------------- #
+
+def _json_body(obj: Any) -> bytes:
+    # نفس مخرجات jsonify في Flask (مفاتيح مرتبة، ASCII، بدون مسافات، سطر جديد)
+    return (json.dumps(obj, sort_keys=True, separators=(",", ":")) + "\n").encode()
+
+
+async def _send(send, status: int, body: bytes, content_type: bytes = b"application/json") -> None:
+    headers = [
+        (b"content-type", content_type),
+        (b"content-length", str(len(body)).encode()),
+    ]
+    headers += [(k.lower().encode(), v.encode()) for k, v in SECURITY_HEADERS.items()]
+    await send({"type": "http.response.start", "status": status, "headers": headers})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _read_body(receive) -> Optional[bytes]:
+    chunks = []
+    size = 0
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return None
+        chunk = message.get("body", b"")
+        size += len(chunk)
+        if size > ASGI_MAX_BODY_BYTES:
+            return None
+        chunks.append(chunk)
+        if not message.get("more_body", False):
+            return b"".join(chunks)
+
+
+def _header(scope, name: bytes) -> Optional[str]:
+    for key, value in scope.get("headers", ()):
+        if key == name:
+            return value.decode("latin-1")
+    return None
+
+
+def _is_json(scope) -> bool:
+    content_type = _header(scope, b"content-type")
+    if content_type is None:
+        return False
+    mimetype = content_type.split(";")[0].strip().lower()
+    return mimetype == "application/json" or mimetype.endswith("+json")
+
+
+def _query(scope) -> Dict[str, str]:
+    return {k: v[-1] for k, v in parse_qs(scope.get("query_string", b"").decode("latin-1")).items()}
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            try:
+                db_pool.start()
+                model_pool.start()
+                await db_pool.run(init_services)
+                # تحميل جدول المدن الآن حتى لا يحدث داخل الـ loop في أول طلب
+                await db_pool.run(resolve_region, "")
+            except Exception as exc:
+                await send({"type": "lifespan.startup.failed", "message": str(exc)})
+                return
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            model_pool.shutdown()
+            db_pool.shutdown()
+            # حفظ ما تبقى في طابور الكتابة المؤجلة
+            disable_write_behind()
+            disable_feature_store()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+
+async def application(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    started = time.perf_counter()
+    method = scope["method"]
+    path = scope["path"].rstrip("/") or "/"
+
+    if path == "/score":
+        endpoint = "asgi.score"
+        if method != "POST":
+            status, body = 405, {"error": "Method Not Allowed"}
+        elif not _is_json(scope):
+            status, body = 415, {"error": "Content-Type must be application/json"}
+        else:
+            raw = await _read_body(receive)
+            if raw is None:
+                status, body = 413, {"error": "Request body too large"}
+            else:
+                try:
+                    data = json.loads(raw)
+                except ValueError:
+                    status, body = 400, {"error": "Invalid JSON body"}
+                else:
+                    status, body = await score_event(data)
+        await _send(send, status, _json_body(body))
+    elif method != "GET":
+        endpoint = "asgi.other"
+        await _send(send, 405, _json_body({"error": "Method Not Allowed"}))
+    elif path == "/health":
+        endpoint = "asgi.health"
+        await _send(send, 200, _json_body({"status": "ok", "message": "SND risk engine is running"}))
+    elif path == "/metrics":
+        endpoint = "asgi.metrics"
+        await _send(send, 200, render_prometheus().encode(), b"text/plain; version=0.0.4")
+    elif path == "/model":
+        endpoint = "asgi.model"
+        await _send(send, 200, _json_body(model_info()))
+    elif path == "/policy":
+        endpoint = "asgi.policy"
+        await _send(send, 200, _json_body(get_policy().info()))
+    elif path == "/events":
+        endpoint = "asgi.events"
+        status, body = await _events(_query(scope))
+        await _send(send, status, _json_body(body))
+    elif path == "/events/stream":
+        # اتصال مفتوح: لا يُسجل في زمن الطلبات
+        await _events_stream(scope, receive, send, _query(scope))
+        return
+    else:
+        endpoint = "asgi.other"
+        await _send(send, 404, _json_body({"error": "Not Found"}))
+
+    observe_request(endpoint, time.perf_counter() - started)
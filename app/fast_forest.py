@@ -0,0 +1,201 @@
+import hashlib
+import os
+
+import numpy as np
+
+# ---------------------------------------------------------------
+# نسخة "مسطّحة" من IsolationForest:
+# كل عقد كل الأشجار في مصفوفات NumPy متصلة (feature / threshold / children)
+# + طول المسار الجاهز لكل ورقة، والتقييم عبارة عن نزول متجهي
+# لعدد ثابت من الخطوات (= أقصى عمق) لكل الصفوف وكل الأشجار مرة واحدة.
+# الناتج يطابق decision_function في sklearn (ضمن دقة float).
+# ---------------------------------------------------------------
+
+FLAT_FORMAT_VERSION = 1
+
+# عدد الصفوف في كل خطوة تقييم (يحدّ حجم المصفوفات المؤقتة صفوف × أشجار)
+SCORE_CHUNK_ROWS = 256
+
+
+def _average_path_length(n_samples: np.ndarray) -> np.ndarray:
+    """
+    نفس _average_path_length في sklearn:
+    متوسط طول المسار لبحث فاشل في شجرة بحث ثنائية فيها n عنصر.
+    """
+    n = np.asarray(n_samples, dtype=float)
+    out = np.zeros_like(n)
+    two = n == 2
+    many = n > 2
+    out[two] = 1.0
+    out[many] = (
+        2.0 * (np.log(n[many] - 1.0) + np.euler_gamma) - 2.0 * (n[many] - 1.0) / n[many]
+    )
+    return out
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class FlatForest:
+    """
+    مقيّم IsolationForest مبني على مصفوفات NumPy فقط.
+    يوفر decision_function بنفس واجهة sklearn (صف واحد أو دفعة).
+    """
+
+    def __init__(
+        self,
+        feature: np.ndarray,
+        threshold: np.ndarray,
+        children: np.ndarray,
+        leaf_depth: np.ndarray,
+        roots: np.ndarray,
+        max_depth: int,
+        n_features: int,
+        offset: float,
+        denominator: float,
+        source_sha256: str = "",
+    ):
+        self.feature = feature
+        self.threshold = threshold
+        # الأبناء متداخلين: children[2*i] = يمين، children[2*i + 1] = يسار
+        # حتى يكون الانتقال فهرسة واحدة: children[2*node + go_left]
+        self.children = children
+        self.leaf_depth = leaf_depth
+        self.roots = roots
+        self.max_depth = int(max_depth)
+        self.n_features_in_ = int(n_features)
+        self.offset_ = float(offset)
+        self.denominator = float(denominator)
+        self.source_sha256 = source_sha256
+
+    # ---------- التحويل من sklearn ---------- #
+
+    @classmethod
+    def from_sklearn(cls, model, source_sha256: str = "") -> "FlatForest":
+        features, thresholds, lefts, rights, depths, roots = [], [], [], [], [], []
+        base = 0
+        max_depth = 0
+
+        for tree, tree_features in zip(model.estimators_, model.estimators_features_):
+            t = tree.tree_
+            n = t.node_count
+            is_leaf = t.children_left == -1
+
+            # عمق كل عقدة (الأب دائماً قبل الابن في ترتيب sklearn)
+            node_depth = np.zeros(n, dtype=np.int64)
+            for i in range(n):
+                if not is_leaf[i]:
+                    node_depth[t.children_left[i]] = node_depth[i] + 1
+                    node_depth[t.children_right[i]] = node_depth[i] + 1
+
+            idx = np.arange(n)
+            # الورقة تشير لنفسها، والعتبة +inf حتى تبقى مكانها في كل خطوة
+            left = np.where(is_leaf, idx, t.children_left) + base
+            right = np.where(is_leaf, idx, t.children_right) + base
+            feat = np.where(is_leaf, 0, np.asarray(tree_features)[np.maximum(t.feature, 0)])
+            thr = np.where(is_leaf, np.inf, t.threshold)
+
+            # طول المسار عند الورقة: العمق + c(عدد العينات في الورقة)
+            leaf_depth = np.where(
+                is_leaf, node_depth + _average_path_length(t.n_node_samples), 0.0
+            )
+
+            features.append(feat)
+            thresholds.append(thr)
+            lefts.append(left)
+            rights.append(right)
+            depths.append(leaf_depth)
+            roots.append(base)
+            max_depth = max(max_depth, int(node_depth.max()))
+            base += n
+
+        denominator = len(model.estimators_) * float(
+            _average_path_length(np.array([model.max_samples_]))[0]
+        )
+
+        children = np.stack([np.concatenate(rights), np.concatenate(lefts)], axis=1)
+
+        return cls(
+            feature=np.concatenate(features).astype(np.intp),
+            threshold=np.concatenate(thresholds).astype(np.float64),
+            children=children.ravel().astype(np.intp),
+            leaf_depth=np.concatenate(depths).astype(np.float64),
+            roots=np.asarray(roots, dtype=np.intp),
+            max_depth=max_depth,
+            n_features=model.n_features_in_,
+            offset=model.offset_,
+            denominator=denominator,
+            source_sha256=source_sha256,
+        )
+
+    # ---------- التقييم ---------- #
+
+    def score_samples(self, X) -> np.ndarray:
+        # أشجار sklearn تقارن القيم بعد تحويلها إلى float32
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+
+        n_rows, n_features = X.shape
+        depths = np.empty(n_rows, dtype=np.float64)
+
+        for start in range(0, n_rows, SCORE_CHUNK_ROWS):
+            chunk = X[start:start + SCORE_CHUNK_ROWS]
+            flat_x = chunk.ravel()
+            row_base = (np.arange(chunk.shape[0], dtype=np.intp) * n_features)[:, None]
+
+            # nodes[i, t] = العقدة الحالية للصف i في الشجرة t
+            nodes = np.repeat(self.roots[None, :], chunk.shape[0], axis=0)
+            for _ in range(self.max_depth):
+                go_left = flat_x[row_base + self.feature[nodes]] <= self.threshold[nodes]
+                nodes = self.children[2 * nodes + go_left]
+
+            depths[start:start + chunk.shape[0]] = self.leaf_depth[nodes].sum(axis=1)
+
+        return -(2.0 ** (-depths / self.denominator))
+
+    def decision_function(self, X) -> np.ndarray:
+        return self.score_samples(X) - self.offset_
+
+    # ---------- الحفظ والتحميل ---------- #
+
+    def save(self, path: str) -> None:
+        tmp_path = f"{path}.tmp.npz"
+        np.savez(
+            tmp_path,
+            version=FLAT_FORMAT_VERSION,
+            feature=self.feature,
+            threshold=self.threshold,
+            children=self.children,
+            leaf_depth=self.leaf_depth,
+            roots=self.roots,
+            max_depth=self.max_depth,
+            n_features=self.n_features_in_,
+            offset=self.offset_,
+            denominator=self.denominator,
+            source_sha256=self.source_sha256,
+        )
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "FlatForest":
+        with np.load(path, allow_pickle=False) as data:
+            if int(data["version"]) != FLAT_FORMAT_VERSION:
+                raise ValueError(f"Unsupported flat model version in {path}")
+            return cls(
+                feature=data["feature"],
+                threshold=data["threshold"],
+                children=data["children"],
+                leaf_depth=data["leaf_depth"],
+                roots=data["roots"],
+                max_depth=int(data["max_depth"]),
+                n_features=int(data["n_features"]),
+                offset=float(data["offset"]),
+                denominator=float(data["denominator"]),
+                source_sha256=str(data["source_sha256"]),
+            )
@@ -1,15 +1,40 @@
+import argparse
+import atexit
+import heapq
+import multiprocessing
 import os
 import sqlite3
+import sys
+import threading
+import time
 from datetime import datetime
+from multiprocessing import shared_memory
 from typing import Dict, List
 
 import numpy as np
 from sklearn.ensemble import IsolationForest
 import joblib
 
-from app.processing import build_features
+from app.fast_forest import FlatForest, file_sha256
+from feature_store import FEATURE_STORE_DIR, FeatureStore
+from app.model_registry import BASE_DIR, MODEL_REGISTRY_DIR, LoadedModel, ModelRegistry
+from app.online_model import HalfSpaceForest, limits_for
+from app.processing import Event, features_from_profile
+from profile_cache import LOW_RISK_THRESHOLD, UserProfile
 
-MODEL_PATH = "snd_model.pkl"
+# ملف النموذج القديم (قبل السجل): يُستخدم فقط لو السجل فارغ
+MODEL_PATH = os.environ.get("SND_MODEL_PATH", os.path.join(BASE_DIR, "snd_model.pkl"))
+
+# كل كم ثانية نفحص السجل بحثاً عن نسخة فعّالة جديدة (0 = بدون فحص دوري)
+MODEL_RELOAD_INTERVAL = float(os.environ.get("SND_MODEL_RELOAD_INTERVAL", "5"))
+
+# النسخة المسطّحة من النموذج (NumPy فقط) للتقييم السريع
+# SND_FLAT_MODEL=0 يرجعنا لاستخدام كائن sklearn مباشرة
+USE_FLAT_MODEL = os.environ.get("SND_FLAT_MODEL", "1") == "1"
+
+
+def flat_model_path(model_path: str = MODEL_PATH) -> str:
+    return os.path.splitext(model_path)[0] + ".flat.npz"
 
 # نفس المفاتيح الراجعة من build_features
 FEATURE_KEYS: List[str] = [
@@ -30,93 +55,516 @@ FEATURE_KEYS: List[str] = [
     "city_frequency",
     "device_frequency",
     "service_frequency",
+    # تسلسل الخدمات (sequences.py)
+    "transition_rarity",
+    "sequence_novelty",
 ]
 
-_model = None  # يتم تحميله عند أول استخدام
+registry = ModelRegistry(MODEL_REGISTRY_DIR)
+
+# النموذج الفعّال (LoadedModel). الاستبدال = إسناد مرجع واحد،
+# والطلبات تقرأه بدون أي قفل فلا تنتظر أبداً تحميل نسخة جديدة.
+_active: LoadedModel | None = None
+_load_lock = threading.Lock()  # يمنع تحميلين متزامنين فقط (ليس على مسار الطلب)
+_reloader: threading.Thread | None = None
+
+# ---------------- النموذج المتعلّم أثناء التشغيل ----------------
+# SND_ANOMALY_ENGINE=online: Half-Space Trees تتعلم من الأحداث منخفضة المخاطر
+# المحفوظة، وتقيّم بدل IsolationForest بعد اكتمال أول نافذة.
+# الافتراضي forest = IsolationForest فقط (بدون تعلم أثناء التشغيل).
+ANOMALY_ENGINE = os.environ.get("SND_ANOMALY_ENGINE", "forest")
+
+# حدود كل ميزة لتحويلها إلى [0, 1]: (أقل, أعلى, log1p؟)
+ONLINE_FEATURE_LIMITS = {
+    "event_hour": (0, 23, False),
+    "day_of_week": (0, 6, False),
+    "is_weekend": (0, 1, False),
+    "is_night": (0, 1, False),
+    "events_last_1h": (0, 50, True),
+    "events_last_24h": (0, 500, True),
+    "avg_daily_events": (0, 500, True),
+    "minutes_since_last_event": (0, 9999, True),
+    "is_known_city": (0, 1, False),
+    "is_new_device": (0, 1, False),
+    "is_sensitive_service": (0, 1, False),
+    "city_frequency": (0, 1, False),
+    "device_frequency": (0, 1, False),
+    "service_frequency": (0, 1, False),
+    "transition_rarity": (0, 1, False),
+    "sequence_novelty": (0, 1, False),
+}
 
+online_model: HalfSpaceForest | None = (
+    HalfSpaceForest(limits_for(FEATURE_KEYS, ONLINE_FEATURE_LIMITS))
+    if ANOMALY_ENGINE == "online"
+    else None
+)
 
-def _vector_from_features(features: Dict[str, float]) -> np.ndarray:
+# حالة النموذج المتعلّم تُحفظ بجانب سجل النماذج كل ONLINE_SAVE_INTERVAL ثانية وعند الإيقاف،
+# وتُستعاد عند التشغيل (بدونها تضيع كل نافذة تعلّمها الخادم مع كل إعادة تشغيل)
+ONLINE_STATE_PATH = os.environ.get(
+    "SND_ONLINE_STATE_PATH", os.path.join(MODEL_REGISTRY_DIR, "online_state.npz")
+)
+ONLINE_SAVE_INTERVAL = float(os.environ.get("SND_ONLINE_SAVE_INTERVAL", "30"))
+
+_online_saved_samples = 0  # samples_seen عند آخر حفظ/استعادة
+_online_saver: threading.Thread | None = None
+
+
+def _vector_from_features(features: Dict[str, float], keys: List[str] = FEATURE_KEYS) -> np.ndarray:
     """
-    تحويل قاموس الميزات إلى vector رقمي بنفس ترتيب FEATURE_KEYS.
+    تحويل قاموس الميزات إلى vector رقمي بنفس ترتيب keys (افتراضياً FEATURE_KEYS).
     أي ميزة ناقصة نضع لها 0.
     """
-    return np.array([[float(features.get(k, 0.0)) for k in FEATURE_KEYS]], dtype=float)
+    return np.array([[float(features.get(k, 0.0)) for k in keys]], dtype=float)
 
 
-def train_model(
-    db_path: str = "events.db",
-    model_path: str = MODEL_PATH,
+def _matrix_from_features(
+    features_list: List[Dict[str, float]], keys: List[str] = FEATURE_KEYS
+) -> np.ndarray:
+    """
+    تحويل قائمة قواميس ميزات إلى مصفوفة (n × len(keys)) دفعة واحدة.
+    """
+    if not features_list:
+        return np.empty((0, len(keys)), dtype=float)
+    return np.vstack([_vector_from_features(f, keys) for f in features_list])
+
+
+# حجم كل دفعة نقرأها من قاعدة البيانات أثناء التدريب
+TRAIN_CHUNK_SIZE = 5000
+
+
+_TRAINING_QUERY = """
+    SELECT
+        e.id,
+        CAST(strftime('%s', e.event_time) AS INTEGER),
+        e.user_id, e.device, e.city, e.service, e.event_time, e.timestamp_ms, e.risk_score
+    FROM events e
+    {join}
+    {where}
+    ORDER BY datetime(e.event_time) ASC, e.id ASC
+"""
+
+
+def _iter_training_rows(cur: sqlite3.Cursor, chunk_size: int):
+    """
+    المرور على نتائج _TRAINING_QUERY على دفعات وحساب ميزات كل حدث
+    من بصمة في الذاكرة تمثل "ما قبله فقط"، ثم إضافة الحدث للبصمة.
+    يرجع (event_id, time_key, vector).
+    """
+    profiles: Dict[str, UserProfile] = {}
+    while True:
+        rows = cur.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        for (event_id, time_key, user_id, device, city, service,
+             event_time, timestamp_ms, risk_score) in rows:
+            profile = profiles.get(user_id)
+            if profile is None:
+                profile = profiles[user_id] = UserProfile(user_id)
+
+            day = None
+            try:
+                event = Event.from_row(user_id, device, city, service, event_time, timestamp_ms)
+                day = event.day
+                feats = features_from_profile(event, profile)
+                yield event_id, time_key, [float(feats.get(k, 0.0)) for k in FEATURE_KEYS]
+            except Exception as e:
+                # نتجاهل أي سطر فيه مشكلة ميزات
+                print(f"[train_model] تخطي حدث بسبب خطأ في الميزات: {e}")
+
+            profile.apply_event(device, city, service, event_time, timestamp_ms, risk_score, day)
+
+
+def iter_training_features(conn: sqlite3.Connection, chunk_size: int = TRAIN_CHUNK_SIZE):
+    """
+    المرور على الأحداث بالترتيب الزمني (cursor يقرأ على دفعات بدل fetchall)
+    وحساب ميزات كل حدث من بصمة في الذاكرة تمثل "ما قبله فقط"،
+    ثم إضافة الحدث للبصمة. النتيجة: ميزات صحيحة في لحظتها (point-in-time)
+    بدون أي استعلام إضافي لكل حدث.
+
+    يرجع (generator) قوائم ميزات بنفس ترتيب FEATURE_KEYS.
+    """
+    cur = conn.cursor()
+    cur.execute(_TRAINING_QUERY.format(join="", where=""))
+    for _, _, vec in _iter_training_rows(cur, chunk_size):
+        yield vec
+
+
+def _reservoir_slot(rng: np.random.Generator, seen: int, capacity: int) -> int:
+    """
+    خطوة واحدة من reservoir sampling: أين نضع الصف رقم seen (أو -1 = نتجاهله).
+    """
+    if seen < capacity:
+        return seen
+    j = int(rng.integers(0, seen + 1))
+    return j if j < capacity else -1
+
+
+def load_training_matrix(
+    db_path: str,
     random_state: int = 42,
-) -> None:
+    chunk_size: int = TRAIN_CHUNK_SIZE,
+    max_rows: int | None = None,
+) -> np.ndarray:
     """
-    تدريب IsolationForest على الأحداث المخزّنة في قاعدة البيانات
-    باستخدام build_features لكل حدث، ثم حفظ النموذج إلى ملف.
+    بناء مصفوفة التدريب في مصفوفة NumPy محجوزة مسبقاً.
+    لو max_rows محدد والأحداث أكثر منه نستخدم reservoir sampling
+    (عينة عشوائية منتظمة من كل السجل بذاكرة ثابتة).
     """
     conn = sqlite3.connect(db_path)
-    cur = conn.cursor()
+    total = conn.execute("SELECT COUNT(*) FROM events").fetchone()[0]
+    capacity = min(total, max_rows) if max_rows else total
+
+    X = np.empty((capacity, len(FEATURE_KEYS)), dtype=float)
+    rng = np.random.default_rng(random_state)
+    seen = 0
+
+    for vec in iter_training_features(conn, chunk_size):
+        slot = _reservoir_slot(rng, seen, capacity)
+        if slot >= 0:
+            X[slot] = vec
+        seen += 1
 
-    # نأخذ الأحداث الأساسية لبناء الميزات
-    cur.execute(
-        """
-        SELECT user_id, device, city, service, event_time
-        FROM events
-        ORDER BY datetime(event_time) ASC
-        """
-    )
-    rows = cur.fetchall()
     conn.close()
+    return X[:min(seen, capacity)]
 
-    if not rows:
-        print("[train_model] لا توجد أحداث في قاعدة البيانات للتدريب.")
-        # ممكن مستقبلاً نولّد بيانات تدريب صناعية هنا
-        return
 
-    X = []
-    for (user_id, device, city, service, event_time) in rows:
-        data = {
-            "user_id": user_id,
-            "device": device,
-            "city": city,
-            "service": service,
-            "event_time": event_time,
-        }
-        try:
-            feats = build_features(data)
-            vec = [float(feats.get(k, 0.0)) for k in FEATURE_KEYS]
-            X.append(vec)
-        except Exception as e:
-            # نتجاهل أي سطر فيه مشكلة ميزات
-            print(f"[train_model] تخطي حدث بسبب خطأ في الميزات: {e}")
+# ---------------- التدريب المتوازي (multiprocessing) ----------------
 
-    if not X:
-        print("[train_model] لم نستطع توليد ميزات كافية للتدريب.")
-        return
+def _assign_shards(conn: sqlite3.Connection, n_shards: int, max_id: int | None = None):
+    """
+    توزيع المستخدمين على n_shards بحيث تتقارب أعداد الأحداث
+    (الأكبر أولاً → الـ shard الأقل حملاً). الترتيب ثابت = نتيجة ثابتة.
+    max_id (اختياري): عدّ الأحداث حتى هذا id فقط.
+    ترجع [(user_ids, n_events), ...].
+    """
+    if max_id is None:
+        counts = conn.execute(
+            "SELECT user_id, COUNT(*) FROM events GROUP BY user_id"
+        ).fetchall()
+    else:
+        counts = conn.execute(
+            "SELECT user_id, COUNT(*) FROM events WHERE id <= ? GROUP BY user_id",
+            (max_id,),
+        ).fetchall()
+    counts.sort(key=lambda r: (-r[1], r[0]))
+
+    heap = [(0, i) for i in range(n_shards)]
+    shards = [([], 0) for _ in range(n_shards)]
+    for user_id, n in counts:
+        load, i = heapq.heappop(heap)
+        users, total = shards[i]
+        users.append(user_id)
+        shards[i] = (users, total + n)
+        heapq.heappush(heap, (load + n, i))
+    return [s for s in shards if s[0]]
+
+
+def _feature_shard_worker(task) -> int:
+    """
+    يعمل داخل process مستقل: يبني ميزات مستخدمي الـ shard بالترتيب الزمني
+    ويكتبها مباشرة في الذاكرة المشتركة (بدون تمرير قوائم عبر pickle).
+    يرجع عدد الصفوف المكتوبة بدءاً من offset (بحد أقصى capacity = حصة الـ shard).
+    """
+    db_path, x_name, keys_name, total_rows, offset, capacity, max_id, user_ids, chunk_size = task
+
+    x_shm = shared_memory.SharedMemory(name=x_name)
+    keys_shm = shared_memory.SharedMemory(name=keys_name)
+    try:
+        X = np.ndarray((total_rows, len(FEATURE_KEYS)), dtype=np.float64, buffer=x_shm.buf)
+        keys = np.ndarray((total_rows, 2), dtype=np.int64, buffer=keys_shm.buf)
+
+        conn = sqlite3.connect(db_path)
+        conn.execute("CREATE TEMP TABLE shard_users (user_id TEXT PRIMARY KEY)")
+        conn.executemany(
+            "INSERT INTO shard_users (user_id) VALUES (?)", ((u,) for u in user_ids)
+        )
+        cur = conn.cursor()
+        # نفس اللقطة التي حُسبت منها الأحجام: أحداث أُضيفت بعدها لا تدخل
+        cur.execute(
+            _TRAINING_QUERY.format(
+                join="JOIN shard_users s ON s.user_id = e.user_id", where="WHERE e.id <= ?"
+            ),
+            (max_id,),
+        )
+
+        written = 0
+        for event_id, time_key, vec in _iter_training_rows(cur, chunk_size):
+            if written >= capacity:
+                # لا نكتب أبداً في صفوف الـ shard التالي
+                print(f"[train_model] الـ shard تجاوز حصته ({capacity} صف)، نتوقف عندها")
+                break
+            X[offset + written] = vec
+            # NULL في SQLite يأتي أولاً في ORDER BY ASC
+            keys[offset + written] = (
+                np.iinfo(np.int64).min if time_key is None else time_key,
+                event_id,
+            )
+            written += 1
+
+        conn.close()
+        del X, keys
+        return written
+    finally:
+        x_shm.close()
+        keys_shm.close()
+
+
+def load_training_matrix_parallel(
+    db_path: str,
+    workers: int,
+    random_state: int = 42,
+    chunk_size: int = TRAIN_CHUNK_SIZE,
+    max_rows: int | None = None,
+) -> np.ndarray:
+    """
+    نفس load_training_matrix لكن الميزات تُحسب على عدة processes:
+    - المستخدمين يتوزعون على shards (ميزات كل مستخدم تعتمد على سجله فقط)
+    - كل worker يكتب صفوفه في SharedMemory مع (الوقت, id) لكل صف
+    - بعدها نرتب الصفوف بنفس ترتيب التدريب التسلسلي
+    النتيجة مطابقة تماماً للتسلسلي مهما كان عدد الـ workers
+    (وبالتالي IsolationForest يعطي نفس النموذج مع نفس random_state).
+    ملاحظة: هنا المصفوفة الكاملة تكون في الذاكرة قبل reservoir sampling.
+    """
+    # القاعدة قد تكون قاعدة الخدمة الشغالة: الأحجام والـ offsets من لقطة واحدة حتى MAX(id)،
+    # وكل worker يقرأ نفس اللقطة (id لا يُعاد استخدامه مع AUTOINCREMENT)
+    conn = sqlite3.connect(db_path)
+    max_id = conn.execute("SELECT COALESCE(MAX(id), 0) FROM events").fetchone()[0]
+    shards = _assign_shards(conn, workers, max_id)
+    conn.close()
+    total = sum(n_events for _, n_events in shards)
+
+    n_features = len(FEATURE_KEYS)
+    if total == 0:
+        return np.empty((0, n_features), dtype=float)
+
+    x_shm = shared_memory.SharedMemory(create=True, size=total * n_features * 8)
+    keys_shm = shared_memory.SharedMemory(create=True, size=total * 2 * 8)
+    try:
+        tasks, offsets = [], []
+        offset = 0
+        for user_ids, n_events in shards:
+            tasks.append(
+                (db_path, x_shm.name, keys_shm.name, total, offset, n_events, max_id,
+                 user_ids, chunk_size)
+            )
+            offsets.append(offset)
+            offset += n_events
+
+        with multiprocessing.Pool(processes=min(workers, len(tasks))) as pool:
+            written = pool.map(_feature_shard_worker, tasks)
+
+        X_all = np.ndarray((total, n_features), dtype=np.float64, buffer=x_shm.buf)
+        keys_all = np.ndarray((total, 2), dtype=np.int64, buffer=keys_shm.buf)
+        valid = np.concatenate(
+            [np.arange(o, o + n, dtype=np.intp) for o, n in zip(offsets, written)]
+        )
+        keys = keys_all[valid]
+        order = valid[np.lexsort((keys[:, 1], keys[:, 0]))]
 
-    X = np.array(X, dtype=float)
+        # نفس reservoir sampling التسلسلي على نفس الترتيب
+        capacity = min(order.size, max_rows) if max_rows else order.size
+        if capacity < order.size:
+            rng = np.random.default_rng(random_state)
+            picked = order[:capacity].copy()
+            for seen in range(capacity, order.size):
+                slot = _reservoir_slot(rng, seen, capacity)
+                if slot >= 0:
+                    picked[slot] = order[seen]
+            order = picked
+
+        X = X_all[order].copy()
+        del X_all, keys_all
+        return X
+    finally:
+        x_shm.close()
+        x_shm.unlink()
+        keys_shm.close()
+        keys_shm.unlink()
+
+
+def load_training_matrix_from_store(
+    store_dir: str,
+    random_state: int = 42,
+    max_rows: int | None = None,
+) -> np.ndarray:
+    """
+    مصفوفة التدريب من مخزن الميزات العمودي (feature_store.py) بدل إعادة حساب
+    الميزات من events: نفس الأحداث المحفوظة (stored=1)، مقروءة من memmaps.
+    """
+    return FeatureStore(store_dir).matrix(
+        FEATURE_KEYS, stored_only=True, max_rows=max_rows, random_state=random_state
+    )
+
+
+def train_model(
+    db_path: str | None = None,
+    model_path: str | None = None,
+    random_state: int = 42,
+    chunk_size: int = TRAIN_CHUNK_SIZE,
+    max_rows: int | None = None,
+    workers: int = 1,
+    activate: bool = True,
+    feature_store: str | None = None,
+) -> str | None:
+    """
+    تدريب IsolationForest على الأحداث المخزّنة في قاعدة البيانات
+    (ميزات محسوبة بالتدريج أثناء المرور على السجل)، ثم حفظه كنسخة جديدة
+    في سجل النماذج وترجع اسم النسخة.
+
+    workers: عدد الـ processes لبناء الميزات + عدد الأنوية لتدريب الغابة
+    (1 = تسلسلي بذاكرة ثابتة، 0 = كل الأنوية).
+    model_path: لو محدد نحفظ ملف واحد بالطريقة القديمة بدل السجل.
+    activate: تفعيل النسخة الجديدة مباشرة (الخوادم تلتقطها بدون إعادة تشغيل).
+    feature_store: مجلد مخزن الميزات؛ لو محدد تُقرأ الميزات منه بدل db_path.
+    db_path: افتراضياً نفس قاعدة الخدمة (database.sqlite_db_path) مهما كان المجلد الحالي.
+    """
+    started = time.perf_counter()
+    if db_path is None and feature_store is None:
+        from database import sqlite_db_path
+
+        db_path = sqlite_db_path()
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+
+    if feature_store is not None:
+        X = load_training_matrix_from_store(
+            feature_store, random_state=random_state, max_rows=max_rows
+        )
+    elif workers > 1:
+        X = load_training_matrix_parallel(
+            db_path,
+            workers=workers,
+            random_state=random_state,
+            chunk_size=chunk_size,
+            max_rows=max_rows,
+        )
+    else:
+        X = load_training_matrix(
+            db_path,
+            random_state=random_state,
+            chunk_size=chunk_size,
+            max_rows=max_rows,
+        )
+
+    if X.shape[0] == 0:
+        print("[train_model] لا توجد أحداث في قاعدة البيانات للتدريب.")
+        # ممكن مستقبلاً نولّد بيانات تدريب صناعية هنا
+        return
 
     # نموذج IsolationForest للكشف عن الشذوذ
     model = IsolationForest(
         n_estimators=200,
         contamination=0.05,  # يفترض أن 5% فقط شاذ
         random_state=random_state,
+        n_jobs=workers,  # النتيجة نفسها مع أي n_jobs لنفس random_state
     )
     model.fit(X)
-
-    joblib.dump(model, model_path)
-    print(f"[train_model] تم تدريب النموذج وحفظه في: {model_path}")
+    training_seconds = time.perf_counter() - started
     print(f"[train_model] عدد العينات المستخدمة في التدريب: {X.shape[0]}")
 
+    if model_path is not None:
+        joblib.dump(model, model_path)
+        print(f"[train_model] تم تدريب النموذج وحفظه في: {model_path}")
+        export_flat_model(model_path, model=model)
+        return None
+
+    return registry.publish(
+        model,
+        {
+            "feature_keys": FEATURE_KEYS,
+            "training_rows": int(X.shape[0]),
+            "training_seconds": round(training_seconds, 3),
+            "db_path": os.path.abspath(db_path) if feature_store is None else None,
+            "feature_store": os.path.abspath(feature_store) if feature_store is not None else None,
+            "random_state": random_state,
+            "max_rows": max_rows,
+            "workers": workers,
+            "n_estimators": model.n_estimators,
+            "contamination": model.contamination,
+        },
+        activate=activate,
+    )
+
+
+def export_flat_model(
+    model_path: str = MODEL_PATH,
+    flat_path: str | None = None,
+    model: IsolationForest | None = None,
+) -> FlatForest:
+    """
+    تحويل IsolationForest المحفوظ إلى مصفوفات NumPy مسطّحة وحفظها بجانبه.
+    الملف الناتج يحمل sha256 لملف النموذج الأصلي حتى نعرف إذا صار قديم.
+    """
+    flat_path = flat_path or flat_model_path(model_path)
+    if model is None:
+        model = joblib.load(model_path)
+
+    flat = FlatForest.from_sklearn(model, source_sha256=file_sha256(model_path))
+    flat.save(flat_path)
+    print(f"[model] تم حفظ النسخة المسطّحة من النموذج في: {flat_path}")
+    return flat
+
+
+def _load_flat_model() -> FlatForest | None:
+    """
+    تحميل النسخة المسطّحة لو كانت مطابقة لملف النموذج الحالي،
+    وإلا نبنيها من ملف sklearn (مرة واحدة) ونحفظها للتشغيلات القادمة.
+    """
+    source_sha256 = file_sha256(MODEL_PATH)
+    path = flat_model_path(MODEL_PATH)
+
+    if os.path.exists(path):
+        try:
+            flat = FlatForest.load(path)
+            if flat.source_sha256 == source_sha256:
+                print("[model] تم تحميل النسخة المسطّحة من النموذج.")
+                return flat
+        except (OSError, ValueError, KeyError) as e:
+            print(f"[model] تعذر قراءة النسخة المسطّحة، سيتم إعادة بنائها: {e}")
+
+    flat = FlatForest.from_sklearn(joblib.load(MODEL_PATH), source_sha256=source_sha256)
+    try:
+        flat.save(path)
+    except OSError as e:
+        # مجلد للقراءة فقط مثلاً: نكمل بالنسخة التي في الذاكرة
+        print(f"[model] تعذر حفظ النسخة المسطّحة: {e}")
+    return flat
+
+
+def _legacy_key() -> tuple | None:
+    try:
+        st = os.stat(MODEL_PATH)
+    except OSError:
+        return None
+    return ("legacy", st.st_mtime_ns, st.st_size)
 
-def _load_model() -> IsolationForest:
+
+def _desired_key() -> tuple:
     """
-    تحميل النموذج من الملف، أو إعادة استخدامه لو كان محمّل مسبقاً.
+    أي نموذج يجب أن يكون فعّالاً الآن: نسخة السجل الفعّالة،
+    وإلا ملف MODEL_PATH القديم، وإلا النموذج الافتراضي.
     """
-    global _model
+    version = registry.active_version()
+    if version is not None:
+        return ("registry", version)
+    return _legacy_key() or ("dummy",)
 
-    if _model is not None:
-        return _model
 
-    if not os.path.exists(MODEL_PATH):
+def _build_model(key: tuple) -> LoadedModel:
+    if key[0] == "registry":
+        loaded = registry.load(key[1], flat=USE_FLAT_MODEL)
+    elif key[0] == "legacy":
+        model = _load_flat_model() if USE_FLAT_MODEL else joblib.load(MODEL_PATH)
+        print("[model] تم تحميل النموذج من القرص.")
+        loaded = LoadedModel(model, "legacy", "legacy", key, {"path": MODEL_PATH})
+    elif key[0] == "file":
+        path = key[1]
+        model = FlatForest.load(path) if path.endswith(".npz") else joblib.load(path)
+        loaded = LoadedModel(model, os.path.basename(path), "file", key, {"path": path})
+    else:
         print("[model] ملف النموذج غير موجود، يُفضّل تشغيل train_model أولاً.")
         # في حالة عدم وجود نموذج، ننشئ واحداً بسيطاً افتراضياً لتجنب الانهيار
         dummy = IsolationForest(
@@ -126,12 +574,195 @@ def _load_model() -> IsolationForest:
         )
         # تدريب سريع على نقطة واحدة (صحيّة) حتى لا يرمي خطأ
         dummy.fit(np.zeros((10, len(FEATURE_KEYS))))
-        _model = dummy
-        return _model
+        loaded = LoadedModel(dummy, "dummy", "dummy", key, {})
+
+    if loaded.feature_keys is None:
+        # نماذج دُرّبت قبل إضافة ميزات جديدة (آخر FEATURE_KEYS) تقيّم بأول n_features_in_ منها
+        loaded.feature_keys = FEATURE_KEYS[:loaded.model.n_features_in_]
+
+    # تسخين: أول تقييم يحدث هنا وليس في أول طلب بعد التبديل
+    loaded.model.decision_function(np.zeros((1, len(loaded.feature_keys))))
+    return loaded
+
+
+def load_model_spec(spec: str) -> LoadedModel:
+    """
+    تحميل نموذج مستقل عن النموذج الفعّال (للمقارنة في backtest.py):
+    "active" = ما يقيّم به الخادم الآن، "legacy" = MODEL_PATH، "v0003" = نسخة من السجل،
+    أو مسار ملف .pkl / .flat.npz.
+    """
+    if spec == "active":
+        return _build_model(_desired_key())
+    if spec == "legacy":
+        key = _legacy_key()
+        if key is None:
+            raise ValueError(f"Model file not found: {MODEL_PATH}")
+        return _build_model(key)
+    if spec in registry.versions():
+        return _build_model(("registry", spec))
+    if os.path.isfile(spec):
+        return _build_model(("file", os.path.abspath(spec)))
+    raise ValueError(f"Unknown model: {spec}")
+
+
+def reload_model(force: bool = False) -> bool:
+    """
+    تحميل النموذج المطلوب لو تغيّر (أو force) ثم نشره بإسناد مرجع واحد.
+    الطلبات الجارية تكمل بالنموذج القديم، والطلبات التالية ترى الجديد.
+    ترجع True لو تم التبديل.
+    """
+    global _active
+
+    with _load_lock:
+        key = _desired_key()
+        current = _active
+        if current is not None and current.key == key and not force:
+            return False
+
+        loaded = _build_model(key)
+        _active = loaded
+
+    old_version = current.version if current is not None else None
+    print(f"[model] النموذج الفعّال: {loaded.version} (السابق: {old_version})")
+    return True
+
+
+def _get_active() -> LoadedModel:
+    active = _active
+    if active is None:
+        reload_model()
+        active = _active
+    return active
+
+
+def _load_model():
+    """
+    النموذج الفعّال حالياً (تحميل أول مرة فقط لو لم يُحمّل عند التشغيل).
+    الافتراضي: النسخة المسطّحة (FlatForest) بنفس واجهة decision_function.
+    """
+    return _get_active().model
+
+
+def model_info() -> Dict:
+    """
+    معلومات النسخة الفعّالة (لـ /model).
+    """
+    info = _get_active().info()
+    info["engine"] = ANOMALY_ENGINE
+    if online_model is not None:
+        info["online"] = online_model.info()
+    return info
+
+
+def _scoring_model():
+    """
+    (النموذج الذي يقيّم الآن, ترتيب ميزاته):
+    Half-Space Trees لو مفعّلة وجاهزة، وإلا IsolationForest.
+    """
+    if online_model is not None and online_model.ready:
+        return online_model, FEATURE_KEYS
+    active = _get_active()
+    return active.model, active.feature_keys
+
+
+def learn_event(features: Dict[str, float], risk_score: float) -> None:
+    """
+    تحديث النموذج المتعلّم أثناء التشغيل بعد حفظ الحدث.
+    نتعلم فقط من الأحداث منخفضة المخاطر (نفس حد البصمة) حتى لا يتسمم الأساس.
+    """
+    if online_model is None or risk_score > LOW_RISK_THRESHOLD:
+        return
+    online_model.learn(_vector_from_features(features))
+
+
+def save_online_model() -> bool:
+    """
+    حفظ حالة النموذج المتعلّم لو تعلّم شيئاً منذ آخر حفظ.
+    """
+    global _online_saved_samples
+
+    if online_model is None:
+        return False
+    samples = online_model.samples_seen
+    if samples == _online_saved_samples:
+        return False
+    online_model.save(ONLINE_STATE_PATH)
+    _online_saved_samples = samples
+    return True
+
+
+def _online_save_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            save_online_model()
+        except Exception as e:
+            print(f"[model] فشل حفظ حالة النموذج المتعلّم: {e}")
+
+
+def start_online_model(interval: float = ONLINE_SAVE_INTERVAL) -> None:
+    """
+    SND_ANOMALY_ENGINE=online: استعادة الحالة المحفوظة + حفظ دوري وعند الإيقاف.
+    الحالة في عملية واحدة، فأكثر من worker (SND_WORKER_PROCESSES) يعطي درجات مختلفة
+    لنفس الحدث حسب العملية: نرفض التشغيل بدل ذلك.
+    """
+    global _online_saved_samples, _online_saver
+
+    if online_model is None or _online_saver is not None:
+        return
+    if int(os.environ.get("SND_WORKER_PROCESSES", "1")) > 1:
+        raise RuntimeError(
+            "SND_ANOMALY_ENGINE=online keeps its state in one process; run a single worker"
+        )
+
+    if os.path.exists(ONLINE_STATE_PATH):
+        try:
+            if online_model.load(ONLINE_STATE_PATH):
+                _online_saved_samples = online_model.samples_seen
+                print(
+                    f"[model] تمت استعادة النموذج المتعلّم ({online_model.samples_seen} حدث، "
+                    f"{online_model.windows_completed} نافذة) من: {ONLINE_STATE_PATH}"
+                )
+            else:
+                print(f"[model] تجاهل {ONLINE_STATE_PATH}: إعدادات النموذج المتعلّم تغيّرت")
+        except Exception as e:
+            print(f"[model] فشل استعادة النموذج المتعلّم، نبدأ من الصفر: {e}")
+
+    atexit.register(save_online_model)
+    if interval <= 0:
+        _online_saver = False
+        return
+    _online_saver = threading.Thread(
+        target=_online_save_loop, args=(interval,), name="snd-online-saver", daemon=True
+    )
+    _online_saver.start()
+
+
+def _reload_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            reload_model()
+        except Exception as e:
+            # نكمل بالنموذج الحالي ونحاول مرة أخرى في الفحص التالي
+            print(f"[model] فشل تحميل النموذج الجديد: {e}")
+
 
-    _model = joblib.load(MODEL_PATH)
-    print("[model] تم تحميل النموذج من القرص.")
-    return _model
+def start_model_reloader(interval: float = MODEL_RELOAD_INTERVAL) -> None:
+    """
+    تحميل النموذج عند تشغيل الخادم (بدل أول طلب) + thread في الخلفية
+    يفحص السجل كل interval ثانية ويبدّل النموذج عند تفعيل نسخة جديدة.
+    """
+    global _reloader
+
+    _get_active()
+    start_online_model()
+    if interval <= 0 or _reloader is not None:
+        return
+    _reloader = threading.Thread(
+        target=_reload_loop, args=(interval,), name="snd-model-reloader", daemon=True
+    )
+    _reloader.start()
 
 
 def evaluate_event(features: Dict[str, float]) -> float:
@@ -143,14 +774,101 @@ def evaluate_event(features: Dict[str, float]) -> float:
     - قيم أعلى (قريبة من 0.5) = طبيعي
     - قيم أقل (قريبة من -0.5 أو أقل) = شاذ
     """
-    model = _load_model()
-    vec = _vector_from_features(features)
+    model, keys = _scoring_model()
+    vec = _vector_from_features(features, keys)
     score = model.decision_function(vec)[0]
     return float(score)
 
 
+def evaluate_events(features_list: List[Dict[str, float]]) -> List[float]:
+    """
+    نفس evaluate_event لكن لمجموعة أحداث:
+    نبني مصفوفة واحدة ونستدعي decision_function مرة واحدة فقط
+    بدل استدعاء لكل حدث (تكلفة sklearn الثابتة لكل استدعاء أكبر من حساب الأشجار نفسه).
+    """
+    if not features_list:
+        return []
+    model, keys = _scoring_model()
+    X = _matrix_from_features(features_list, keys)
+    return [float(s) for s in model.decision_function(X)]
+
+
 if __name__ == "__main__":
     # يسمح لك بتدريب النموذج عن طريق:
     # python -m app.model
-    print("[model] بدء تدريب النموذج من خلال main ...")
-    train_model()
+    # أو تحويل النموذج الحالي إلى النسخة المسطّحة فقط:
+    # python -m app.model --export-flat
+    # أو عرض/تفعيل نسخ السجل:
+    # python -m app.model --list
+    # python -m app.model --activate v0002
+    parser = argparse.ArgumentParser(description="SND model training")
+    parser.add_argument(
+        "--db", default=None, help="مسار قاعدة SQLite (افتراضياً قاعدة الخدمة من SND_DATABASE_URL)"
+    )
+    parser.add_argument(
+        "--max-rows",
+        type=int,
+        default=None,
+        help="أقصى عدد صفوف تدريب (reservoir sampling لو السجل أكبر)",
+    )
+    parser.add_argument("--chunk-size", type=int, default=TRAIN_CHUNK_SIZE)
+    parser.add_argument(
+        "--feature-store",
+        nargs="?",
+        const=FEATURE_STORE_DIR,
+        default=None,
+        metavar="DIR",
+        help="التدريب من مخزن الميزات العمودي بدل events (افتراضياً SND_FEATURE_STORE_DIR)",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="عدد الـ processes للميزات والأنوية للتدريب (0 = كل الأنوية)",
+    )
+    parser.add_argument(
+        "--export-flat",
+        action="store_true",
+        help="تحويل snd_model.pkl إلى snd_model.flat.npz بدون تدريب",
+    )
+    parser.add_argument(
+        "--no-activate",
+        action="store_true",
+        help="حفظ النسخة الجديدة في السجل بدون تفعيلها",
+    )
+    parser.add_argument("--list", action="store_true", help="عرض نسخ السجل")
+    parser.add_argument("--activate", metavar="VERSION", help="تفعيل نسخة من السجل")
+    args = parser.parse_args()
+
+    if args.export_flat:
+        export_flat_model()
+    elif args.list:
+        active = registry.active_version()
+        for version in registry.versions():
+            meta = registry.metadata(version)
+            marker = "*" if version == active else " "
+            print(
+                f"{marker} {version}  {meta.get('created_at')}  "
+                f"rows={meta.get('training_rows')}  {meta.get('training_seconds')}s"
+            )
+    elif args.activate:
+        registry.activate(args.activate)
+    else:
+        db_path = args.db
+        if db_path is None and args.feature_store is None:
+            from database import sqlite_db_path
+
+            try:
+                db_path = sqlite_db_path()
+            except ValueError as e:
+                print(f"[model] {e} (استخدم --db أو --feature-store)")
+                sys.exit(2)
+        print("[model] بدء تدريب النموذج من خلال main ...")
+        train_model(
+            db_path=db_path,
+            chunk_size=args.chunk_size,
+            max_rows=args.max_rows,
+            workers=args.workers,
+            activate=not args.no_activate,
+            feature_store=args.feature_store,
+        )
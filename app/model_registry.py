@@ -0,0 +1,203 @@
+import json
+import os
+import re
+import tempfile
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional
+
+import joblib
+
+from app.fast_forest import FlatForest, file_sha256
+
+# ---------------------------------------------------------------
+# سجل النماذج (Model Registry):
+#
+#   models/
+#     v0001/  model.pkl  model.flat.npz  metadata.json
+#     v0002/  ...
+#     ACTIVE  ← اسم النسخة الفعّالة (يُكتب ذرّياً بـ os.replace)
+#
+# كل نسخة تُكتب في مجلد مؤقت ثم تُنقل باسمها النهائي (rename ذرّي)،
+# فلا يرى أي قارئ نسخة نصف مكتوبة.
+# ---------------------------------------------------------------
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MODEL_REGISTRY_DIR = os.environ.get(
+    "SND_MODEL_REGISTRY", os.path.join(BASE_DIR, "models")
+)
+
+ACTIVE_FILE = "ACTIVE"
+MODEL_FILE = "model.pkl"
+FLAT_FILE = "model.flat.npz"
+METADATA_FILE = "metadata.json"
+
+_VERSION_RE = re.compile(r"^v(\d+)$")
+
+
+class LoadedModel:
+    """
+    نموذج جاهز للتقييم + معلوماته. يُستبدل ككائن كامل (مرجع واحد)
+    حتى يرى كل طلب نموذجاً ومعلومات من نفس النسخة.
+    """
+
+    __slots__ = ("model", "version", "source", "key", "metadata", "feature_keys", "loaded_at")
+
+    def __init__(
+        self,
+        model,
+        version: str,
+        source: str,
+        key: tuple,
+        metadata: Dict,
+        feature_keys: Optional[List[str]] = None,
+    ):
+        self.model = model
+        self.version = version
+        self.source = source  # registry / legacy / dummy
+        self.key = key  # يتغير فقط لو تغيّر الملف/النسخة على القرص
+        self.metadata = metadata
+        # ترتيب الميزات الذي تدرّب عليه النموذج (None = يحدده app.model)
+        self.feature_keys = feature_keys
+        self.loaded_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+    def info(self) -> Dict:
+        return {
+            "version": self.version,
+            "source": self.source,
+            "loaded_at": self.loaded_at,
+            "model_type": type(self.model).__name__,
+            "feature_keys": self.feature_keys,
+            "metadata": self.metadata,
+        }
+
+
+class ModelRegistry:
+    def __init__(self, root: str = MODEL_REGISTRY_DIR):
+        self.root = root
+
+    # ---------- القراءة ---------- #
+
+    def version_dir(self, version: str) -> str:
+        return os.path.join(self.root, version)
+
+    def versions(self) -> List[str]:
+        if not os.path.isdir(self.root):
+            return []
+        found = []
+        for name in os.listdir(self.root):
+            match = _VERSION_RE.match(name)
+            if match and os.path.exists(os.path.join(self.root, name, METADATA_FILE)):
+                found.append((int(match.group(1)), name))
+        return [name for _, name in sorted(found)]
+
+    def metadata(self, version: str) -> Dict:
+        with open(os.path.join(self.version_dir(version), METADATA_FILE), encoding="utf-8") as f:
+            return json.load(f)
+
+    def active_version(self) -> Optional[str]:
+        """
+        النسخة الفعّالة حسب ملف ACTIVE (أو None لو السجل فارغ).
+        """
+        try:
+            with open(os.path.join(self.root, ACTIVE_FILE), encoding="utf-8") as f:
+                version = f.read().strip()
+        except OSError:
+            return None
+        if not version or not os.path.isdir(self.version_dir(version)):
+            return None
+        return version
+
+    def load(self, version: str, flat: bool = True) -> LoadedModel:
+        """
+        تحميل نسخة من السجل. flat=True: النسخة المسطّحة (تُبنى من model.pkl
+        لو كانت ناقصة أو لا تطابق sha256 الخاص به).
+        """
+        path = self.version_dir(version)
+        metadata = self.metadata(version)
+        model_path = os.path.join(path, MODEL_FILE)
+
+        if not flat:
+            model = joblib.load(model_path)
+        else:
+            model = None
+            flat_path = os.path.join(path, FLAT_FILE)
+            if os.path.exists(flat_path):
+                try:
+                    model = FlatForest.load(flat_path)
+                    if model.source_sha256 != metadata.get("sha256"):
+                        model = None
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"[model_registry] تعذر قراءة {flat_path}: {e}")
+                    model = None
+            if model is None:
+                model = FlatForest.from_sklearn(
+                    joblib.load(model_path), source_sha256=file_sha256(model_path)
+                )
+
+        return LoadedModel(
+            model, version, "registry", ("registry", version), metadata,
+            feature_keys=metadata.get("feature_keys"),
+        )
+
+    # ---------- الكتابة ---------- #
+
+    def publish(self, model, metadata: Dict, activate: bool = True) -> str:
+        """
+        حفظ نموذج sklearn كنسخة جديدة (pkl + flat + metadata) وترجع اسمها.
+        activate=True: تصبح النسخة الفعّالة مباشرة.
+        """
+        os.makedirs(self.root, exist_ok=True)
+        tmp_dir = tempfile.mkdtemp(prefix=".tmp-", dir=self.root)
+
+        model_path = os.path.join(tmp_dir, MODEL_FILE)
+        joblib.dump(model, model_path)
+        sha256 = file_sha256(model_path)
+        FlatForest.from_sklearn(model, source_sha256=sha256).save(
+            os.path.join(tmp_dir, FLAT_FILE)
+        )
+
+        while True:
+            existing = self.versions()
+            last = int(_VERSION_RE.match(existing[-1]).group(1)) if existing else 0
+            version = f"v{last + 1:04d}"
+
+            meta = dict(metadata)
+            meta.update({
+                "version": version,
+                "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+                "sha256": sha256,
+            })
+            with open(os.path.join(tmp_dir, METADATA_FILE), "w", encoding="utf-8") as f:
+                json.dump(meta, f, ensure_ascii=False, indent=2)
+
+            try:
+                os.rename(tmp_dir, self.version_dir(version))
+                break
+            except OSError:
+                # تدريب آخر أخذ نفس الرقم في نفس اللحظة → نجرب الرقم التالي
+                if not os.path.isdir(self.version_dir(version)):
+                    raise
+                time.sleep(0.01)
+
+        print(f"[model_registry] تم حفظ النسخة {version} في: {self.version_dir(version)}")
+        if activate:
+            self.activate(version)
+        return version
+
+    def activate(self, version: str) -> None:
+        """
+        جعل النسخة هي الفعّالة (الخوادم تلتقطها في الفحص الدوري التالي).
+        """
+        if not os.path.exists(os.path.join(self.version_dir(version), METADATA_FILE)):
+            raise ValueError(f"Unknown model version: {version}")
+        # ملف مؤقت باسم فريد لكل استدعاء: تفعيلان متزامنان لا يكتبان في نفس الملف
+        fd, tmp_path = tempfile.mkstemp(prefix=f".{ACTIVE_FILE}-", suffix=".tmp", dir=self.root)
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                f.write(version + "\n")
+            os.replace(tmp_path, os.path.join(self.root, ACTIVE_FILE))
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        print(f"[model_registry] النسخة الفعّالة الآن: {version}")
@@ -0,0 +1,310 @@
+import os
+import tempfile
+import threading
+from typing import Dict, List, NamedTuple, Sequence, Tuple
+
+import numpy as np
+
+# ---------------------------------------------------------------
+# نموذج شذوذ يتعلم أثناء التشغيل: Streaming Half-Space Trees
+# (Tan, Ting & Liu 2011).
+#
+# - كل شجرة كاملة بعمق ثابت، مبنية عشوائياً على فضاء الميزات
+#   (بدون بيانات)، ومخزنة كمصفوفات heap: ابناء العقدة i هم 2i+1 و 2i+2
+# - كل عقدة فيها "كتلة مرجعية" (النافذة السابقة) و "كتلة حالية"
+# - التعلم = زيادة الكتلة الحالية على مسار واحد في كل شجرة
+#   (عمق الشجرة = log2 لعدد العقد) → تكلفة ثابتة وذاكرة ثابتة
+# - كل window_size حدث: الحالية تصبح المرجعية وتبدأ نافذة جديدة
+#   (النموذج يتبع تغيّر السلوك بدون إعادة تدريب كاملة)
+# - الحالة (الكتل + المعايرة + النافذة الجارية) تُحفظ في ملف npz وتُستعاد عند التشغيل
+#   (save / load). الحالة في عملية واحدة فقط: عدة workers = نماذج مختلفة، فلا نسمح بها.
+# ---------------------------------------------------------------
+
+ONLINE_TREES = 25
+ONLINE_DEPTH = 10
+ONLINE_WINDOW_SIZE = 250
+
+# نسبة الأحداث التي نعتبرها شاذة عند المعايرة (نفس contamination في IsolationForest)
+ONLINE_CONTAMINATION = 0.05
+
+# قيمة decision_function لحدث "عادي" (الوسيط) بعد المعايرة،
+# قريبة من القيم التي يعطيها IsolationForest للأحداث العادية
+ONLINE_TYPICAL_SCORE = 0.15
+
+
+class _Reference(NamedTuple):
+    """
+    الكتلة المرجعية ومعايرتها (offset / scale المحسوبة عليها).
+    تُنشر معاً بإسناد واحد، فالتقييم المتزامن مع تبديل النافذة يرى القديمة كاملة أو الجديدة كاملة.
+    """
+
+    mass: np.ndarray
+    offset: float
+    scale: float
+
+
+class HalfSpaceForest:
+    """
+    limits: لكل ميزة (أقل قيمة, أعلى قيمة, log?) لتحويلها إلى [0, 1]
+    (log=True: نستخدم log1p للعدادات والمدد ذات الذيل الطويل).
+    القيم خارج الحدود تُقص عليها.
+    """
+
+    def __init__(
+        self,
+        limits: Sequence[Tuple[float, float, bool]],
+        n_trees: int = ONLINE_TREES,
+        depth: int = ONLINE_DEPTH,
+        window_size: int = ONLINE_WINDOW_SIZE,
+        contamination: float = ONLINE_CONTAMINATION,
+        random_state: int = 42,
+    ):
+        self.n_features_in_ = len(limits)
+        self.n_trees = int(n_trees)
+        self.depth = int(depth)
+        self.window_size = int(window_size)
+        self.contamination = float(contamination)
+        # العقدة التي كتلتها المرجعية <= هذا الحد تعتبر "نادرة" ونتوقف عندها
+        self.size_limit = 0.1 * self.window_size
+
+        log = np.array([bool(l[2]) for l in limits])
+        lo = np.array([float(l[0]) for l in limits])
+        hi = np.array([float(l[1]) for l in limits])
+        self._log = log
+        self._lo = np.where(log, np.log1p(np.maximum(lo, 0.0)), lo)
+        span = np.where(log, np.log1p(np.maximum(hi, 0.0)), hi) - self._lo
+        self._span = np.where(span > 0, span, 1.0)
+
+        self.feature, self.split = self._build_trees(np.random.default_rng(random_state))
+        n_nodes = self.feature.shape[1]
+        self._ref = _Reference(np.zeros((self.n_trees, n_nodes), dtype=np.float64), 0.0, 1.0)
+        self.latest_mass = np.zeros((self.n_trees, n_nodes), dtype=np.float64)
+        # 2^عمق كل عقدة (لتحويل الكتلة إلى كثافة)
+        node_depth = np.floor(np.log2(np.arange(n_nodes) + 1)).astype(np.int64)
+        self._depth_scale = 2.0 ** node_depth
+        self._tree_index = np.arange(self.n_trees)[:, None]
+
+        # عينات النافذة الحالية (للمعايرة عند تبديل النافذة)
+        self._window_rows = np.empty((self.window_size, self.n_features_in_), dtype=np.float64)
+        self._window_count = 0
+        self.samples_seen = 0
+        self.windows_completed = 0
+        self._lock = threading.Lock()
+
+    # ---------- بناء الأشجار ---------- #
+
+    def _build_trees(self, rng: np.random.Generator):
+        n_internal = 2 ** self.depth - 1
+        n_nodes = 2 ** (self.depth + 1) - 1
+        feature = np.zeros((self.n_trees, n_nodes), dtype=np.intp)
+        split = np.full((self.n_trees, n_nodes), np.inf, dtype=np.float64)
+
+        for t in range(self.n_trees):
+            # مجال عمل عشوائي لكل ميزة يغطي [0, 1] (كما في الورقة الأصلية)
+            s = rng.random(self.n_features_in_)
+            r = 2.0 * np.maximum(s, 1.0 - s)
+            mins = np.empty((n_nodes, self.n_features_in_))
+            maxs = np.empty((n_nodes, self.n_features_in_))
+            mins[0] = s - r
+            maxs[0] = s + r
+
+            for node in range(n_internal):
+                q = int(rng.integers(self.n_features_in_))
+                mid = (mins[node, q] + maxs[node, q]) / 2.0
+                feature[t, node] = q
+                split[t, node] = mid
+
+                left, right = 2 * node + 1, 2 * node + 2
+                mins[left] = mins[node]
+                maxs[left] = maxs[node]
+                maxs[left, q] = mid
+                mins[right] = mins[node]
+                maxs[right] = maxs[node]
+                mins[right, q] = mid
+
+        return feature, split
+
+    # ---------- المسارات ---------- #
+
+    def _scale_rows(self, X) -> np.ndarray:
+        X = np.asarray(X, dtype=np.float64)
+        if X.ndim == 1:
+            X = X.reshape(1, -1)
+        X = np.where(self._log, np.log1p(np.maximum(X, 0.0)), X)
+        return np.clip((X - self._lo) / self._span, 0.0, 1.0)
+
+    def _paths(self, X: np.ndarray) -> np.ndarray:
+        """
+        مسار كل صف في كل شجرة: مصفوفة (صفوف, أشجار, depth + 1) من أرقام العقد.
+        """
+        n_rows = X.shape[0]
+        trees = np.arange(self.n_trees)[None, :]
+        rows = np.arange(n_rows)[:, None]
+        paths = np.zeros((n_rows, self.n_trees, self.depth + 1), dtype=np.intp)
+        nodes = np.zeros((n_rows, self.n_trees), dtype=np.intp)
+
+        for k in range(self.depth):
+            go_right = X[rows, self.feature[trees, nodes]] > self.split[trees, nodes]
+            nodes = 2 * nodes + 1 + go_right
+            paths[:, :, k + 1] = nodes
+        return paths
+
+    # ---------- التعلم ---------- #
+
+    def learn(self, X) -> None:
+        """
+        إضافة حدث (أو عدة أحداث) للنافذة الحالية.
+        """
+        X = self._scale_rows(X)
+        # المسارات لا تعتمد على الكتل → نحسبها لكل الصفوف مرة واحدة
+        all_paths = self._paths(X)
+        with self._lock:
+            for row, paths in zip(X, all_paths):
+                # كل (شجرة, عقدة) تظهر مرة واحدة في المسار → إضافة مباشرة
+                self.latest_mass[self._tree_index, paths] += 1.0
+                self._window_rows[self._window_count] = row
+                self._window_count += 1
+                self.samples_seen += 1
+                if self._window_count == self.window_size:
+                    self._rotate_window()
+
+    def _rotate_window(self) -> None:
+        # معايرة مثل offset_ في IsolationForest:
+        # أدنى contamination من النافذة → 0، والوسيط → ONLINE_TYPICAL_SCORE.
+        # نقيّم النافذة المكتملة على المرجع السابق (خارج العينة = مثل الأحداث القادمة)،
+        # وأول نافذة فقط على نفسها.
+        mass = self._ref.mass if self.windows_completed else self.latest_mass
+        log_mass = self._log_mass(self._window_rows, mass)
+        offset = float(np.quantile(log_mass, self.contamination))
+        median = float(np.median(log_mass))
+
+        self._ref = _Reference(
+            self.latest_mass, offset, ONLINE_TYPICAL_SCORE / max(median - offset, 1e-9)
+        )
+        self.latest_mass = np.zeros_like(mass)
+        self.windows_completed += 1
+        self._window_count = 0
+
+    # ---------- التقييم ---------- #
+
+    @property
+    def ready(self) -> bool:
+        """
+        النموذج جاهز بعد اكتمال أول نافذة (قبلها لا توجد كتلة مرجعية).
+        """
+        return self.windows_completed > 0
+
+    @property
+    def ref_mass(self) -> np.ndarray:
+        return self._ref.mass
+
+    @property
+    def offset_(self) -> float:
+        return self._ref.offset
+
+    def _log_mass(self, X_scaled: np.ndarray, ref_mass: np.ndarray) -> np.ndarray:
+        paths = self._paths(X_scaled)
+        trees = np.arange(self.n_trees)[None, :, None]
+        mass = ref_mass[trees, paths]  # (صفوف, أشجار, عمق)
+
+        # نتوقف عند أول عقدة كتلتها <= size_limit (أو عند الورقة)
+        rare = mass <= self.size_limit
+        rare[:, :, -1] = True
+        stop = rare.argmax(axis=2)
+
+        stop_nodes = np.take_along_axis(paths, stop[:, :, None], axis=2)[:, :, 0]
+        stop_mass = np.take_along_axis(mass, stop[:, :, None], axis=2)[:, :, 0]
+        score = (stop_mass * self._depth_scale[stop_nodes]).sum(axis=1)
+        return np.log1p(score / (self.n_trees * self.window_size))
+
+    def score_samples(self, X) -> np.ndarray:
+        return self._log_mass(self._scale_rows(X), self._ref.mass)
+
+    def decision_function(self, X) -> np.ndarray:
+        """
+        نفس اتجاه IsolationForest: موجب = عادي، سالب = شاذ (محصورة بين -0.5 و 0.5).
+        """
+        ref = self._ref  # قراءة واحدة: الكتلة والمعايرة من نفس النافذة
+        scores = (self._log_mass(self._scale_rows(X), ref.mass) - ref.offset) * ref.scale
+        return np.clip(scores, -0.5, 0.5)
+
+    # ---------- الحفظ والاستعادة ---------- #
+
+    def state(self) -> Dict[str, np.ndarray]:
+        """
+        نسخة من الحالة كاملة (الأشجار للتحقق من التوافق عند الاستعادة).
+        """
+        with self._lock:
+            ref = self._ref  # لا تتغير بعد نشرها (_rotate_window يبدأ مصفوفة جديدة)
+            return {
+                "config": np.array([self.n_features_in_, self.n_trees, self.depth, self.window_size]),
+                "lo": self._lo,
+                "span": self._span,
+                "feature": self.feature,
+                "split": self.split,
+                "ref_mass": ref.mass,
+                "calibration": np.array([ref.offset, ref.scale]),
+                "latest_mass": self.latest_mass.copy(),
+                "window_rows": self._window_rows[:self._window_count].copy(),
+                "counters": np.array([self.samples_seen, self.windows_completed]),
+            }
+
+    def restore(self, state) -> bool:
+        """
+        استعادة حالة من state(). ترجع False (بدون تغيير) لو الإعدادات أو الأشجار أو حدود
+        الميزات مختلفة (نموذج بإعدادات جديدة يبدأ من الصفر).
+        """
+        current = self.state()
+        for key in ("config", "lo", "span", "feature", "split"):
+            saved = np.asarray(state[key])
+            if saved.shape != current[key].shape or not np.array_equal(saved, current[key]):
+                return False
+
+        rows = np.asarray(state["window_rows"], dtype=np.float64)
+        offset, scale = (float(x) for x in state["calibration"])
+        samples_seen, windows_completed = (int(x) for x in state["counters"])
+        with self._lock:
+            self._ref = _Reference(np.array(state["ref_mass"], dtype=np.float64), offset, scale)
+            self.latest_mass = np.array(state["latest_mass"], dtype=np.float64)
+            self._window_rows[:len(rows)] = rows
+            self._window_count = len(rows)
+            self.samples_seen = samples_seen
+            self.windows_completed = windows_completed
+        return True
+
+    def save(self, path: str) -> None:
+        """
+        حفظ ذرّي: ملف مؤقت في نفس المجلد ثم os.replace.
+        """
+        state = self.state()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                np.savez(f, **state)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def load(self, path: str) -> bool:
+        with np.load(path) as data:
+            return self.restore(data)
+
+    def info(self) -> Dict:
+        return {
+            "ready": self.ready,
+            "samples_seen": self.samples_seen,
+            "windows_completed": self.windows_completed,
+            "window_size": self.window_size,
+            "n_trees": self.n_trees,
+            "depth": self.depth,
+        }
+
+
+def limits_for(keys: List[str], limits: Dict[str, Tuple[float, float, bool]]):
+    """
+    ترتيب حدود الميزات بنفس ترتيب keys (الميزة غير المعرّفة: [0, 1]).
+    """
+    return [limits.get(k, (0.0, 1.0, False)) for k in keys]
@@ -0,0 +1,452 @@
+import json
+import operator
+import os
+import threading
+import time
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.model_registry import BASE_DIR
+
+# ---------------------------------------------------------------
+# محرك السياسات: قواعد rules_score + طبقة القرار من ملف JSON
+# بدل سلاسل if داخل الكود.
+#
+# الشروط:
+#   ["feature", "op", value]          op: == != < <= > >= in not_in
+#   {"all": [...]} / {"any": [...]} / {"not": شرط}
+# المتغير risk_score = قيمة السكور الحالية أثناء طبقة القرار
+# (تتغير مع كل override)، وباقي الأسماء ميزات من build_features.
+#
+# عند التحميل تُترجم السياسة إلى "خطة" مسطحة:
+# - كل شرط ورقي فريد على الميزات يُحسب مرة واحدة لكل دفعة (precomputed)
+# - الشروط على risk_score فقط تُحسب أثناء تطبيق الـ overrides بالترتيب
+# - نفس الخطة تعمل على حدث واحد (قيم عادية) أو دفعة (أعمدة NumPy)
+# ---------------------------------------------------------------
+
+POLICY_PATH = os.environ.get("SND_POLICY_PATH", os.path.join(BASE_DIR, "policy.json"))
+
+# كل كم ثانية نفحص ملف السياسة (0 = بدون فحص دوري)
+POLICY_RELOAD_INTERVAL = float(os.environ.get("SND_POLICY_RELOAD_INTERVAL", "5"))
+
+# متغيرات تتغير أثناء طبقة القرار (ليست ميزات)
+DYNAMIC_VARS = ("risk_score",)
+
+_OPS = {
+    "==": operator.eq,
+    "!=": operator.ne,
+    "<": operator.lt,
+    "<=": operator.le,
+    ">": operator.gt,
+    ">=": operator.ge,
+}
+
+
+class PolicyError(ValueError):
+    pass
+
+
+def _and(a, b):
+    return a & b
+
+
+def _or(a, b):
+    return a | b
+
+
+def _not(a):
+    return ~a if isinstance(a, np.ndarray) else not a
+
+
+def _select(mask, new, old):
+    """
+    where(mask, new, old) لقيمة واحدة أو لعمود.
+    """
+    if isinstance(mask, np.ndarray):
+        return np.where(mask, new, old)
+    return new if mask else old
+
+
+class _Rule:
+    __slots__ = ("id", "cond", "score", "decision", "risk_min", "risk_max")
+
+    def __init__(self, spec: Dict, compile_cond: Callable):
+        if "id" not in spec or "when" not in spec:
+            raise PolicyError(f"Rule needs 'id' and 'when': {spec}")
+        self.id = str(spec["id"])
+        self.cond = compile_cond(spec["when"])
+        self.score = float(spec.get("score", 0.0))
+        self.decision = spec.get("decision")
+        self.risk_min = float(spec["risk_min"]) if "risk_min" in spec else None
+        self.risk_max = float(spec["risk_max"]) if "risk_max" in spec else None
+
+
+class CompiledPolicy:
+    """
+    سياسة جاهزة للتقييم. تُبنى مرة واحدة عند التحميل.
+    """
+
+    def __init__(self, spec: Dict, source: str = ""):
+        self.spec = spec
+        self.source = source
+        self.version = str(spec.get("version", ""))
+        self.defaults: Dict[str, Any] = dict(spec.get("defaults", {}))
+
+        # الشروط الورقية الفريدة على الميزات: (feature, op, value) → رقم
+        self._leaf_index: Dict[tuple, int] = {}
+        self._leaves: List[Tuple[str, str, Any]] = []
+
+        rules_spec = spec.get("rules_score", {})
+        self.score_rules = [_Rule(r, self._compile) for r in rules_spec.get("rules", [])]
+        self.clamp = tuple(float(x) for x in rules_spec.get("clamp", (0, 100)))
+
+        decision_spec = spec.get("decision", {})
+        self.blend = [(str(k), float(w)) for k, w in decision_spec.get("blend", {}).items()]
+        if not self.blend:
+            raise PolicyError("decision.blend is required")
+        self.thresholds = [
+            (float(t["max"]), str(t["decision"])) for t in decision_spec.get("thresholds", [])
+        ]
+        self.default_decision = str(decision_spec.get("default", "Block"))
+
+        # كل override إما قاعدة واحدة أو مجموعة first_match (أول قاعدة تنطبق فقط)
+        self.overrides: List[List[_Rule]] = []
+        for item in decision_spec.get("overrides", []):
+            if "first_match" in item:
+                self.overrides.append([_Rule(r, self._compile) for r in item["first_match"]])
+            else:
+                self.overrides.append([_Rule(item, self._compile)])
+
+        ids = [r.id for r in self.score_rules] + [r.id for g in self.overrides for r in g]
+        if len(ids) != len(set(ids)):
+            raise PolicyError("Rule ids must be unique")
+
+        self.features = sorted({leaf[0] for leaf in self._leaves})
+        self._leaf_fns = [self._leaf_fn(*leaf) for leaf in self._leaves]
+
+    # ---------- الترجمة ---------- #
+
+    def _compile(self, node) -> Callable:
+        """
+        شرط JSON → دالة (static, dynamic) → bool أو مصفوفة bool.
+        """
+        if isinstance(node, list):
+            if len(node) != 3:
+                raise PolicyError(f"Condition must be [feature, op, value]: {node}")
+            name, op, value = node
+            if op not in _OPS and op not in ("in", "not_in"):
+                raise PolicyError(f"Unknown operator: {op}")
+
+            if name in DYNAMIC_VARS:
+                fn = _OPS.get(op)
+                if fn is None:
+                    raise PolicyError(f"Operator {op} not supported for {name}")
+                return lambda static, dynamic, _n=name, _f=fn, _v=value: _f(dynamic[_n], _v)
+
+            if op in ("in", "not_in"):
+                value = tuple(value)
+            key = (name, op, value)
+            idx = self._leaf_index.get(key)
+            if idx is None:
+                idx = self._leaf_index[key] = len(self._leaves)
+                self._leaves.append(key)
+            return lambda static, dynamic, _i=idx: static[_i]
+
+        if isinstance(node, dict) and len(node) == 1:
+            kind, children = next(iter(node.items()))
+            if kind == "not":
+                child = self._compile(children)
+                return lambda static, dynamic: _not(child(static, dynamic))
+            if kind in ("all", "any") and children:
+                compiled = [self._compile(c) for c in children]
+                join = _and if kind == "all" else _or
+
+                def combined(static, dynamic):
+                    result = compiled[0](static, dynamic)
+                    for c in compiled[1:]:
+                        result = join(result, c(static, dynamic))
+                    return result
+
+                return combined
+
+        raise PolicyError(f"Invalid condition: {node}")
+
+    # ---------- الأعمدة ---------- #
+
+    def columns_from_features(self, features_list: Sequence[Dict[str, Any]]) -> Dict[str, np.ndarray]:
+        """
+        قائمة قواميس ميزات → عمود NumPy لكل ميزة تحتاجها السياسة فقط.
+        """
+        columns = {}
+        for name in self.features:
+            default = self.defaults.get(name, 0)
+            values = [f.get(name, default) for f in features_list]
+            if isinstance(default, str) or any(isinstance(v, str) for v in values):
+                columns[name] = np.array(values, dtype=object)
+            else:
+                columns[name] = np.array(values, dtype=np.float64)
+        return columns
+
+    def _leaf_fn(self, name: str, op: str, value) -> Callable:
+        default = self.defaults.get(name, 0)
+        if op in ("in", "not_in"):
+            members = frozenset(value)
+            array_members = np.array(value, dtype=object)
+            negate = op == "not_in"
+
+            def leaf(values):
+                x = values.get(name, default)
+                if isinstance(x, np.ndarray):
+                    hit = np.isin(x, array_members)
+                else:
+                    hit = x in members
+                return _not(hit) if negate else hit
+
+            return leaf
+
+        fn = _OPS[op]
+        return lambda values: fn(values.get(name, default), value)
+
+    def _static(self, values: Dict[str, Any]) -> List:
+        """
+        حساب كل الشروط الورقية مرة واحدة (قيم عادية أو أعمدة).
+        """
+        return [leaf(values) for leaf in self._leaf_fns]
+
+    # ---------- التقييم ---------- #
+
+    def _rules_score(self, static, fired):
+        score = 0.0
+        for rule in self.score_rules:
+            mask = rule.cond(static, None)
+            score = score + _select(mask, rule.score, 0.0)
+            fired.append((rule.id, mask))
+        low, high = self.clamp
+        if isinstance(score, np.ndarray):
+            return np.clip(score, low, high)
+        return max(low, min(high, score))
+
+    def _decide(self, static, variables, fired):
+        risk = 0.0
+        for name, weight in self.blend:
+            risk = risk + weight * variables[name]
+
+        if isinstance(risk, np.ndarray):
+            decision = np.full(risk.shape, self.default_decision, dtype=object)
+            for limit, label in reversed(self.thresholds):
+                decision = np.where(risk <= limit, label, decision)
+        else:
+            decision = self.default_decision
+            for limit, label in self.thresholds:
+                if risk <= limit:
+                    decision = label
+                    break
+
+        vector = isinstance(risk, np.ndarray)
+        for group in self.overrides:
+            taken = False
+            for rule in group:
+                mask = rule.cond(static, {"risk_score": risk})
+                if len(group) > 1:
+                    mask = mask & _not(taken)
+                    taken = taken | mask
+                fired.append((rule.id, mask))
+
+                if not vector:
+                    # حدث واحد: بدون أي عملية NumPy
+                    if mask:
+                        if rule.risk_max is not None:
+                            risk = min(risk, rule.risk_max)
+                        if rule.risk_min is not None:
+                            risk = max(risk, rule.risk_min)
+                        if rule.decision is not None:
+                            decision = rule.decision
+                    continue
+
+                if rule.risk_max is not None:
+                    risk = np.where(mask, np.minimum(risk, rule.risk_max), risk)
+                if rule.risk_min is not None:
+                    risk = np.where(mask, np.maximum(risk, rule.risk_min), risk)
+                if rule.decision is not None:
+                    decision = np.where(mask, rule.decision, decision)
+
+        return risk, decision
+
+    def rules_score(self, features: Dict[str, Any]) -> float:
+        return float(self._rules_score(self._static(features), []))
+
+    def decide(self, features: Dict[str, Any], ai_risk_score: float, rules_score: float):
+        """
+        (risk_score, decision) لحدث واحد.
+        """
+        risk, decision = self._decide(
+            self._static(features),
+            {"ai_risk_score": ai_risk_score, "rules_score": rules_score},
+            [],
+        )
+        return float(risk), decision
+
+    def evaluate(self, features: Dict[str, Any], ai_risk_score: float):
+        """
+        حدث واحد: (rules_score, risk_score, decision, fired_rules).
+        """
+        static = self._static(features)
+        fired: List[Tuple[str, Any]] = []
+        rules_score = float(self._rules_score(static, fired))
+        risk, decision = self._decide(
+            static, {"ai_risk_score": ai_risk_score, "rules_score": rules_score}, fired
+        )
+        return rules_score, float(risk), decision, [rule_id for rule_id, hit in fired if hit]
+
+    def evaluate_columns(self, columns: Dict[str, np.ndarray], ai_risk_scores: np.ndarray):
+        """
+        دفعة كاملة على أعمدة NumPy:
+        (rules_scores, risk_scores, decisions, fired_rules لكل صف).
+        """
+        ai_risk_scores = np.asarray(ai_risk_scores, dtype=np.float64)
+        n = ai_risk_scores.shape[0]
+        static = [
+            np.broadcast_to(s, (n,)) for s in self._static(columns)
+        ]
+        fired: List[Tuple[str, Any]] = []
+        rules_scores = np.broadcast_to(self._rules_score(static, fired), (n,))
+        risk, decision = self._decide(
+            static, {"ai_risk_score": ai_risk_scores, "rules_score": rules_scores}, fired
+        )
+
+        fired_rules: List[List[str]] = [[] for _ in range(n)]
+        for rule_id, mask in fired:
+            for i in np.flatnonzero(np.broadcast_to(mask, (n,))):
+                fired_rules[i].append(rule_id)
+        return rules_scores, np.broadcast_to(risk, (n,)), np.broadcast_to(decision, (n,)), fired_rules
+
+    def evaluate_batch(self, features_list: Sequence[Dict[str, Any]], ai_risk_scores):
+        return self.evaluate_columns(self.columns_from_features(features_list), ai_risk_scores)
+
+    def info(self) -> Dict:
+        return {
+            "version": self.version,
+            "source": self.source,
+            "score_rules": [r.id for r in self.score_rules],
+            "overrides": [r.id for g in self.overrides for r in g],
+        }
+
+
+# ---------------- التحميل + التحديث بدون إعادة تشغيل ----------------
+
+# ملف السياسة المرفق مع الكود (التعريف الوحيد للقواعد الأساسية): يُستخدم لو SND_POLICY_PATH
+# يشير لملف آخر غير موجود أو غير صالح عند التشغيل
+SHIPPED_POLICY_PATH = os.path.join(BASE_DIR, "policy.json")
+
+# آخر خيار لو حتى الملف المرفق غير صالح: درجة النموذج وحدها بنفس العتبات، بدون قواعد
+# (حتى لا يفشل كل طلب /score)
+FALLBACK_POLICY: Dict[str, Any] = {
+    "version": "fallback",
+    "decision": {
+        "blend": {"ai_risk_score": 1.0},
+        "thresholds": [
+            {"max": 30, "decision": "Allow"},
+            {"max": 60, "decision": "Alert"},
+            {"max": 80, "decision": "Challenge"},
+        ],
+        "default": "Block",
+    },
+}
+
+
+def load_policy(path: str = POLICY_PATH) -> CompiledPolicy:
+    with open(path, encoding="utf-8") as f:
+        spec = json.load(f)
+    return CompiledPolicy(spec, source=path)
+
+
+_active: Optional[CompiledPolicy] = None
+_active_mtime: Optional[int] = None
+_failed_mtime: Optional[int] = None  # آخر نسخة غير صالحة (لا نعيد المحاولة حتى يتغير الملف)
+_load_lock = threading.Lock()
+_reloader: Optional[threading.Thread] = None
+
+
+def reload_policy(force: bool = False) -> bool:
+    """
+    إعادة تحميل ملف السياسة لو تغيّر. السياسة الجديدة تُنشر بإسناد مرجع واحد.
+    لو الملف غير صالح (أي خطأ) أو محذوف نكمل بالسياسة الحالية، ولو لا توجد سياسة
+    بعد نستخدم _fallback_policy. ترجع True لو تغيّرت السياسة الفعّالة.
+    """
+    global _active, _active_mtime, _failed_mtime
+
+    with _load_lock:
+        try:
+            mtime = os.stat(POLICY_PATH).st_mtime_ns
+        except OSError:
+            mtime = None
+        if mtime is None:
+            if _active is not None:
+                return False
+            error = f"الملف غير موجود: {POLICY_PATH}"
+        else:
+            if _active is not None and mtime in (_active_mtime, _failed_mtime) and not force:
+                return False
+            try:
+                policy = load_policy(POLICY_PATH)
+            except Exception as e:
+                # spec بشكل خاطئ قد يرمي أي خطأ (AttributeError ...)، لا نعيد المحاولة حتى يتغير الملف
+                _failed_mtime = mtime
+                if _active is not None:
+                    print(f"[policy] فشل تحميل السياسة الجديدة، نكمل بالحالية ({_active.version}): {e}")
+                    return False
+                error = str(e)
+            else:
+                _active, _active_mtime = policy, mtime
+                print(f"[policy] تم تحميل السياسة {policy.version} من: {POLICY_PATH}")
+                return True
+
+        _active = _fallback_policy()
+        _active_mtime = None
+    print(f"[policy] تعذر تحميل ملف السياسة ({error})، نستخدم {_active.source} ({_active.version}).")
+    return True
+
+
+def _fallback_policy() -> CompiledPolicy:
+    """
+    الملف المرفق (لو SND_POLICY_PATH ملف آخر)، وإلا FALLBACK_POLICY.
+    """
+    if os.path.abspath(POLICY_PATH) != os.path.abspath(SHIPPED_POLICY_PATH):
+        try:
+            return load_policy(SHIPPED_POLICY_PATH)
+        except Exception as e:
+            print(f"[policy] تعذر تحميل السياسة المرفقة: {e}")
+    return CompiledPolicy(FALLBACK_POLICY, source="fallback")
+
+
+def get_policy() -> CompiledPolicy:
+    policy = _active
+    if policy is None:
+        reload_policy()
+        policy = _active
+    return policy
+
+
+def _reload_loop(interval: float) -> None:
+    while True:
+        time.sleep(interval)
+        try:
+            reload_policy()
+        except Exception as e:
+            print(f"[policy] فشل تحميل السياسة الجديدة، نكمل بالحالية: {e}")
+
+
+def start_policy_reloader(interval: float = POLICY_RELOAD_INTERVAL) -> None:
+    """
+    تحميل السياسة عند التشغيل + فحص دوري للملف في الخلفية.
+    """
+    global _reloader
+
+    get_policy()
+    if interval <= 0 or _reloader is not None:
+        return
+    _reloader = threading.Thread(
+        target=_reload_loop, args=(interval,), name="snd-policy-reloader", daemon=True
+    )
+    _reloader.start()
@@ -1,8 +1,29 @@
-import sqlite3
+import os
 from datetime import datetime
-from typing import Dict, Tuple, Any
+from typing import Dict, Optional, Tuple, Any
 
-from database import DB_PATH, get_last_event, get_low_risk_event_count, get_event_stats
+from database import get_user_profile, resolve_region
+from profile_cache import UserProfile, sqlite_day
+
+# الحقول الإلزامية في كل حدث
+REQUIRED_FIELDS = ("user_id", "device", "city", "service", "event_time")
+
+# القيم القياسية لـ os / browser (غيرها = "other")
+KNOWN_OS = frozenset({"ios", "android", "windows", "macos", "linux"})
+KNOWN_BROWSERS = frozenset({"safari", "chrome", "edge", "firefox"})
+
+# الخدمات الحساسة (SMS, كلمة مرور, بيانات هوية, ... إلخ)
+SENSITIVE_SERVICES = frozenset({
+    "change_mobile",
+    "reset_password",
+    "update_profile",
+    "update_id",
+    "issue_document",
+    "renew_id",
+})
+
+# أقصى عدد قيم مختلفة نحتفظ بنسخة موحّدة منها لكل حقل فئوي
+CATEGORY_MAX_VALUES = int(os.environ.get("SND_CATEGORY_MAX_VALUES", "10000"))
 
 # -------------------------------
 # 1) دوال مساعدة عامة
@@ -10,28 +31,10 @@ from database import DB_PATH, get_last_event, get_low_risk_event_count, get_even
 
 def convert_city_to_region(city: str) -> str:
     """
-    تحويل المدينة إلى منطقة رئيسية داخل المملكة.
-    يمكنك لاحقاً توسيع القاموس ليشمل كل المدن والقرى.
+    تحويل المدينة إلى منطقة رئيسية داخل المملكة
+    (جدول city_region في الذاكرة، ولتوسيعه: python -m regions load gazetteer.csv).
     """
-    c = (city or "").strip().lower()
-
-    central = {"riyadh", "الرياض"}
-    west = {"jeddah", "مكة", "makkah", "المدينة", "medina", "madinah", "جدة"}
-    east = {"dammam", "الدمام", "khobar", "الخبر", "الظهران"}
-    south = {"abha", "أبها", "جازان", "jazan", "نجران"}
-    north = {"tabuk", "تبوك", "عرعر", "sakaka", "سكاكا", "حائل"}
-
-    if c in central:
-        return "central"
-    if c in west:
-        return "west"
-    if c in east:
-        return "east"
-    if c in south:
-        return "south"
-    if c in north:
-        return "north"
-    return "unknown"
+    return resolve_region(city)
 
 
 def get_time_window(hour: int) -> str:
@@ -52,77 +55,246 @@ def get_time_window(hour: int) -> str:
 
 
 # -------------------------------
-# 2) validate_event
+# 2) الحدث المحلَّل (Event) + القيم الفئوية
 # -------------------------------
 
-def validate_event(data: Dict[str, Any]) -> Tuple[bool, str]:
+class Vocabulary:
     """
-    التحقق من أن الطلب يحتوي على الحقول الأساسية وبصيغة صحيحة.
+    نسخة واحدة (interned) لكل قيمة من حقل فئوي (المدينة، الجهاز، الخدمة، ...):
+    كل الأحداث والبصمات تشير لنفس الكائن، فالمقارنة (last_city == city) ومفاتيح
+    عدادات البصمة تنجح بمقارنة المؤشر قبل مقارنة الأحرف، وذاكرة أقل للبصمات.
+    بحد أقصى CATEGORY_MAX_VALUES (القيم تأتي من العميل)، وبعده ترجع القيمة كما هي.
     """
-    required = ["user_id", "device", "city", "service", "event_time"]
-    for field in required:
+
+    __slots__ = ("values", "max_values")
+
+    def __init__(self, max_values: int = CATEGORY_MAX_VALUES):
+        self.values: Dict[str, str] = {}
+        self.max_values = max_values
+
+    def intern(self, value: str) -> str:
+        canonical = self.values.get(value)
+        if canonical is not None:
+            return canonical
+        if len(self.values) >= self.max_values:
+            return value
+        return self.values.setdefault(value, value)
+
+    def __len__(self) -> int:
+        return len(self.values)
+
+
+CITIES = Vocabulary()
+DEVICES = Vocabulary()
+SERVICES = Vocabulary()
+_OS_VALUES = {value: value for value in KNOWN_OS}
+_BROWSER_VALUES = {value: value for value in KNOWN_BROWSERS}
+
+
+def _clean(value: Any) -> str:
+    return (value if type(value) is str else str(value)).strip().lower()
+
+
+class Event:
+    """
+    حدث بعد التحقق والتطبيع، يُحلَّل مرة واحدة فقط (parse_event) ثم يمر كما هو على
+    الميزات والتخزين والرد: وقت محلَّل (event_dt) + epoch ms + اليوم (مثل date() في SQLite)
+    بدل datetime.fromisoformat في كل مرحلة.
+    """
+
+    __slots__ = (
+        "user_id",
+        "device",
+        "city",
+        "region",
+        "os",
+        "browser",
+        "service",
+        "event_time",
+        "event_dt",
+        "timestamp_ms",
+        "day",
+        "data",
+    )
+
+    def __init__(
+        self,
+        user_id: str,
+        device: str,
+        city: str,
+        service: str,
+        event_time: str,
+        event_dt: datetime,
+        timestamp_ms: Optional[int] = None,
+        region: Optional[str] = None,
+        os_name: Optional[str] = None,
+        browser: Optional[str] = None,
+        data: Optional[Dict[str, Any]] = None,
+    ):
+        self.user_id = user_id
+        self.device = DEVICES.intern(device)
+        self.city = CITIES.intern(city)
+        self.service = SERVICES.intern(service)
+        self.region = region
+        self.os = os_name
+        self.browser = browser
+        self.event_time = event_time
+        self.event_dt = event_dt
+        self.timestamp_ms = (
+            int(event_dt.timestamp() * 1000) if timestamp_ms is None else timestamp_ms
+        )
+        self.day = sqlite_day(event_dt)
+        self.data = data  # الطلب الأصلي (حقول إضافية تُحفظ في raw_payload)
+
+    @classmethod
+    def from_row(
+        cls,
+        user_id: str,
+        device: str,
+        city: str,
+        service: str,
+        event_time: str,
+        timestamp_ms: Optional[int] = None,
+    ) -> "Event":
+        """
+        حدث محفوظ مسبقاً (مطبَّع): التدريب وإعادة التشغيل (backtest.py).
+        ValueError / TypeError لو event_time غير صالح.
+        """
+        return cls(user_id, device, city, service, event_time,
+                   datetime.fromisoformat(event_time), timestamp_ms)
+
+    def to_dict(self) -> Dict[str, Any]:
+        """
+        نفس شكل normalize_event: الطلب الأصلي + الحقول المطبَّعة
+        (raw_payload و received_payload في الرد).
+        """
+        cleaned = dict(self.data or ())
+        cleaned.update(
+            user_id=self.user_id,
+            device=self.device,
+            city=self.city,
+            service=self.service,
+            event_time=self.event_time,
+            os=self.os,
+            browser=self.browser,
+            region=self.region,
+        )
+        return cleaned
+
+
+def _required_error(data: Dict[str, Any]) -> str:
+    """
+    رسالة أول حقل إلزامي ناقص أو فارغ (بنفس ترتيب REQUIRED_FIELDS).
+    """
+    for field in REQUIRED_FIELDS:
         if field not in data:
-            return False, f"Missing field: {field}"
-        if isinstance(data[field], str) and not data[field].strip():
-            return False, f"Empty field: {field}"
+            return f"Missing field: {field}"
+        value = data[field]
+        if isinstance(value, str) and not value.strip():
+            return f"Empty field: {field}"
+    return "ok"
+
+
+def parse_event(data: Any) -> Tuple[Optional[Event], str]:
+    """
+    التحقق + التطبيع في خطوة واحدة: (Event, "ok") أو (None, رسالة الخطأ).
+    نفس قواعد validate_event ونفس ناتج normalize_event:
+      - الحقول الإلزامية موجودة وغير فارغة، و event_time بصيغة ISO
+      - المدينة / الجهاز / الخدمة lowercase، و os / browser إلى قيم قياسية
+      - region من جدول المدن
+    كل حقل يُقرأ ويُنظَّف مرة واحدة، والفحص التفصيلي (_required_error) فقط عند الخطأ.
+    """
+    if not isinstance(data, dict):
+        return None, "Event must be a JSON object"
+
+    try:
+        user_id = data["user_id"]
+        device = data["device"]
+        city = data["city"]
+        service = data["service"]
+        event_time = data["event_time"]
+    except KeyError:
+        return None, _required_error(data)
+
+    # النص الفارغ بعد strip = حقل فارغ (القيم غير النصية لا تكون فارغة بعد str)
+    user_id = (user_id if type(user_id) is str else str(user_id)).strip()
+    device = _clean(device)
+    city = _clean(city)
+    service = _clean(service)
+    event_time_str = (event_time if type(event_time) is str else str(event_time)).strip()
+    if not (user_id and device and city and service and event_time_str):
+        return None, _required_error(data)
 
     # التحقق من صيغة الوقت
     try:
         # نقبل صيغة ISO مثل 2025-11-29T14:00:00
-        datetime.fromisoformat(data["event_time"])
+        event_dt = datetime.fromisoformat(event_time)
     except Exception:
-        return False, "Invalid event_time format, expected ISO like 2025-11-29T14:00:00"
-
-    return True, "ok"
+        return None, "Invalid event_time format, expected ISO like 2025-11-29T14:00:00"
+
+    os_raw = data.get("os")
+    browser_raw = data.get("browser")
+    event = Event(
+        user_id,
+        device,
+        city,
+        service,
+        event_time_str,
+        event_dt,
+        None,
+        convert_city_to_region(city),
+        "other" if os_raw is None else _OS_VALUES.get(_clean(os_raw), "other"),
+        "other" if browser_raw is None else _BROWSER_VALUES.get(_clean(browser_raw), "other"),
+        data,
+    )
+    return event, "ok"
 
 
 # -------------------------------
-# 3) normalize_event
+# 3) validate_event / normalize_event
 # -------------------------------
 
+def validate_event(data: Dict[str, Any]) -> Tuple[bool, str]:
+    """
+    التحقق من أن الطلب يحتوي على الحقول الأساسية وبصيغة صحيحة.
+    (المسار الأساسي يستخدم parse_event مباشرة بدل التحليل مرتين.)
+    """
+    event, message = parse_event(data)
+    return event is not None, message
+
+
 def normalize_event(data: Dict[str, Any]) -> Dict[str, Any]:
     """
-    تطبيع البيانات:
+    تطبيع البيانات (بعد validate_event):
       - توحيد المدينة إلى lowercase
       - إضافة region
       - ضبط os / browser إلى قيم قياسية
     ملاحظة مهمة: لا نُضيف كائنات datetime داخل هذا القاموس
     حتى لا تسبب مشاكل في JSON.
     """
-    cleaned = dict(data)  # نعمل نسخة
-
-    # توحيد النصوص الأساسية
-    cleaned["user_id"] = str(cleaned.get("user_id", "")).strip()
-    cleaned["device"] = str(cleaned.get("device", "")).strip().lower()
-    cleaned["city"] = str(cleaned.get("city", "")).strip().lower()
-    cleaned["service"] = str(cleaned.get("service", "")).strip().lower()
-    cleaned["event_time"] = str(cleaned.get("event_time", "")).strip()
-
-    # نظام التشغيل
-    os_val = str(cleaned.get("os", "other")).strip().lower()
-    if os_val not in {"ios", "android", "windows", "macos", "linux"}:
-        os_val = "other"
-    cleaned["os"] = os_val
-
-    # المتصفح
-    browser_val = str(cleaned.get("browser", "other")).strip().lower()
-    if browser_val not in {"safari", "chrome", "edge", "firefox"}:
-        browser_val = "other"
-    cleaned["browser"] = browser_val
-
-    # المنطقة
-    cleaned["region"] = convert_city_to_region(cleaned["city"])
-
-    return cleaned
+    event, message = parse_event(data)
+    if event is None:
+        raise ValueError(message)
+    return event.to_dict()
 
 
 # -------------------------------
 # 4) build_features
 # -------------------------------
 
-def build_features(data: Dict[str, Any]) -> Dict[str, Any]:
+def build_features(event: Event) -> Dict[str, Any]:
     """
-    بناء الميزات السلوكية من الحدث الحالي + الأحداث السابقة في قاعدة البيانات.
+    بناء الميزات السلوكية من الحدث الحالي + بصمة المستخدم (الأحداث السابقة).
+    التفاصيل في features_from_profile.
+    """
+    return features_from_profile(event, get_user_profile(event.user_id))
+
+
+def features_from_profile(event: Event, profile: UserProfile) -> Dict[str, Any]:
+    """
+    بناء الميزات السلوكية من الحدث الحالي + بصمة مستخدم جاهزة.
+    مفصولة عن build_features حتى يقدر التدريب يمرر بصمة يبنيها بنفسه
+    (إعادة تشغيل السجل بالترتيب = ميزات صحيحة في لحظتها بدون قاعدة البيانات).
 
     المتوقَّع إرجاعه (مثال):
     {
@@ -140,29 +312,35 @@ def build_features(data: Dict[str, Any]) -> Dict[str, Any]:
         "city_frequency": 0.8,
         "device_frequency": 0.9,
         "service_frequency": 0.5,
+        "transition_rarity": 0.75,
+        "sequence_novelty": 0.5,
         "is_sensitive_service": 1,
         "is_new_user": 0,
     }
     """
-    user_id = data["user_id"]
-    device = data["device"]
-    city = data["city"]
-    service = data["service"]
-    event_time_str = data["event_time"]
+    device = event.device
+    city = event.city
+    service = event.service
 
-    event_dt = datetime.fromisoformat(event_time_str)
+    event_dt = event.event_dt
     event_hour = event_dt.hour
     day_of_week = event_dt.weekday()  # 0=Monday
     is_weekend = 1 if day_of_week in (4, 5) else 0  # مثلاً الجمعة+السبت
     time_window = get_time_window(event_hour)
     is_night = 1 if time_window == "night" else 0
 
-    # --------- 1) معلومات من الأحداث السابقة (آخر حدث) ---------
-    last_event = get_last_event(user_id)
+    # --------- 1) بصمة المستخدم من الذاكرة (بدون استعلامات على الجدول) ---------
+    now_ts_ms = event.timestamp_ms
+
+    # --------- 2) معلومات من الأحداث السابقة (آخر حدث) ---------
+    last_event = profile.last_event
     if last_event:
         last_time_str, last_device, last_city, last_ts_ms = last_event
-        last_dt = datetime.fromisoformat(last_time_str)
-        minutes_since_last = (event_dt - last_dt).total_seconds() / 60.0
+        # بالـ epoch ms (نفس حساب timestamp_ms للحدثين): لا تحليل لوقت الحدث السابق،
+        # ويعمل حتى لو أحدهما بـ timezone والآخر بدون
+        if last_ts_ms is None:  # صفوف قديمة بدون timestamp_ms
+            last_ts_ms = int(datetime.fromisoformat(last_time_str).timestamp() * 1000)
+        minutes_since_last = (now_ts_ms - last_ts_ms) / 60000.0
         is_new_device = 1 if last_device != device else 0
         is_known_city = 1 if last_city == city else 0
     else:
@@ -172,71 +350,12 @@ def build_features(data: Dict[str, Any]) -> Dict[str, Any]:
 
     minutes_since_last = max(minutes_since_last, 0.0)
 
-    stats = get_event_stats(
-        user_id=user_id,
-        device=device,
-        city=city,
-        service=service,
-        now_ts_ms=int(event_dt.timestamp() * 1000),
-    )
-
-    events_last_1h = stats.get("events_last_1h", 0)
-    events_last_24h = stats.get("events_last_24h", 0)
-    avg_daily_events = stats.get("avg_daily_events", 0.0)
-    device_frequency = stats.get("device_frequency", 0.0)
-    city_frequency = stats.get("city_frequency", 0.0)
-    service_frequency = stats.get("service_frequency", 0.0)
-
-    # --------- 2) إحصاءات من قاعدة البيانات ---------
-
-    # تحويل الوقت الحالي إلى milliseconds لاستخدامه في الاستعلام
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    now_ts_ms = int(event_dt.timestamp() * 1000)
-
-    # عدد الأحداث لآخر ساعة
-    cur.execute(
-        """
-        SELECT COUNT(*) FROM events
-        WHERE user_id = ?
-        AND timestamp_ms >= ?
-        """,
-        (user_id, now_ts_ms - 3600 * 1000),
-    )
-    events_last_1h = cur.fetchone()[0]
-
-    # عدد الأحداث لآخر 24 ساعة
-    cur.execute(
-        """
-        SELECT COUNT(*) FROM events
-        WHERE user_id = ?
-        AND timestamp_ms >= ?
-        """,
-        (user_id, now_ts_ms - 24 * 3600 * 1000),
-    )
-    events_last_24h = cur.fetchone()[0]
-
-    # إجمالي الأحداث لهذا المستخدم
-    cur.execute(
-        """
-        SELECT COUNT(*) FROM events
-        WHERE user_id = ?
-        """,
-        (user_id,),
-    )
-    total_events = cur.fetchone()[0]
-
-    # عدد الأيام المختلفة التي نشط فيها المستخدم
-    cur.execute(
-        """
-        SELECT COUNT(DISTINCT date(event_time)) 
-        FROM events
-        WHERE user_id = ?
-        """,
-        (user_id,),
-    )
-    active_days = cur.fetchone()[0] or 0
+    # عدادات النوافذ المنزلقة بوقت الحدث: {"5m": .., "1h": .., "24h": .., "7d": ..}
+    velocity = profile.velocity.counts(now_ts_ms)
+    events_last_1h = velocity["1h"]
+    events_last_24h = velocity["24h"]
+    total_events = profile.total_events
+    active_days = len(profile.active_days)
 
     if active_days > 0:
         avg_daily_events = total_events / active_days
@@ -245,61 +364,27 @@ def build_features(data: Dict[str, Any]) -> Dict[str, Any]:
 
     # تكرار المدينة / الجهاز / الخدمة بالنسبة لسجل المستخدم
     if total_events > 0:
-        cur.execute(
-            """
-            SELECT COUNT(*) FROM events
-            WHERE user_id = ? AND city = ?
-            """,
-            (user_id, city),
-        )
-        city_count = cur.fetchone()[0]
-
-        cur.execute(
-            """
-            SELECT COUNT(*) FROM events
-            WHERE user_id = ? AND device = ?
-            """,
-            (user_id, device),
-        )
-        device_count = cur.fetchone()[0]
-
-        cur.execute(
-            """
-            SELECT COUNT(*) FROM events
-            WHERE user_id = ? AND service = ?
-            """,
-            (user_id, service),
-        )
-        service_count = cur.fetchone()[0]
-
-        city_frequency = city_count / total_events
-        device_frequency = device_count / total_events
-        service_frequency = service_count / total_events
+        city_frequency = profile.city_counts.get(city, 0) / total_events
+        device_frequency = profile.device_counts.get(device, 0) / total_events
+        service_frequency = profile.service_counts.get(service, 0) / total_events
     else:
         city_frequency = 0.0
         device_frequency = 0.0
         service_frequency = 0.0
 
-    conn.close()
-
     # --------- 3) حساسية الخدمة ---------
 
     # --------- 4) حالة المستخدم الجديد (لمنع تسميم البصمة) ---------
     # -------- 3) تعريف الميزات السلوكية النهائية --------
 
-    # الخدمات الحساسة (SMS, كلمة مرور, بيانات هوية, ... إلخ)0
-    sensitive_services = [
-        "change_mobile",
-        "reset_password",
-        "update_profile",
-        "update_id",
-        "issue_document",
-        "renew_id",
-    ]
-    is_sensitive_service = 1 if service in sensitive_services else 0
+    # الخدمات الحساسة (SENSITIVE_SERVICES)
+    is_sensitive_service = 1 if service in SENSITIVE_SERVICES else 0
+
+    # تسلسل الخدمات: ندرة الانتقال من آخر خدمة + جدة التسلسل (آخر خدمتين → الحالية)
+    transition_rarity, sequence_novelty = profile.transitions.features(service)
 
     # عدد الأحداث منخفضة المخاطر السابقة لهذا المستخدم
-    previous_low_risk = get_low_risk_event_count(user_id)
+    previous_low_risk = profile.low_risk_count
     is_new_user = 1 if previous_low_risk == 0 else 0
 
     # قاموس الميزات الذي يذهب للـ model + rules
@@ -326,9 +411,17 @@ def build_features(data: Dict[str, Any]) -> Dict[str, Any]:
         "device_frequency": device_frequency,
         "service_frequency": service_frequency,
 
+        # تسلسل الخدمات (مثل login → change_mobile → reset_password)
+        "transition_rarity": transition_rarity,
+        "sequence_novelty": sequence_novelty,
+
         # حساسية الخدمة + حالة المستخدم
         "is_sensitive_service": is_sensitive_service,
         "is_new_user": is_new_user,
     }
 
+    # نوافذ إضافية (SND_VELOCITY_WINDOWS) للقواعد: events_last_5m, events_last_7d ...
+    for window, count in velocity.items():
+        features.setdefault(f"events_last_{window}", count)
+
     return features
@@ -1,15 +1,28 @@
 # app/routes.py
-from flask import Blueprint, jsonify, request, render_template
-from datetime import datetime 
+from flask import Blueprint, Response, jsonify, request, render_template
 import json
 
-from database import insert_event, get_recent_events
+from database import (
+    MAX_STORED_RISK_SCORE,
+    get_events_since,
+    get_recent_events,
+    insert_event,
+    start_event_feed,
+)
+from feature_store import record_scored_event
 from app.processing import (
-    validate_event,
-    normalize_event,
+    Event,
+    parse_event,
     build_features,
 )
-from app.model import evaluate_event  # IsolationForest أو أي نموذج AI عندك
+from app.model import (  # IsolationForest أو أي نموذج AI عندك
+    evaluate_event,
+    evaluate_events,
+    learn_event,
+    model_info,
+)
+from app.policy import get_policy
+from metrics import record_decision, render_prometheus, stage_timer
 
 main_bp = Blueprint("main", __name__)
 
@@ -23,6 +36,33 @@ def health():
     })
 
 
+# ---------------- metrics (Prometheus) ----------------
+@main_bp.route("/metrics", methods=["GET"])
+def metrics():
+    """
+    زمن كل مرحلة + زمن الطلبات + عدد استعلامات SQL + توزيع القرارات.
+    """
+    return Response(render_prometheus(), mimetype="text/plain; version=0.0.4")
+
+
+# ---------------- النموذج الفعّال ----------------
+@main_bp.route("/model", methods=["GET"])
+def model():
+    """
+    النسخة الفعّالة من النموذج + بيانات تدريبها (من سجل النماذج).
+    """
+    return jsonify(model_info())
+
+
+# ---------------- سياسة القرار ----------------
+@main_bp.route("/policy", methods=["GET"])
+def policy():
+    """
+    نسخة السياسة الفعّالة (policy.json) وأسماء قواعدها.
+    """
+    return jsonify(get_policy().info())
+
+
 # ------------- صفحة الداشبورد ---------------
 @main_bp.route("/dashboard", methods=["GET"])
 def dashboard():
@@ -33,78 +73,228 @@ def dashboard():
 
 
 # ------------- API: آخر الأحداث كـ JSON ---------------
+# أقصى عدد أحداث في رد /events واحد
+MAX_EVENTS_PAGE = 500
+# كل كم ثانية يُرسل تعليق keep-alive في /events/stream إن لم تصل أحداث
+STREAM_KEEPALIVE_SECONDS = 15
+
+
+def _int_arg(value, default: int) -> int:
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def list_events(since_id=None, limit=None) -> dict:
+    """
+    بدون since_id: آخر limit أحداث من الأحدث للأقدم (لقطة الداشبورد).
+    مع since_id: الأحداث بعده من الأقدم للأحدث (cursor: since_id = last_id من الرد السابق).
+    """
+    limit = max(1, min(_int_arg(limit, 50), MAX_EVENTS_PAGE))
+    if since_id is None or since_id == "":
+        rows = get_recent_events(limit=limit)
+        last_id = rows[0]["id"] if rows else 0
+    else:
+        since_id = max(0, _int_arg(since_id, 0))
+        rows = get_events_since(since_id, limit)
+        last_id = rows[-1]["id"] if rows else since_id
+    return {"events": rows, "last_id": last_id}
+
+
+def stream_start_id(since_id, last_event_id) -> int:
+    """
+    من أين يبدأ البث: Last-Event-ID عند إعادة اتصال EventSource، ثم since_id،
+    وإلا من آخر حدث الآن (الأحداث الجديدة فقط).
+    """
+    for value in (last_event_id, since_id):
+        if value not in (None, ""):
+            return max(0, _int_arg(value, 0))
+    return start_event_feed().last_id
+
+
+def stream_backlog(feed, last_id: int):
+    """
+    الأحداث بعد last_id: من الحلقة في الذاكرة، أو من التخزين إن فات المشترك جزء منها.
+    ترجع [(id, json), ...] من الأقدم للأحدث.
+    """
+    items, gap = feed.since(last_id)
+    if gap:
+        # لا نتجاوز آخر id نشرته الحلقة: ما بعده قد تسبقه أحداث لم تظهر بعد
+        settled = feed.last_id
+        items = [
+            (e["id"], feed.encode(e))
+            for e in get_events_since(last_id, MAX_EVENTS_PAGE)
+            if e["id"] <= settled
+        ]
+    return items
+
+
+def sse_frames(items) -> str:
+    return "".join(f"id: {event_id}\nevent: scored\ndata: {payload}\n\n" for event_id, payload in items)
+
+
 @main_bp.route("/events", methods=["GET"])
 def events():
     """
-    إرجاع آخر N أحداث بصيغة JSON لاستخدامها في الداشبورد.
+    آخر N أحداث بصيغة JSON (?limit=، افتراضياً 50)، أو صفحة بعد ?since_id=.
     """
-    rows = get_recent_events(limit=50)
+    return jsonify(list_events(request.args.get("since_id"), request.args.get("limit")))
 
-    clean_events = []
-    for r in rows:
-        # متوافق مع أغلب إصدارات events.db التي استخدمناها سابقاً:
-        # id, user_id, device, city, service, event_time, risk_score, decision
-        clean_events.append({
-            "id": r[0],
-            "user_id": r[1],
-            "device": r[2],
-            "city": r[3],
-            "region": r[4],
-            "os": r[5],
-            "browser": r[6],
-            "service": r[7],
-            "event_time": r[8],
-            "risk_score": r[9],
-            "decision": r[12],
-        })
 
-    return jsonify({"events": clean_events})
+@main_bp.route("/events/stream", methods=["GET"])
+def events_stream():
+    """
+    Server-Sent Events: كل حدث جديد بعد حفظه (event: scored)، بدون polling على جدول events.
+    """
+    feed = start_event_feed()
+    last_id = stream_start_id(request.args.get("since_id"), request.headers.get("Last-Event-ID"))
+
+    def generate():
+        nonlocal last_id
+        yield "retry: 3000\n\n"
+        while True:
+            items = stream_backlog(feed, last_id)
+            if items:
+                last_id = items[-1][0]
+                yield sse_frames(items)
+                continue
+            if not feed.wait(last_id, STREAM_KEEPALIVE_SECONDS):
+                yield ": keep-alive\n\n"
+
+    return Response(
+        generate(),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 
 # ------------- دالة مساعدة لحساب rules_score ---------------
 def compute_rules_score(features: dict) -> float:
     """
-    قواعد تقييم إضافية مبنية على السلوك:
+    قواعد تقييم إضافية مبنية على السلوك (من policy.json → rules_score):
     - مدينة جديدة / جهاز جديد / خدمة حساسة / وقت متأخر / سبايك في النشاط...
     ترجع قيمة بين 0 و 100 تقريباً.
     """
+    return get_policy().rules_score(features)
 
-    rules_score = 0.0
 
-    is_known_city = features.get("is_known_city", 0)
-    is_new_device = features.get("is_new_device", 0)
-    is_sensitive_service = features.get("is_sensitive_service", 0)
-    events_last_1h = features.get("events_last_1h", 0)
-    events_last_24h = features.get("events_last_24h", 0)
-    time_window = features.get("time_window", "unknown")
-    avg_daily_events = features.get("avg_daily_events", 0.0)
+# ------------- دوال مساعدة: من raw_score إلى القرار + الحفظ ---------------
+def ai_risk_from_raw(raw_score: float) -> float:
+    """
+    تحويل raw_score من decision_function إلى ai_risk_score بين 0 و 100.
+    """
+    clamped = max(-0.5, min(0.5, raw_score))
+    anomaly_score = (0.5 - clamped) / 1.0
+    return anomaly_score * 100.0
 
-    # مدينة غير مألوفة للمستخدم
-    if not is_known_city:
-        rules_score += 20.0
 
-    # جهاز جديد
-    if is_new_device:
-        rules_score += 20.0
+def apply_decision_layer(features: dict, ai_risk_score: float, rules_score: float):
+    """
+    دمج الذكاء مع القواعد + طبقة القرار (Allow / Alert / Challenge / Block)
+    حسب policy.json → decision (الأوزان، الحدود، warm start، الخدمات الحساسة، السبايك).
+    ترجع (risk_score, decision).
+    """
+    return get_policy().decide(features, ai_risk_score, rules_score)
 
-    # خدمة حساسة (تغيير جوال / إعادة تعيين كلمة مرور ...)
-    if is_sensitive_service:
-        rules_score += 30.0
 
-    # وقت استخدام غريب (ليل / فجر)
-    if time_window in ["night", "late_night"]:
-        rules_score += 10.0
+def store_scored_event(
+    event: Event,
+    ai_risk_score: float,
+    rules_score: float,
+    risk_score: float,
+    decision: str,
+) -> dict:
+    """
+    تجهيز raw_payload وحفظ الحدث في قاعدة البيانات.
+    ترجع payload_for_store (نفسه الذي يرجع للعميل في received_payload).
+    """
+    # -------- 9) تجهيز payload خام للتخزين (الطلب + الحقول المطبَّعة، بدون datetime) --------
+    payload_for_store = event.to_dict()
+    raw_payload = json.dumps(payload_for_store, ensure_ascii=False)
 
-    # نشاط عالي جداً في آخر ساعة / 24 ساعة (Spike)
-    if events_last_1h >= 5 or events_last_24h >= 20:
-        rules_score += 10.0
+    # -------- 10) حفظ الحدث في قاعدة البيانات --------
+    # الوقت محلَّل مسبقاً في parse_event (timestamp_ms + اليوم للبصمة)
+    insert_event(
+        user_id=event.user_id,
+        device=event.device,
+        city=event.city,
+        service=event.service,
+        event_time=event.event_time,
+        region=event.region or "",
+        os_name=event.os or "",
+        browser=event.browser or "",
+        timestamp_ms=event.timestamp_ms,
+        ai_risk_score=ai_risk_score,
+        rules_score=rules_score,
+        risk_score=risk_score,
+        decision=decision,
+        raw_payload=raw_payload,
+        event_day=event.day,
+    )
+
+    return payload_for_store
+
+
+def _finalize_event(
+    event: Event,
+    features: dict,
+    raw_score: float,
+    timer=None,
+    evaluated: tuple | None = None,
+) -> dict:
+    """
+    الخطوات المشتركة بين /score و /score/batch بعد حساب raw_score:
+    - تحويل raw_score إلى ai_risk_score
+    - rules_score + طبقة القرار من السياسة (أو evaluated الجاهز من تقييم الدفعة)
+    - حفظ الحدث في قاعدة البيانات
+    ترجع قاموس الرد للعميل.
+    """
+    if timer is None:
+        timer = stage_timer()
+
+    ai_risk_score = ai_risk_from_raw(raw_score)
 
-    # معدل استخدام يومي غير طبيعي
-    if avg_daily_events > 50:
-        rules_score += 10.0
+    # -------- 5 → 8) rules_score + الدمج + طبقة القرار (policy.json) --------
+    if evaluated is None:
+        evaluated = get_policy().evaluate(features, ai_risk_score)
+    rules_score, risk_score, decision, fired_rules = evaluated
+    timer.lap("decision")
+    record_decision(decision)
+
+    # -------- 9 + 10) الحفظ --------
+    payload_for_store = store_scored_event(
+        event, ai_risk_score, rules_score, risk_score, decision
+    )
+    timer.lap("insert")
+
+    # التعلم أثناء التشغيل (SND_ANOMALY_ENGINE=online) من الأحداث منخفضة المخاطر
+    learn_event(features, risk_score)
+
+    # مخزن الميزات العمودي (SND_FEATURE_STORE=1) للتدريب والتحليل بدون إعادة الحساب
+    record_scored_event(
+        features,
+        event.user_id,
+        event.timestamp_ms,
+        risk_score,
+        ai_risk_score,
+        rules_score,
+        decision,
+        stored=risk_score <= MAX_STORED_RISK_SCORE,
+    )
+
+    # -------- 11) تجهيز الرد للعميل --------
+    return {
+        "risk_score": risk_score,
+        "ai_risk_score": ai_risk_score,
 
-    # حصر القيم بين 0 و 100
-    return max(0.0, min(100.0, rules_score))
+        "rules_score": rules_score,
+        "decision": decision,
+        "fired_rules": fired_rules,
+        "raw_score": raw_score,
+        "features_used": features,
+        "received_payload": payload_for_store,
+    }
 
 
 # ------------- API: دالة التقييم الرئيسية /score ---------------
@@ -122,140 +312,101 @@ def score():
     - تحفظ الحدث منخفض المخاطر في قاعدة البيانات لبناء البصمة السلوكية
     """
 
+    timer = stage_timer()
+
     # -------- 1) استلام البيانات والتحقق --------
     data = request.get_json() or {}
 
-    valid, message = validate_event(data)
-    if not valid:
+    # -------- 2) التطبيع / التنظيف (في نفس الخطوة) --------
+    # parse_event يرجع Event: الحقول المطبَّعة + الوقت محلَّلاً مرة واحدة
+    # (event_dt + timestamp_ms) لكل المراحل التالية
+    event, message = parse_event(data)
+    timer.lap("validate")
+    if event is None:
         return jsonify({"error": message}), 400
 
-    # -------- 2) التطبيع / التنظيف --------
-    # normalize_event قد يضيف حقول داخلية مثل:
-    #  _event_dt (datetime)
-    #  _timestamp_ms (int)
-    cleaned = normalize_event(data)
-
     # -------- 3) بناء الميزات السلوكية --------
-    features = build_features(cleaned)
+    features = build_features(event)
+    timer.lap("features")
 
     # -------- 4) استدعاء نموذج الذكاء الاصطناعي --------
     # نفترض أن evaluate_event يرجع raw_score في المدى [-0.5, +0.5]
     raw_score = evaluate_event(features)
+    timer.lap("model")
 
-    # نحول raw_score إلى ai_risk_score بين 0 و 100
-    clamped = max(-0.5, min(0.5, raw_score))
-    anomaly_score = (0.5 - clamped) / 1.0
-    ai_risk_score = anomaly_score * 100.0
-
-    # -------- 5) حساب rules_score --------
-    rules_score = compute_rules_score(features)
-
-    # -------- 6) دمج الذكاء مع القواعد --------
-    # وزن الذكاء 55% والقواعد 45% كما اختبرنا سابقاً
-    risk_score = (0.55 * ai_risk_score) + (0.45 * rules_score)
+    # -------- 5 → 11) القواعد + القرار + الحفظ --------
+    response = _finalize_event(event, features, raw_score, timer)
+    return jsonify(response), 200
 
-    # -------- 7) طبقة قرار خاصة بالمستخدم الجديد (Warm Start) --------
-    # -------- 7 + 8) Decision Layer (baseline + warm start + challenge) --------
 
-    # 1) القرار الأساسي حسب risk_score
-    if risk_score <= 30:
-        decision = "Allow"
-    elif risk_score <= 60:
-        decision = "Alert"
-    elif risk_score <= 80:
-        decision = "Challenge"
-    else:
-        decision = "Block"
-
-    # 2) منطق المستخدم الجديد (Warm Start) + منع تسميم البصمة
-    is_new_user = features.get("is_new_user", 0)
-    city_freq = features.get("city_frequency", 0.0)
-    device_freq = features.get("device_frequency", 0.0)
-    service_freq = features.get("service_frequency", 0.0)
-
-    if is_new_user:
-        # مستخدم جديد وكل شيء طبيعي (مدينة + جهاز + خدمة متكررة) → سماح محافظ
-        if (
-            city_freq == 1.0
-            and device_freq == 1.0
-            and service_freq == 1.0
-            and risk_score <= 60
-        ):
-            decision = "Allow"
-            # نجبر السكور أن يكون منخفض عشان نبني baseline نظيفة
-            risk_score = min(risk_score, 25.0)
-        else:
-            # مستخدم جديد لكن السلوك مو مثالي → نرفعه إلى Alert محافظ
-            if risk_score < 60:
-                decision = "Alert"
-                risk_score = min(risk_score, 60.0)
-
-
-    # 3) خدمات حساسة: بين 61–80 نفضّل Challenge بدل Alert
-    is_sensitive_service = features.get("is_sensitive_service", 0)
-    if is_sensitive_service and 61 <= risk_score <= 80:
-        decision = "Challenge"
-
-    # 4) تشديد إضافي للخدمات الحساسة إذا السكور >= 40
-    if is_sensitive_service and risk_score >= 40:
-        decision = "Challenge"
-
-    # 5) Spike قوي جداً في الساعة / اليوم
-    events_last_1h = features.get("events_last_1h", 0)
-    events_last_24h = features.get("events_last_24h", 0)
-
-    # أرقام أكثر واقعية لاستخدام منصة حكومية واحدة
-    # - أكثر من 20 حدث في ساعة واحدة
-    # - أو أكثر من 80 حدث في يوم واحد
-    if events_last_1h >= 5 or events_last_24h >= 24:
-        # نرفع السكور لحد أدنى 60 (منطقة Challenge)
-        if risk_score < 60:
-            risk_score = 60.0
-        decision = "Challenge"
-
-
-    # -------- 9) تجهيز payload خام للتخزين (حذف الحقول المؤقتة) --------
-    payload_for_store = dict(cleaned)
-
-    # نحذف الحقول الداخلية التي لا نريدها في raw_payload
-    payload_for_store.pop("_event_dt", None)
-    payload_for_store.pop("_timestamp_ms", None)
-
-    # تأكد أن event_time عبارة عن نص ISO قبل التخزين
-    if isinstance(payload_for_store.get("event_time"), datetime):
-        payload_for_store["event_time"] = payload_for_store["event_time"].isoformat()
+# ------------- API: تقييم مجموعة أحداث /score/batch ---------------
+MAX_BATCH_SIZE = 1000
 
-    raw_payload = json.dumps(payload_for_store, ensure_ascii=False)
 
-    # -------- 10) حفظ الحدث في قاعدة البيانات --------
-    insert_event(
-        user_id=payload_for_store["user_id"],
-        device=payload_for_store["device"],
-        city=payload_for_store["city"],
-        service=payload_for_store["service"],
-        event_time=payload_for_store["event_time"],
-        region=payload_for_store.get("region", ""),
-        os_name=payload_for_store.get("os", ""),
-        browser=payload_for_store.get("browser", ""),
-        timestamp_ms=int(
-            datetime.fromisoformat(payload_for_store["event_time"]).timestamp() * 1000
-        ),
-        ai_risk_score=ai_risk_score,
-        rules_score=rules_score,
-        risk_score=risk_score,
-        decision=decision,
-        raw_payload=raw_payload,
-    )
+@main_bp.route("/score/batch", methods=["POST"])
+def score_batch():
+    """
+    تقييم مجموعة أحداث في طلب واحد:
+        {"events": [ {...}, {...}, ... ]}  أو قائمة مباشرة [ {...}, ... ]
 
-    # -------- 11) تجهيز الرد للعميل --------
-    response = {
-        "risk_score": risk_score,
-        "ai_risk_score": ai_risk_score,
+    أحداث نفس المستخدم لازم تُعالج بالترتيب (ميزات السرعة تعتمد على الحدث السابق
+    بعد حفظه)، لذلك نقسم الدفعة إلى "موجات": الموجة k فيها الحدث رقم k لكل مستخدم.
+    كل موجة: بناء الميزات ← استدعاء واحد للنموذج على مصفوفة كاملة ← القرار والحفظ لكل صف.
 
-        "rules_score": rules_score,
-        "decision": decision,
-        "raw_score": raw_score,
-        "features_used": features,
-        "received_payload": payload_for_store,
-    }
-    return jsonify(response), 200
+    الرد بنفس ترتيب الإدخال:
+        {"results": [ {...رد /score...} أو {"error": "..."} ]}
+    """
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get("events")
+
+    if not isinstance(data, list):
+        return jsonify({"error": "Expected a JSON list of events or {\"events\": [...]}"}), 400
+    if len(data) > MAX_BATCH_SIZE:
+        return jsonify({"error": f"Batch too large, max {MAX_BATCH_SIZE} events"}), 400
+
+    results = [None] * len(data)
+
+    # -------- 1 + 2) التحقق والتطبيع + التقسيم إلى موجات حسب المستخدم --------
+    waves = []
+    user_positions = {}
+    for idx, raw_event in enumerate(data):
+        event, message = parse_event(raw_event)
+        if event is None:
+            results[idx] = {"error": message}
+            continue
+
+        position = user_positions.get(event.user_id, 0)
+        user_positions[event.user_id] = position + 1
+
+        if position == len(waves):
+            waves.append([])
+        waves[position].append((idx, event))
+
+    # -------- 3 → 11) لكل موجة: ميزات ← نموذج (مرة واحدة) ← قرار وحفظ --------
+    policy = get_policy()  # نفس السياسة لكل الدفعة حتى لو تحدّث الملف أثناءها
+    for wave in waves:
+        timer = stage_timer()
+        features_list = [build_features(event) for _, event in wave]
+        timer.lap("batch_features")
+        raw_scores = evaluate_events(features_list)
+        timer.lap("batch_model")
+
+        # السياسة على الموجة كاملة (أعمدة NumPy) بدل حدث حدث
+        rules_scores, risk_scores, decisions, fired_rules = policy.evaluate_batch(
+            features_list, [ai_risk_from_raw(r) for r in raw_scores]
+        )
+        timer.lap("batch_decision")
+
+        for i, ((idx, event), features, raw_score) in enumerate(
+            zip(wave, features_list, raw_scores)
+        ):
+            evaluated = (
+                float(rules_scores[i]),
+                float(risk_scores[i]),
+                str(decisions[i]),
+                fired_rules[i],
+            )
+            results[idx] = _finalize_event(event, features, raw_score, timer, evaluated)
+
+    return jsonify({"results": results}), 200
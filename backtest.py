@@ -0,0 +1,415 @@
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from app.model import _assign_shards, load_model_spec
+from app.policy import POLICY_PATH, load_policy
+from app.processing import Event, features_from_profile
+from database import MAX_STORED_RISK_SCORE, sqlite_db_path
+from feature_store import user_key
+from profile_cache import UserProfile
+
+# ---------------------- إعادة التشغيل على السجل (Backtesting) ---------------------- #
+#
+# قبل تغيير السياسة أو النموذج: نعيد تشغيل الأحداث التاريخية بالترتيب الزمني،
+# نبني الميزات في لحظتها (point-in-time) من بصمة تتراكم بالتدريج، ونقيّم كل حدث
+# بعدة مرشحين (نموذج + سياسة) ثم نقارن القرارات.
+#
+#   python -m backtest --db events.db \
+#       --candidate prod=active:policy.json --candidate new=v0004:policy_new.json --workers 4
+#   python -m backtest --file export.jsonl --candidate a=legacy --candidate b=v0004
+#
+# - المستخدمون يتوزعون على processes (ميزات كل مستخدم تعتمد على سجله فقط،
+#   فالتقسيم لا يغيّر النتيجة)، وكل process يقرأ أحداث مستخدميه فقط على دفعات
+# - الذاكرة: بصمة لكل مستخدم في الـ shard + دفعة واحدة، مهما كان عدد الأحداث
+# - البصمة تتحدث بالنتيجة المسجلة (risk_score في السجل) وليس بنتيجة كل مرشح،
+#   فكل المرشحين يُقيَّمون على نفس الميزات بالضبط
+# - أول مرشح هو الأساس: تُحسب التغيّرات (flips) لكل مرشح مقارنة به،
+#   ومقارنة بالقرار المسجل لو موجود
+
+# عدد الأحداث في كل استدعاء للنموذج والسياسة
+BACKTEST_CHUNK_SIZE = int(os.environ.get("SND_BACKTEST_CHUNK_SIZE", "4096"))
+
+_EVENTS_QUERY = """
+    SELECT e.user_id, e.device, e.city, e.service, e.event_time,
+           e.timestamp_ms, e.risk_score, e.decision
+    FROM events e
+    {join}
+    ORDER BY datetime(e.event_time) ASC, e.id ASC
+"""
+
+
+class Candidate:
+    """
+    مرشح واحد: نموذج + سياسة، يُحمّل داخل كل worker.
+    """
+
+    def __init__(self, name: str, model_spec: str, policy_path: str):
+        self.name = name
+        self.model_spec = model_spec
+        self.policy_path = policy_path
+        self.model = None
+        self.policy = None
+
+    @classmethod
+    def parse(cls, text: str) -> "Candidate":
+        """
+        "name=model[:policy.json]" — model: active / legacy / v0003 / مسار ملف.
+        """
+        name, _, rest = text.partition("=")
+        if not rest:
+            name, rest = text, text
+        model_spec, _, policy_path = rest.partition(":")
+        return cls(name, model_spec or "active", policy_path or POLICY_PATH)
+
+    def load(self) -> "Candidate":
+        self.model = load_model_spec(self.model_spec)
+        self.policy = load_policy(self.policy_path)
+        return self
+
+    def decide(self, features_list: List[Dict]) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        (risk_scores, decisions) لدفعة: استدعاء واحد للنموذج + السياسة على أعمدة.
+        """
+        keys = self.model.feature_keys
+        X = np.array([[float(f.get(k, 0.0)) for k in keys] for f in features_list], dtype=float)
+        raw = self.model.model.decision_function(X)
+        # نفس ai_risk_from_raw في app/routes.py
+        ai_risk = (0.5 - np.clip(raw, -0.5, 0.5)) * 100.0
+        _, risk, decisions, _ = self.policy.evaluate_batch(features_list, ai_risk)
+        return np.asarray(risk, dtype=float), np.asarray(decisions)
+
+    def describe(self) -> Dict:
+        return {
+            "model": self.model_spec,
+            "model_version": self.model.version if self.model else None,
+            "policy": self.policy_path,
+            "policy_version": self.policy.version if self.policy else None,
+        }
+
+
+# ---------- مصادر الأحداث ---------- #
+
+def _db_events(db_path: str, user_ids: Sequence[str], chunk_size: int) -> Iterator[tuple]:
+    conn = sqlite3.connect(db_path)
+    try:
+        conn.execute("CREATE TEMP TABLE shard_users (user_id TEXT PRIMARY KEY)")
+        conn.executemany("INSERT INTO shard_users (user_id) VALUES (?)", ((u,) for u in user_ids))
+        cur = conn.cursor()
+        cur.execute(_EVENTS_QUERY.format(join="JOIN shard_users s ON s.user_id = e.user_id"))
+        while True:
+            rows = cur.fetchmany(chunk_size)
+            if not rows:
+                return
+            yield from rows
+    finally:
+        conn.close()
+
+
+def _file_records(path: str) -> Iterator[Dict]:
+    with open(path, encoding="utf-8", newline="") as f:
+        if path.endswith(".csv"):
+            yield from csv.DictReader(f)
+        else:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+def _file_events(path: str, shard: int, shards: int) -> Iterator[tuple]:
+    """
+    ملف مصدّر (JSONL أو CSV بأسماء أعمدة events)، مرتب زمنياً (على الأقل لكل مستخدم).
+    كل worker يمر على الملف ويأخذ مستخدمي الـ shard فقط.
+    """
+    for record in _file_records(path):
+        user_id = str(record.get("user_id", "")).strip()
+        if user_key(user_id) % shards != shard:
+            continue
+        timestamp_ms = record.get("timestamp_ms")
+        risk_score = record.get("risk_score")
+        yield (
+            user_id,
+            # نفس تطبيع normalize_event للحقول التي تدخل في الميزات
+            str(record.get("device", "")).strip().lower(),
+            str(record.get("city", "")).strip().lower(),
+            str(record.get("service", "")).strip().lower(),
+            str(record.get("event_time", "")).strip(),
+            int(timestamp_ms) if timestamp_ms not in (None, "") else None,
+            float(risk_score) if risk_score not in (None, "") else None,
+            record.get("decision") or None,
+        )
+
+
+# ---------- الـ worker ---------- #
+
+_candidates: List[Candidate] = []
+
+
+def _init_worker(candidates: List[Candidate]) -> None:
+    global _candidates
+    _candidates = [c.load() for c in candidates]
+
+
+def _new_partial() -> Dict:
+    return {
+        "events": 0,
+        "scored": 0,
+        "skipped": 0,
+        "decisions": {c.name: Counter() for c in _candidates},
+        "risk_sum": {c.name: 0.0 for c in _candidates},
+        "flips": {c.name: Counter() for c in _candidates[1:]},
+        "recorded": {c.name: Counter() for c in _candidates},
+        "seconds": Counter(),
+    }
+
+
+def _score_chunk(partial: Dict, features_list: List[Dict], recorded: List[Optional[str]]) -> None:
+    base = None
+    for cand in _candidates:
+        started = time.perf_counter()
+        risk, decisions = cand.decide(features_list)
+        partial["seconds"][cand.name] += time.perf_counter() - started
+
+        partial["decisions"][cand.name].update(decisions.tolist())
+        partial["risk_sum"][cand.name] += float(risk.sum())
+        if base is None:
+            base = decisions
+        else:
+            changed = np.flatnonzero(decisions != base)
+            partial["flips"][cand.name].update(
+                (str(base[i]), str(decisions[i])) for i in changed
+            )
+        partial["recorded"][cand.name].update(
+            (rec, str(dec)) for rec, dec in zip(recorded, decisions.tolist()) if rec is not None
+        )
+    partial["scored"] += len(features_list)
+
+
+def _replay_shard(task) -> Dict:
+    """
+    يعمل داخل process: يمر على أحداث مستخدمي الـ shard بالترتيب الزمني،
+    يبني الميزات من "ما قبل الحدث فقط" ثم يضيف الحدث للبصمة.
+    """
+    source, location, shard_arg, score_from_ms, chunk_size = task
+    if source == "db":
+        events = _db_events(location, shard_arg, chunk_size)
+    else:
+        events = _file_events(location, *shard_arg)
+
+    partial = _new_partial()
+    profiles: Dict[str, UserProfile] = {}
+    features_list: List[Dict] = []
+    recorded: List[Optional[str]] = []
+    started = time.perf_counter()
+
+    for user_id, device, city, service, event_time, timestamp_ms, risk_score, decision in events:
+        partial["events"] += 1
+        profile = profiles.get(user_id)
+        if profile is None:
+            profile = profiles[user_id] = UserProfile(user_id)
+
+        try:
+            event = Event.from_row(user_id, device, city, service, event_time, timestamp_ms)
+            features = features_from_profile(event, profile)
+        except (TypeError, ValueError):
+            partial["skipped"] += 1
+            continue
+
+        if score_from_ms is None or event.timestamp_ms >= score_from_ms:
+            features_list.append(features)
+            recorded.append(decision)
+            if len(features_list) >= chunk_size:
+                _score_chunk(partial, features_list, recorded)
+                features_list, recorded = [], []
+
+        # البصمة تتحدث مثل الإنتاج: الأحداث فوق MAX_STORED_RISK_SCORE لا تُحفظ
+        # (ملف بدون risk_score: كأن الحدث منخفض المخاطر)
+        risk = 0.0 if risk_score is None else risk_score
+        if risk <= MAX_STORED_RISK_SCORE:
+            profile.apply_event(event.device, event.city, event.service, event_time,
+                                event.timestamp_ms, risk, event.day)
+
+    if features_list:
+        _score_chunk(partial, features_list, recorded)
+    partial["seconds"]["total"] += time.perf_counter() - started
+    partial["users"] = len(profiles)
+    return partial
+
+
+# ---------- التشغيل + التقرير ---------- #
+
+def _merge(parts: List[Dict]) -> Dict:
+    total = parts[0]
+    for part in parts[1:]:
+        for key in ("events", "scored", "skipped", "users"):
+            total[key] += part[key]
+        for key in ("decisions", "flips", "recorded"):
+            for name, counts in part[key].items():
+                total[key][name].update(counts)
+        for name, value in part["risk_sum"].items():
+            total["risk_sum"][name] += value
+        total["seconds"].update(part["seconds"])
+    return total
+
+
+def _transitions(counts: Counter) -> Dict[str, int]:
+    return {f"{a}->{b}": n for (a, b), n in sorted(counts.items(), key=lambda kv: -kv[1])}
+
+
+def run_backtest(
+    candidates: List[Candidate],
+    db_path: Optional[str] = None,
+    file_path: Optional[str] = None,
+    workers: int = 1,
+    score_from: Optional[str] = None,
+    chunk_size: int = BACKTEST_CHUNK_SIZE,
+) -> Dict:
+    """
+    تشغيل المرشحين على السجل (db_path أو file_path) وإرجاع تقرير المقارنة.
+    """
+    if not candidates:
+        raise ValueError("At least one candidate is required")
+    if len({c.name for c in candidates}) != len(candidates):
+        raise ValueError("Candidate names must be unique")
+    if workers <= 0:
+        workers = os.cpu_count() or 1
+    score_from_ms = (
+        int(datetime.fromisoformat(score_from).timestamp() * 1000) if score_from else None
+    )
+
+    started = time.perf_counter()
+    if file_path is not None:
+        tasks = [("file", file_path, (i, workers), score_from_ms, chunk_size) for i in range(workers)]
+    else:
+        conn = sqlite3.connect(db_path)
+        shards = _assign_shards(conn, workers)
+        conn.close()
+        tasks = [("db", db_path, users, score_from_ms, chunk_size) for users, _ in shards]
+
+    if len(tasks) > 1:
+        with multiprocessing.Pool(
+            processes=len(tasks), initializer=_init_worker, initargs=(candidates,)
+        ) as pool:
+            parts = pool.map(_replay_shard, tasks)
+    # في الأب أيضاً: worker واحد بدون Pool + نسخ النماذج والسياسات في التقرير
+    _init_worker(candidates)
+    if len(tasks) == 1:
+        parts = [_replay_shard(tasks[0])]
+    elif not tasks:
+        parts = [dict(_new_partial(), users=0)]
+    elapsed = time.perf_counter() - started
+
+    total = _merge(parts)
+    scored = total["scored"]
+    base = candidates[0].name
+    report = {
+        "source": file_path or os.path.abspath(db_path),
+        "events": total["events"],
+        "scored": scored,
+        "skipped": total["skipped"],
+        "users": total["users"],
+        "workers": len(tasks),
+        "seconds": round(elapsed, 3),
+        "events_per_second": round(total["events"] / elapsed, 1) if elapsed > 0 else None,
+        "baseline": base,
+        "candidates": {},
+    }
+    for cand in _candidates:
+        counts = total["decisions"][cand.name]
+        entry = cand.describe()
+        entry.update({
+            "decisions": dict(sorted(counts.items())),
+            "share": {d: round(n / scored, 4) for d, n in sorted(counts.items())} if scored else {},
+            "mean_risk": round(total["risk_sum"][cand.name] / scored, 3) if scored else None,
+            "scoring_seconds": round(total["seconds"][cand.name], 3),
+        })
+        if cand.name != base:
+            base_counts = total["decisions"][base]
+            flips = total["flips"][cand.name]
+            entry["vs_baseline"] = {
+                "flips": sum(flips.values()),
+                "flip_rate": round(sum(flips.values()) / scored, 4) if scored else 0.0,
+                "decision_diff": {
+                    d: counts.get(d, 0) - base_counts.get(d, 0)
+                    for d in sorted(set(counts) | set(base_counts))
+                },
+                "transitions": _transitions(flips),
+            }
+        recorded = total["recorded"][cand.name]
+        if recorded:
+            changed = Counter({k: n for k, n in recorded.items() if k[0] != k[1]})
+            entry["vs_recorded"] = {
+                "compared": sum(recorded.values()),
+                "flips": sum(changed.values()),
+                "transitions": _transitions(changed),
+            }
+        report["candidates"][cand.name] = entry
+    return report
+
+
+def _print_report(report: Dict) -> None:
+    print(
+        f"[backtest] {report['events']} حدث ({report['scored']} مُقيَّم، {report['skipped']} متخطى، "
+        f"{report['users']} مستخدم) خلال {report['seconds']} ثانية = "
+        f"{report['events_per_second']} حدث/ثانية على {report['workers']} worker"
+    )
+    for name, entry in report["candidates"].items():
+        marker = "*" if name == report["baseline"] else " "
+        shares = "  ".join(f"{d}={s:.2%}" for d, s in entry["share"].items())
+        print(f"{marker} {name}  [{entry['model_version']} / policy {entry['policy_version']}]  "
+              f"mean_risk={entry['mean_risk']}  {shares}")
+        if "vs_baseline" in entry:
+            diff = entry["vs_baseline"]
+            top = ", ".join(f"{k}={n}" for k, n in list(diff["transitions"].items())[:6])
+            print(f"      flips vs {report['baseline']}: {diff['flips']} ({diff['flip_rate']:.2%})  {top}")
+        if "vs_recorded" in entry:
+            rec = entry["vs_recorded"]
+            print(f"      flips vs recorded: {rec['flips']} / {rec['compared']}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SND policy/model backtesting")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--db", default=None, help="قاعدة SQLite (الافتراضي قاعدة الخدمة من SND_DATABASE_URL)")
+    source.add_argument("--file", default=None, help="ملف مصدّر JSONL أو CSV مرتب زمنياً")
+    parser.add_argument(
+        "--candidate", action="append", default=[], metavar="NAME=MODEL[:POLICY]",
+        help="مرشح (يمكن تكراره، الأول هو الأساس). MODEL: active / legacy / v0003 / مسار",
+    )
+    parser.add_argument("--workers", type=int, default=1, help="عدد الـ processes (0 = كل الأنوية)")
+    parser.add_argument("--score-from", default=None,
+                        help="تقييم الأحداث من هذا الوقت فقط (ISO)، وما قبله يبني البصمة فقط")
+    parser.add_argument("--chunk-size", type=int, default=BACKTEST_CHUNK_SIZE)
+    parser.add_argument("--output", default=None, help="حفظ التقرير كـ JSON")
+    args = parser.parse_args()
+
+    db_path = args.db
+    if db_path is None and args.file is None:
+        try:
+            db_path = sqlite_db_path()
+        except ValueError as e:
+            print(f"[backtest] {e} (استخدم --db أو --file)")
+            sys.exit(2)
+
+    report = run_backtest(
+        [Candidate.parse(c) for c in (args.candidate or ["active"])],
+        db_path=db_path,
+        file_path=args.file,
+        workers=args.workers,
+        score_from=args.score_from,
+        chunk_size=args.chunk_size,
+    )
+    _print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,405 @@
+"""
+قياس أداء مسار /score (throughput + latency + تفصيل لكل مرحلة).
+
+أمثلة:
+    # داخل نفس العملية مع تفصيل المراحل (validate / normalize / features / model / rules / decision / insert)
+    python benchmark.py --mode pipeline --users 200 --history 100 --events 5000
+
+    # عبر Flask test client (end-to-end داخل العملية)
+    python benchmark.py --mode client --events 2000
+
+    # عبر HTTP حقيقي ضد سيرفر محلي شغّال (python run.py)
+    python benchmark.py --mode http --url http://127.0.0.1:5000 --concurrency 8
+
+    # حفظ النتيجة ومقارنتها بتشغيل سابق
+    python benchmark.py --output new.json --compare old.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import urllib.request
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Dict, List
+
+import numpy as np
+
+from test_events import CITIES, DEVICES, SERVICES
+
+SENSITIVE_SERVICES = ["change_mobile", "reset_password", "renew_id"]
+NORMAL_SERVICES = [s for s in SERVICES if s not in SENSITIVE_SERVICES]
+
+STAGES = ["validate", "normalize", "features", "model", "rules", "decision", "insert"]
+
+
+# ---------------------- توليد البيانات ---------------------- #
+
+def generate_workload(
+    users: int,
+    history: int,
+    events: int,
+    sensitive_ratio: float,
+    anomaly_ratio: float,
+    history_days: int,
+    seed: int,
+):
+    """
+    توليد مستخدمين صناعيين لكل واحد بصمة (جهاز + مدينة + خدمات مفضلة)،
+    ثم سجل تاريخي بعمق history لكل مستخدم، ثم أحداث القياس بالترتيب الزمني.
+    """
+    rng = random.Random(seed)
+    start = datetime(2025, 1, 1, 8, 0, 0)
+
+    profiles = []
+    for i in range(users):
+        profiles.append({
+            "user_id": f"bench-user-{i}",
+            "device": rng.choice(DEVICES),
+            "city": rng.choice(CITIES),
+            "services": rng.sample(NORMAL_SERVICES, k=min(3, len(NORMAL_SERVICES))),
+        })
+
+    def make_event(p, when, anomalous):
+        if rng.random() < sensitive_ratio:
+            service = rng.choice(SENSITIVE_SERVICES)
+        else:
+            service = rng.choice(p["services"])
+        device, city = p["device"], p["city"]
+        if anomalous:
+            if rng.random() < 0.5:
+                device = rng.choice(DEVICES)
+            else:
+                city = rng.choice(CITIES)
+        return {
+            "user_id": p["user_id"],
+            "device": device,
+            "city": city,
+            "service": service,
+            "event_time": when.isoformat(),
+        }
+
+    history_events = []
+    span_s = history_days * 24 * 3600
+    for p in profiles:
+        for k in range(history):
+            when = start + timedelta(seconds=int(span_s * k / max(history, 1)))
+            history_events.append(make_event(p, when, anomalous=False))
+
+    measured = []
+    t0 = start + timedelta(days=history_days)
+    for k in range(events):
+        p = profiles[rng.randrange(users)]
+        when = t0 + timedelta(seconds=k * 7)
+        measured.append(make_event(p, when, anomalous=rng.random() < anomaly_ratio))
+
+    return history_events, measured
+
+
+# ---------------------- الإحصائيات ---------------------- #
+
+def summarize(samples_ms: List[float]) -> Dict[str, float]:
+    if not samples_ms:
+        return {"count": 0}
+    arr = np.asarray(samples_ms, dtype=float)
+    p50, p95, p99 = np.percentile(arr, [50, 95, 99])
+    return {
+        "count": int(arr.size),
+        "mean": float(arr.mean()),
+        "p50": float(p50),
+        "p95": float(p95),
+        "p99": float(p99),
+        "max": float(arr.max()),
+    }
+
+
+# ---------------------- أوضاع التشغيل ---------------------- #
+
+def _use_local_db(db_path: str | None) -> str:
+    import database
+
+    database.DB_PATH = db_path or os.path.join(tempfile.mkdtemp(prefix="snd-bench-"), "events.db")
+    return database.DB_PATH
+
+
+def _seed_local(history_events) -> None:
+    from app.processing import parse_event
+    from database import insert_event
+
+    for ev in history_events:
+        event, _ = parse_event(ev)
+        insert_event(
+            user_id=event.user_id,
+            device=event.device,
+            city=event.city,
+            region=event.region,
+            os_name=event.os,
+            browser=event.browser,
+            service=event.service,
+            event_time=event.event_time,
+            timestamp_ms=event.timestamp_ms,
+            risk_score=10.0,
+            ai_risk_score=10.0,
+            rules_score=0.0,
+            decision="Allow",
+            raw_payload=json.dumps(event.to_dict(), ensure_ascii=False),
+            event_day=event.day,
+        )
+
+
+def run_pipeline(history_events, measured, args) -> dict:
+    """
+    استدعاء مراحل score() مباشرة مع توقيت كل مرحلة على حدة.
+    """
+    _use_local_db(args.db)
+
+    from app import create_app
+    from app.model import evaluate_event
+    from app.processing import build_features, parse_event
+    from app.routes import (
+        ai_risk_from_raw,
+        apply_decision_layer,
+        compute_rules_score,
+        store_scored_event,
+    )
+
+    create_app()
+    _seed_local(history_events)
+    evaluate_event({})  # تحميل النموذج قبل القياس
+
+    stages = {name: [] for name in STAGES}
+    totals = []
+    decisions = Counter()
+    clock = time.perf_counter
+
+    started = clock()
+    for ev in measured:
+        t0 = clock()
+        event, _ = parse_event(ev)
+        t1 = clock()
+        # parse_event = validate + normalize في خطوة واحدة (normalize = 0)
+        t2 = t1
+        features = build_features(event)
+        t3 = clock()
+        raw_score = evaluate_event(features)
+        t4 = clock()
+        rules_score = compute_rules_score(features)
+        t5 = clock()
+        ai_risk_score = ai_risk_from_raw(raw_score)
+        risk_score, decision = apply_decision_layer(features, ai_risk_score, rules_score)
+        t6 = clock()
+        store_scored_event(event, ai_risk_score, rules_score, risk_score, decision)
+        t7 = clock()
+
+        for name, a, b in zip(STAGES, (t0, t1, t2, t3, t4, t5, t6), (t1, t2, t3, t4, t5, t6, t7)):
+            stages[name].append((b - a) * 1000.0)
+        totals.append((t7 - t0) * 1000.0)
+        decisions[decision] += 1
+    elapsed = clock() - started
+
+    return {
+        "elapsed_s": elapsed,
+        "latency_ms": summarize(totals),
+        "stages_ms": {name: summarize(v) for name, v in stages.items()},
+        "decisions": dict(decisions),
+    }
+
+
+def run_client(history_events, measured, args) -> dict:
+    """
+    end-to-end عبر Flask test client (بدون شبكة).
+    """
+    _use_local_db(args.db)
+
+    from app import create_app
+    from app.model import evaluate_event
+
+    client = create_app().test_client()
+    _seed_local(history_events)
+    evaluate_event({})
+
+    totals = []
+    decisions = Counter()
+    errors = 0
+    clock = time.perf_counter
+
+    started = clock()
+    for ev in measured:
+        t0 = clock()
+        r = client.post("/score", json=ev)
+        totals.append((clock() - t0) * 1000.0)
+        if r.status_code != 200:
+            errors += 1
+            continue
+        decisions[r.get_json()["decision"]] += 1
+    elapsed = clock() - started
+
+    return {
+        "elapsed_s": elapsed,
+        "latency_ms": summarize(totals),
+        "decisions": dict(decisions),
+        "errors": errors,
+    }
+
+
+def _post_json(url: str, payload, timeout: float = 30.0):
+    req = urllib.request.Request(
+        url,
+        data=json.dumps(payload).encode("utf-8"),
+        headers={"Content-Type": "application/json"},
+        method="POST",
+    )
+    with urllib.request.urlopen(req, timeout=timeout) as resp:
+        return json.loads(resp.read().decode("utf-8"))
+
+
+def run_http(history_events, measured, args) -> dict:
+    """
+    عبر HTTP حقيقي ضد سيرفر شغّال.
+    السجل التاريخي يُرسل عبر /score/batch، وأحداث القياس عبر /score.
+    كل مستخدم يُخدم من worker واحد فقط حتى يبقى ترتيب أحداثه صحيح.
+    """
+    base = args.url.rstrip("/")
+
+    for i in range(0, len(history_events), 500):
+        _post_json(f"{base}/score/batch", {"events": history_events[i:i + 500]})
+
+    shards = [[] for _ in range(args.concurrency)]
+    for ev in measured:
+        shards[hash(ev["user_id"]) % args.concurrency].append(ev)
+
+    def worker(shard):
+        lat, decs, errs = [], Counter(), 0
+        for ev in shard:
+            t0 = time.perf_counter()
+            try:
+                body = _post_json(f"{base}/score", ev)
+                decs[body["decision"]] += 1
+            except Exception:
+                errs += 1
+            lat.append((time.perf_counter() - t0) * 1000.0)
+        return lat, decs, errs
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        results = list(pool.map(worker, shards))
+    elapsed = time.perf_counter() - started
+
+    totals, decisions, errors = [], Counter(), 0
+    for lat, decs, errs in results:
+        totals.extend(lat)
+        decisions.update(decs)
+        errors += errs
+
+    return {
+        "elapsed_s": elapsed,
+        "latency_ms": summarize(totals),
+        "decisions": dict(decisions),
+        "errors": errors,
+    }
+
+
+MODES = {
+    "pipeline": run_pipeline,
+    "client": run_client,
+    "http": run_http,
+}
+
+
+# ---------------------- العرض والمقارنة ---------------------- #
+
+def print_summary(result: dict) -> None:
+    lat = result["latency_ms"]
+    print(
+        f"[bench] mode={result['config']['mode']} events={lat.get('count', 0)} "
+        f"throughput={result['throughput_eps']:.1f} ev/s"
+    )
+    print(
+        f"[bench] latency ms: p50={lat.get('p50', 0):.3f} "
+        f"p95={lat.get('p95', 0):.3f} p99={lat.get('p99', 0):.3f}"
+    )
+    for name, st in result.get("stages_ms", {}).items():
+        print(
+            f"[bench]   {name:<10} p50={st.get('p50', 0):.3f} "
+            f"p95={st.get('p95', 0):.3f} p99={st.get('p99', 0):.3f}"
+        )
+    print(f"[bench] decisions: {result.get('decisions', {})}")
+
+
+def compare(old: dict, new: dict) -> None:
+    """
+    طباعة الفرق بين تشغيلين (سالب في latency = تحسّن).
+    """
+    rows = [("throughput_eps", old.get("throughput_eps"), new.get("throughput_eps"))]
+    for q in ("p50", "p95", "p99"):
+        rows.append((f"latency.{q}", old["latency_ms"].get(q), new["latency_ms"].get(q)))
+    for name in STAGES:
+        o = old.get("stages_ms", {}).get(name, {}).get("p50")
+        n = new.get("stages_ms", {}).get(name, {}).get("p50")
+        if o is not None and n is not None:
+            rows.append((f"{name}.p50", o, n))
+
+    print("[bench] metric               old          new        delta")
+    for name, o, n in rows:
+        if not o or n is None:
+            continue
+        print(f"[bench] {name:<18} {o:>10.3f} {n:>12.3f} {(n - o) / o * 100.0:>+10.1f}%")
+
+
+def main(argv=None) -> dict:
+    parser = argparse.ArgumentParser(description="SND /score benchmark")
+    parser.add_argument("--mode", choices=sorted(MODES), default="pipeline")
+    parser.add_argument("--users", type=int, default=100, help="عدد المستخدمين")
+    parser.add_argument("--history", type=int, default=50, help="عدد الأحداث التاريخية لكل مستخدم")
+    parser.add_argument("--history-days", type=int, default=30)
+    parser.add_argument("--events", type=int, default=2000, help="عدد أحداث القياس")
+    parser.add_argument("--sensitive-ratio", type=float, default=0.1)
+    parser.add_argument("--anomaly-ratio", type=float, default=0.1)
+    parser.add_argument("--concurrency", type=int, default=1, help="لوضع http فقط")
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--db", default=None, help="مسار قاعدة بيانات (الافتراضي: ملف مؤقت)")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--output", default=None, help="حفظ النتيجة JSON في ملف")
+    parser.add_argument("--compare", default=None, help="ملف JSON من تشغيل سابق للمقارنة")
+    args = parser.parse_args(argv)
+
+    history_events, measured = generate_workload(
+        users=args.users,
+        history=args.history,
+        events=args.events,
+        sensitive_ratio=args.sensitive_ratio,
+        anomaly_ratio=args.anomaly_ratio,
+        history_days=args.history_days,
+        seed=args.seed,
+    )
+
+    result = MODES[args.mode](history_events, measured, args)
+    result["throughput_eps"] = len(measured) / result["elapsed_s"] if result["elapsed_s"] else 0.0
+    result["config"] = {
+        k: v for k, v in vars(args).items() if k not in ("output", "compare")
+    }
+    result["timestamp"] = datetime.now().isoformat(timespec="seconds")
+
+    print_summary(result)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, indent=2, ensure_ascii=False)
+        print(f"[bench] تم حفظ النتيجة في: {args.output}")
+    else:
+        json.dump(result, sys.stdout, indent=2, ensure_ascii=False)
+        print()
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare(json.load(f), result)
+
+    return result
+
+
+if __name__ == "__main__":
+    main()
@@ -1,71 +1,638 @@
 import os
+import queue
 import sqlite3
+import threading
+import time
 from datetime import datetime, timedelta
 
+from event_feed import EventFeed, StoreFollower
+from event_writer import WriteBehindWriter
+from metrics import METRICS_ENABLED, count_query, record_region_lookup
+from rollups import backfill_rollups, create_rollup_tables
+from profile_cache import ProfileCache, UserProfile
+from regions import (
+    RegionResolver,
+    create_city_region_table,
+    seed_city_regions,
+    upsert_city_regions,
+)
+from storage import COUNT_FIELDS, EVENT_FIELDS, EventStore, ProfileRows
+from velocity import LONGEST_WINDOW_MS, VELOCITY_MAX_EVENTS
+
 # مسار قاعدة البيانات (نفس مجلد المشروع /SND)
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 DB_PATH = os.path.join(BASE_DIR, "events.db")
 
+# إعدادات SQLite (قابلة للتغيير من متغيرات البيئة)
+# WAL: القارئ لا ينتظر الكاتب، و NORMAL يكفي مع WAL (fsync عند الـ checkpoint فقط)
+SQLITE_JOURNAL_MODE = os.environ.get("SND_SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.environ.get("SND_SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get("SND_SQLITE_BUSY_TIMEOUT_MS", "5000"))
+# عدد الاستعلامات المحضّرة (prepared statements) المحفوظة لكل اتصال
+SQLITE_CACHED_STATEMENTS = int(os.environ.get("SND_SQLITE_CACHED_STATEMENTS", "256"))
+# أقصى عدد اتصالات خاملة نحتفظ بها لكل ملف قاعدة بيانات
+SQLITE_POOL_SIZE = int(os.environ.get("SND_SQLITE_POOL_SIZE", "16"))
+
+
+# التخزين: فارغ = SQLite في DB_PATH، أو sqlite:///path أو postgresql://... (storage.py)
+DATABASE_URL = os.environ.get("SND_DATABASE_URL", "")
+# مع تخزين مشترك (عدة عقد): أقصى عمر لبصمة المستخدم في الكاش قبل إعادة تحميلها
+PROFILE_SHARED_MAX_AGE_SECONDS = float(os.environ.get("SND_PROFILE_MAX_AGE_SECONDS", "5"))
+# عدد عمليات الخدمة على نفس التخزين (serve.py --workers): أكثر من واحدة = تخزين مشترك
+WORKER_PROCESSES = int(os.environ.get("SND_WORKER_PROCESSES", "1"))
+
+# الأحداث بمخاطر أعلى من هذا لا تُحفظ في events (ولا تدخل البصمة أو التدريب)
+MAX_STORED_RISK_SCORE = 95
+
+# كل كم ثانية يقرأ poller البث الأحداث الجديدة (تخزين مشترك فقط)
+EVENT_FEED_POLL_INTERVAL = float(os.environ.get("SND_EVENT_FEED_POLL_INTERVAL", "1"))
+
+# تفعيل الكتابة المؤجلة (write-behind) عند تشغيل التطبيق
+WRITE_BEHIND_ENABLED = os.environ.get("SND_WRITE_BEHIND", "0") == "1"
+
+
+# ---------------------- إدارة الاتصالات (Pool) ---------------------- #
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _open_connection(db_path: str) -> sqlite3.Connection:
+    # check_same_thread=False لأن الاتصال ينتقل بين الـ threads عبر الـ pool،
+    # لكنه لا يُستخدم من أكثر من thread في نفس اللحظة
+    conn = sqlite3.connect(
+        db_path,
+        timeout=SQLITE_BUSY_TIMEOUT_MS / 1000.0,
+        check_same_thread=False,
+        cached_statements=SQLITE_CACHED_STATEMENTS,
+    )
+    conn.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+    # عدّ الاستعلامات لكل طلب (/metrics) فقط لو القياس مفعّل
+    if METRICS_ENABLED:
+        conn.set_trace_callback(count_query)
+    return conn
+
+
+def _pool_for(db_path: str) -> queue.LifoQueue:
+    pool = _pools.get(db_path)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.setdefault(db_path, queue.LifoQueue(maxsize=SQLITE_POOL_SIZE))
+    return pool
+
+
+def get_connection(db_path: str | None = None) -> sqlite3.Connection:
+    """
+    أخذ اتصال SQLite من الـ pool (أو فتح اتصال جديد لو الـ pool فاضي).
+    LIFO: الـ thread يرجع غالباً نفس الاتصال الذي أعاده للتو (كاش الاستعلامات المحضّرة دافئ).
+
+    بعد الانتهاء لازم release_connection(conn) بدل conn.close().
+    """
+    path = db_path or DB_PATH
+    try:
+        return _pool_for(path).get_nowait()
+    except queue.Empty:
+        return _open_connection(path)
+
+
+def release_connection(conn: sqlite3.Connection, db_path: str | None = None) -> None:
+    """
+    إرجاع الاتصال إلى الـ pool، أو إغلاقه لو الـ pool ممتلئ.
+    أي transaction مفتوحة بدون commit يتم التراجع عنها.
+    """
+    if conn.in_transaction:
+        conn.rollback()
+    try:
+        _pool_for(db_path or DB_PATH).put_nowait(conn)
+    except queue.Full:
+        conn.close()
+
+
+def close_all_connections() -> None:
+    """
+    إغلاق كل الاتصالات الخاملة في كل الـ pools (عند الإيقاف أو تغيير DB_PATH).
+    """
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        while True:
+            try:
+                pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+# ---------------------- التخزين: SQLite ---------------------- #
+
+_INSERT_EVENT_SQL = """
+    INSERT INTO events (
+        user_id,
+        device,
+        city,
+        region,
+        os,
+        browser,
+        service,
+        event_time,
+        timestamp_ms,
+        risk_score,
+        ai_risk_score,
+        rules_score,
+        decision,
+        raw_payload
+    )
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+_EVENT_FIELDS_SQL = ", ".join(EVENT_FIELDS)
+
+
+class SQLiteEventStore(EventStore):
+    """
+    التخزين الافتراضي: ملف SQLite (WAL + pool اتصالات).
+    db_path=None يعني DB_PATH وقت كل استدعاء (السكربتات والـ benchmark تغيّره).
+    """
+
+    name = "sqlite"
+
+    def __init__(self, db_path: str | None = None):
+        self.db_path = db_path
+
+    def init_schema(self) -> None:
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        # جدول الأحداث الرئيسي
+        cur.execute(
+            """
+            CREATE TABLE IF NOT EXISTS events (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id TEXT NOT NULL,
+                device TEXT NOT NULL,
+                city TEXT NOT NULL,
+                region TEXT,
+                os TEXT,
+                browser TEXT,
+                service TEXT NOT NULL,
+                event_time TEXT NOT NULL,
+                timestamp_ms INTEGER,
+                risk_score REAL NOT NULL,
+                ai_risk_score REAL,
+                rules_score REAL,
+                decision TEXT NOT NULL,
+                raw_payload TEXT
+            );
+            """
+        )
+
+        # فهارس لتحسين الاستعلامات
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_events_user_ts
+            ON events (user_id, timestamp_ms);
+            """
+        )
+
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_events_user_service
+            ON events (user_id, service);
+            """
+        )
+
+        cur.execute(
+            """
+            CREATE INDEX IF NOT EXISTS idx_events_user_city_device
+            ON events (user_id, city, device);
+            """
+        )
+
+        # جداول التجميع (rollups) + trigger التحديث
+        # لو أُنشئت الآن على قاعدة فيها أحداث قديمة، نعبّيها مرة واحدة
+        if create_rollup_tables(cur):
+            conn.commit()
+            backfill_rollups(conn)
+
+        # المدينة → المنطقة (جدول بمفتاح مُطبَّع + المدن الأساسية عند الإنشاء)
+        if create_city_region_table(cur):
+            seed_city_regions(cur)
+
+        conn.commit()
+        release_connection(conn, self.db_path)
+
+    def insert_events(self, rows):
+        conn = get_connection(self.db_path)
+        try:
+            # execute لكل سطر بدل executemany حتى نعرف lastrowid لكل حدث
+            # (نفس الـ transaction ونفس الاستعلام المحضّر، فالفرق بسيط)
+            cur = conn.cursor()
+            ids = []
+            for row in rows:
+                cur.execute(_INSERT_EVENT_SQL, row)
+                ids.append(cur.lastrowid)
+            conn.commit()
+        finally:
+            release_connection(conn, self.db_path)
+        return ids
+
+    def load_profile(self, user_id, window_ms, limit):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+        try:
+            # كل القراءات هنا من جداول التجميع (فهرس مباشر) بدل مسح سجل المستخدم
+            cur.execute(
+                """
+                SELECT total_events, low_risk_count, max_ts, last_event_id
+                FROM user_stats
+                WHERE user_id = ?
+                """,
+                (user_id,),
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+            total_events, low_risk_count, max_ts, last_event_id = row
+
+            cur.execute(
+                """
+                SELECT day
+                FROM user_daily_stats
+                WHERE user_id = ?
+                """,
+                (user_id,),
+            )
+            active_days = [r[0] for r in cur.fetchall()]
+
+            counts = {}
+            for field_name in COUNT_FIELDS:
+                cur.execute(
+                    f"""
+                    SELECT {field_name}, event_count
+                    FROM user_{field_name}_counts
+                    WHERE user_id = ?
+                    """,
+                    (user_id,),
+                )
+                counts[field_name] = cur.fetchall()
+
+            cur.execute(
+                """
+                SELECT event_time, device, city, timestamp_ms
+                FROM events
+                WHERE id = ?
+                """,
+                (last_event_id,),
+            )
+            last_event = cur.fetchone()
+
+            cur.execute(
+                """
+                SELECT prev2, prev1, service, event_count
+                FROM user_service_ngrams
+                WHERE user_id = ?
+                """,
+                (user_id,),
+            )
+            service_ngrams = cur.fetchall()
+
+            cur.execute(
+                """
+                SELECT last_service, prev_service
+                FROM user_service_tail
+                WHERE user_id = ?
+                """,
+                (user_id,),
+            )
+            service_tail = cur.fetchone() or (None, None)
+
+            window_timestamps = []
+            if max_ts is not None:
+                # عدادات النوافذ: طوابع أطول نافذة فقط (فهرس user_id, timestamp_ms)
+                cur.execute(
+                    """
+                    SELECT timestamp_ms
+                    FROM events
+                    WHERE user_id = ?
+                      AND timestamp_ms >= ?
+                    ORDER BY timestamp_ms DESC
+                    LIMIT ?
+                    """,
+                    (user_id, max_ts - window_ms, limit),
+                )
+                window_timestamps = [r[0] for r in reversed(cur.fetchall())]
+        finally:
+            release_connection(conn, self.db_path)
+
+        return ProfileRows(
+            total_events=int(total_events or 0),
+            low_risk_count=int(low_risk_count or 0),
+            active_days=active_days,
+            city_counts=counts["city"],
+            device_counts=counts["device"],
+            service_counts=counts["service"],
+            last_event=last_event,
+            window_timestamps=window_timestamps,
+            service_ngrams=service_ngrams,
+            service_tail=tuple(service_tail),
+        )
+
+    def last_event(self, user_id):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            SELECT event_time, device, city, timestamp_ms
+            FROM events
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT 1
+            """,
+            (user_id,),
+        )
+
+        row = cur.fetchone()
+        release_connection(conn, self.db_path)
+        return row
+
+    def event_count_since(self, user_id, since_ms):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            SELECT COUNT(*)
+            FROM events
+            WHERE user_id = ?
+              AND timestamp_ms IS NOT NULL
+              AND timestamp_ms >= ?
+            """,
+            (user_id, since_ms),
+        )
+
+        count = cur.fetchone()[0]
+        release_connection(conn, self.db_path)
+        return int(count)
+
+    def low_risk_count(self, user_id):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            SELECT low_risk_count
+            FROM user_stats
+            WHERE user_id = ?
+            """,
+            (user_id,),
+        )
+
+        row = cur.fetchone()
+        release_connection(conn, self.db_path)
+        return int(row[0]) if row else 0
+
+    def event_stats(self, user_id, values):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            SELECT
+                (SELECT total_events FROM user_stats WHERE user_id = ?),
+                (SELECT COUNT(*) FROM user_daily_stats WHERE user_id = ?)
+            """,
+            (user_id, user_id),
+        )
+        total_events, distinct_days = cur.fetchone()
+
+        counts = {}
+        for field_name, value in values.items():
+            if not value:
+                counts[field_name] = 0
+                continue
+            cur.execute(
+                f"""
+                SELECT event_count
+                FROM user_{field_name}_counts
+                WHERE user_id = ?
+                  AND {field_name} = ?
+                """,
+                (user_id, value),
+            )
+            row = cur.fetchone()
+            counts[field_name] = row[0] if row else 0
+
+        release_connection(conn, self.db_path)
+        return int(total_events or 0), int(distinct_days or 0), counts
+
+    def recent_events(self, limit):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            f"""
+            SELECT {_EVENT_FIELDS_SQL}
+            FROM events
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (limit,),
+        )
+
+        rows = cur.fetchall()
+        release_connection(conn, self.db_path)
+        return [dict(zip(EVENT_FIELDS, r)) for r in rows]
+
+    def events_since(self, since_id, limit):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            f"""
+            SELECT {_EVENT_FIELDS_SQL}
+            FROM events
+            WHERE id > ?
+            ORDER BY id
+            LIMIT ?
+            """,
+            (since_id, limit),
+        )
+
+        rows = cur.fetchall()
+        release_connection(conn, self.db_path)
+        return [dict(zip(EVENT_FIELDS, r)) for r in rows]
+
+    def sequence_history(self, user_id, limit):
+        conn = get_connection(self.db_path)
+        cur = conn.cursor()
+
+        cur.execute(
+            """
+            SELECT service
+            FROM events
+            WHERE user_id = ?
+            ORDER BY id DESC
+            LIMIT ?
+            """,
+            (user_id, int(limit)),
+        )
+
+        rows = cur.fetchall()
+        release_connection(conn, self.db_path)
+        return [r[0] for r in rows]
+
+    def city_regions(self):
+        conn = get_connection(self.db_path)
+        try:
+            rows = conn.execute("SELECT name_key, region FROM city_region").fetchall()
+        except sqlite3.OperationalError:
+            # قاعدة بيانات بدون init_db (سكربتات قديمة مثلاً)
+            rows = []
+        release_connection(conn, self.db_path)
+        return dict(rows)
+
+    def upsert_city_regions(self, rows):
+        conn = get_connection(self.db_path)
+        try:
+            count = upsert_city_regions(conn.cursor(), rows)
+            conn.commit()
+        finally:
+            release_connection(conn, self.db_path)
+        return count
+
+    def close(self) -> None:
+        close_all_connections()
+
+
+def open_store(url: str | None = None) -> EventStore:
+    """
+    إنشاء التخزين من رابط (SND_DATABASE_URL): فارغ / sqlite:///path / postgresql://...
+    """
+    if not url:
+        return SQLiteEventStore()
+    if url.startswith("sqlite:///"):
+        return SQLiteEventStore(url[len("sqlite:///"):])
+    if url.startswith(("postgresql://", "postgres://")):
+        from storage_postgres import PostgresEventStore
+
+        return PostgresEventStore(url)
+    raise ValueError(f"unsupported SND_DATABASE_URL: {url}")
+
+
+store = open_store(DATABASE_URL)
+
+
+def sqlite_db_path() -> str:
+    """
+    ملف SQLite الذي تكتب فيه الخدمة (حسب SND_DATABASE_URL) للأدوات التي تقرأ SQLite مباشرة
+    (التدريب، backtest، retention، rollups). مع تخزين آخر (PostgreSQL) ترمي ValueError
+    بدل العمل بصمت على ملف events.db قديم أو فارغ.
+    """
+    if not isinstance(store, SQLiteEventStore):
+        raise ValueError(
+            f"this tool works on SQLite only, but SND_DATABASE_URL selects {store.name} storage"
+        )
+    return store.db_path or DB_PATH
+
 
 # ---------------------- تهيئة قاعدة البيانات ---------------------- #
 
+
 def init_db():
     """
-    إنشاء جدول الأحداث إذا لم يكن موجودًا + إنشاء فهارس بسيطة.
-    """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # جدول الأحداث الرئيسي
-    cur.execute(
-        """
-        CREATE TABLE IF NOT EXISTS events (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            user_id TEXT NOT NULL,
-            device TEXT NOT NULL,
-            city TEXT NOT NULL,
-            region TEXT,
-            os TEXT,
-            browser TEXT,
-            service TEXT NOT NULL,
-            event_time TEXT NOT NULL,
-            timestamp_ms INTEGER,
-            risk_score REAL NOT NULL,
-            ai_risk_score REAL,
-            rules_score REAL,
-            decision TEXT NOT NULL,
-            raw_payload TEXT
-        );
-        """
-    )
+    إنشاء جدول الأحداث إذا لم يكن موجودًا + إنشاء فهارس بسيطة وجداول التجميع.
+    """
+    store.init_schema()
 
-    # فهارس لتحسين الاستعلامات
-    cur.execute(
-        """
-        CREATE INDEX IF NOT EXISTS idx_events_user_ts
-        ON events (user_id, timestamp_ms);
-        """
-    )
 
-    cur.execute(
-        """
-        CREATE INDEX IF NOT EXISTS idx_events_user_service
-        ON events (user_id, service);
-        """
-    )
+# ---------------------- إدخال الأحداث ---------------------- #
+
+_writer = None  # WriteBehindWriter عند تفعيل الكتابة المؤجلة
+
+# البث المباشر (/events/stream): الأحداث تُنشر بعد حفظها مباشرة.
+# مع تخزين مشترك (عدة عمليات / عقد) النشر المحلي لا يكفي، فيتولاه poller واحد
+# لكل عملية يقرأ الأحداث الجديدة من التخزين (start_event_feed)
+event_feed = EventFeed()
+_FEED_FROM_STORE = store.shared or WORKER_PROCESSES > 1
+_feed_poller = None  # Thread (تخزين مشترك) أو False بعد البدء
+_feed_poller_lock = threading.Lock()
+# النشر المحلي (SQLite في عملية واحدة): الحفظ والنشر معاً حتى تصل الحلقة بترتيب الـ id.
+# لا يبطئ شيئاً: SQLite يسمح بكاتب واحد في كل لحظة أصلاً
+_publish_lock = threading.Lock()
+
 
-    cur.execute(
-        """
-        CREATE INDEX IF NOT EXISTS idx_events_user_city_device
-        ON events (user_id, city, device);
-        """
+def _store_rows(rows) -> None:
+    """
+    حفظ دفعة أحداث في transaction واحدة ثم نشرها في البث.
+    مع تخزين مشترك النشر يتم من التخزين (StoreFollower) وليس هنا.
+    """
+    if _FEED_FROM_STORE:
+        store.insert_events(rows)
+        return
+    with _publish_lock:
+        _publish_stored(rows, store.insert_events(rows))
+
+
+def _publish_stored(rows, ids) -> None:
+    # الحقول بنفس شكل EVENT_FIELDS (أسطر الإدخال بترتيب EVENT_COLUMNS)
+    event_feed.publish(
+        {
+            "id": event_id,
+            "user_id": row[0],
+            "device": row[1],
+            "city": row[2],
+            "region": row[3],
+            "os": row[4],
+            "browser": row[5],
+            "service": row[6],
+            "event_time": row[7],
+            "risk_score": row[9],
+            "decision": row[12],
+        }
+        for row, event_id in zip(rows, ids)
     )
 
-    conn.commit()
-    conn.close()
 
+def _feed_poll_loop(interval: float) -> None:
+    follower = StoreFollower(event_feed, store.events_since)
+    while True:
+        time.sleep(interval)
+        try:
+            # دفعات متتالية حتى نلحق بالتخزين أو نتوقف عند id ناقص
+            while follower.poll(500) == 500:
+                pass
+        except Exception as exc:
+            print(f"[feed] خطأ أثناء قراءة الأحداث الجديدة: {exc}")
+
+
+def start_event_feed() -> EventFeed:
+    """
+    يُستدعى عند كل مشترك في /events/stream.
+    أول مرة: الحلقة تبدأ من آخر حدث محفوظ الآن (حتى لا يُعاد بث السجل القديم)،
+    ومع تخزين مشترك يبدأ poller في الخلفية.
+    """
+    global _feed_poller
+    if _feed_poller is not None:
+        return event_feed
+    with _feed_poller_lock:
+        if _feed_poller is None:
+            event_feed.publish(store.recent_events(1))
+            if _FEED_FROM_STORE:
+                _feed_poller = threading.Thread(
+                    target=_feed_poll_loop,
+                    args=(EVENT_FEED_POLL_INTERVAL,),
+                    name="snd-event-feed",
+                    daemon=True,
+                )
+                _feed_poller.start()
+            else:
+                _feed_poller = False  # insert_event ينشر مباشرة
+    return event_feed
 
-# ---------------------- إدخال الأحداث ---------------------- #
 
 def insert_event(
     user_id: str,
@@ -82,9 +649,11 @@ def insert_event(
     rules_score: float,
     decision: str,
     raw_payload: str,
+    event_day: str | None = None,
 ):
     """
     تخزين الحدث في جدول events.
+    event_day: تاريخ الحدث (sqlite_date) لو محسوب مسبقاً، لتحديث البصمة بدون تحليل الوقت.
 
     ملاحظة مهمة:
     - نمنع "تسميم" البصمة السلوكية عن طريق عدم حفظ الأحداث عالية الخطورة في التعلم.
@@ -92,57 +661,195 @@ def insert_event(
     """
     # لا نحفظ إلا الأحداث ذات المخاطر <= 90 تقريباً (تقدر تشددها لاحقاً إن حبيت)
     # لو تبي بصمة أنظف جدًا خلي الشرط <= 35 كما ناقشنا سابقًا.
-    if risk_score > 95:
+    if risk_score > MAX_STORED_RISK_SCORE:
         # أحداث شديدة السوء، نتجاهلها من التخزين بالكامل
         return
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        INSERT INTO events (
-            user_id,
-            device,
-            city,
-            region,
-            os,
-            browser,
-            service,
-            event_time,
-            timestamp_ms,
-            risk_score,
-            ai_risk_score,
-            rules_score,
-            decision,
-            raw_payload
-        )
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """,
-        (
-            user_id,
-            device,
-            city,
-            region,
-            os_name,
-            browser,
-            service,
-            event_time,
-            timestamp_ms,
-            risk_score,
-            ai_risk_score,
-            rules_score,
-            decision,
-            raw_payload,
-        ),
+    row = (
+        user_id,
+        device,
+        city,
+        region,
+        os_name,
+        browser,
+        service,
+        event_time,
+        timestamp_ms,
+        risk_score,
+        ai_risk_score,
+        rules_score,
+        decision,
+        raw_payload,
     )
 
-    conn.commit()
-    conn.close()
+    # وضع الكتابة المؤجلة: نحدّث البصمة الآن ونترك الحفظ للكاتب في الخلفية
+    writer = _writer
+    if writer is not None:
+        with profile_cache.lock:
+            writer.register(row)
+            profile_cache.on_insert(
+                user_id=user_id,
+                device=device,
+                city=city,
+                service=service,
+                event_time=event_time,
+                timestamp_ms=timestamp_ms,
+                risk_score=risk_score,
+                day=event_day,
+            )
+        writer.submit(row)
+        return
+
+    # الحفظ خارج قفل الكاش (لا يوقف طلبات المستخدمين الآخرين)، و begin/end_write
+    # تمنع تحميل البصمة المتزامن من حساب الحدث مرتين أو إسقاطه
+    profile_cache.begin_write(user_id)
+    try:
+        _store_rows([row])
+
+        # تحديث البصمة في الذاكرة مباشرة بدل إعادة حسابها من الجدول
+        profile_cache.on_insert(
+            user_id=user_id,
+            device=device,
+            city=city,
+            service=service,
+            event_time=event_time,
+            timestamp_ms=timestamp_ms,
+            risk_score=risk_score,
+            day=event_day,
+        )
+    finally:
+        profile_cache.end_write(user_id)
+
+
+# ---------------------- الكتابة المؤجلة (Write-Behind) ---------------------- #
+
+
+def _flush_event_rows(rows) -> None:
+    """
+    حفظ دفعة أحداث في transaction واحدة (fsync واحد بدل واحد لكل حدث).
+    """
+    _store_rows(rows)
+
+
+def _on_flush_error(rows, error) -> None:
+    # البصمة في الذاكرة حسبت أحداث لم تُحفظ، نعيد تحميلها من القاعدة
+    for row in rows:
+        profile_cache.invalidate(row[0])
+
+
+def enable_write_behind(**kwargs) -> WriteBehindWriter:
+    """
+    تفعيل الكتابة المؤجلة: insert_event يرجع فوراً والحفظ يتم على دفعات في الخلفية.
+    kwargs تمرر لـ WriteBehindWriter (max_queue, batch_size, flush_interval).
+    """
+    global _writer
+    if _writer is None:
+        _writer = WriteBehindWriter(
+            flush_rows=_flush_event_rows,
+            lock=profile_cache.lock,
+            begin_user=profile_cache.begin_write,
+            end_user=profile_cache.end_write,
+            on_error=_on_flush_error,
+            **kwargs,
+        )
+    return _writer
+
+
+def disable_write_behind() -> None:
+    """
+    إيقاف الكتابة المؤجلة بعد حفظ كل الأحداث المعلّقة.
+    """
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.stop()
+
+
+# ---------------------- البصمة السلوكية في الذاكرة ---------------------- #
+
+
+def _load_user_profile(user_id: str) -> UserProfile:
+    """
+    تحميل بصمة المستخدم من قاعدة البيانات (مرة واحدة عند أول وصول).
+    بعدها يتم تحديثها تدريجياً من insert_event بدون الرجوع للجدول.
+    """
+    profile = UserProfile(user_id)
+
+    rows = store.load_profile(user_id, LONGEST_WINDOW_MS, VELOCITY_MAX_EVENTS)
+    if rows is not None:
+        profile.total_events = rows.total_events
+        profile.low_risk_count = rows.low_risk_count
+        profile.active_days = set(rows.active_days)
+        profile.city_counts.update(rows.city_counts)
+        profile.device_counts.update(rows.device_counts)
+        profile.service_counts.update(rows.service_counts)
+        profile.last_event = rows.last_event
+        profile.velocity.load(rows.window_timestamps)
+        profile.transitions.load(rows.service_ngrams, rows.service_tail)
+
+    _apply_pending_events(profile)
+    return profile
+
+
+def _apply_pending_events(profile: UserProfile) -> None:
+    """
+    إضافة الأحداث التي ما زالت في طابور الكتابة المؤجلة
+    حتى يرى build_features ما كتبناه قبل أن يصل للقاعدة (read-your-writes).
+    """
+    writer = _writer
+    if writer is None:
+        return
+    for row in writer.pending_for(profile.user_id):
+        (_, device, city, _, _, _, service, event_time, timestamp_ms, risk_score) = row[:10]
+        profile.apply_event(device, city, service, event_time, timestamp_ms, risk_score)
+
+
+profile_cache = ProfileCache(
+    loader=_load_user_profile,
+    max_age_seconds=(
+        PROFILE_SHARED_MAX_AGE_SECONDS if store.shared or WORKER_PROCESSES > 1 else None
+    ),
+)
+
+
+def get_user_profile(user_id: str) -> UserProfile:
+    """
+    إرجاع بصمة المستخدم من الكاش (أو تحميلها من القاعدة لو أول مرة).
+    """
+    return profile_cache.get(user_id)
+
+
+# ---------------------- المدينة → المنطقة ---------------------- #
+
+
+def _load_city_regions() -> dict:
+    """
+    تحميل جدول city_region كاملاً (مرة واحدة)؛ البحث بعدها من الذاكرة فقط.
+    """
+    return store.city_regions()
+
+
+region_resolver = RegionResolver(
+    loader=_load_city_regions,
+    on_lookup=record_region_lookup if METRICS_ENABLED else None,
+)
+
+
+def resolve_region(city: str) -> str:
+    return region_resolver.resolve(city)
+
+
+def start_region_reloader() -> None:
+    """
+    تحميل جدول المناطق الآن + التقاط تعديلاته (python -m regions load) بدون إعادة تشغيل.
+    """
+    region_resolver.refresh()
+    region_resolver.start_reloader()
 
 
 # ---------------------- دوال مساعدة لاسترجاع البيانات ---------------------- #
 
+
 def get_last_event(user_id: str):
     """
     إرجاع آخر حدث للمستخدم (للتحقق من سرعة الطلبات وغيرها).
@@ -151,23 +858,7 @@ def get_last_event(user_id: str):
         (event_time_str, device, city, timestamp_ms)
     أو None إذا لا توجد أحداث.
     """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT event_time, device, city, timestamp_ms
-        FROM events
-        WHERE user_id = ?
-        ORDER BY id DESC
-        LIMIT 1
-        """,
-        (user_id,),
-    )
-
-    row = cur.fetchone()
-    conn.close()
-    return row  # ممكن تكون None
+    return store.last_event(user_id)  # ممكن تكون None
 
 
 def get_event_count(user_id: str, last_minutes: int = 60) -> int:
@@ -178,45 +869,14 @@ def get_event_count(user_id: str, last_minutes: int = 60) -> int:
     now_ms = int(datetime.utcnow().timestamp() * 1000)
     cutoff_ms = now_ms - (last_minutes * 60 * 1000)
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM events
-        WHERE user_id = ?
-          AND timestamp_ms IS NOT NULL
-          AND timestamp_ms >= ?
-        """,
-        (user_id, cutoff_ms),
-    )
-
-    count = cur.fetchone()[0]
-    conn.close()
-    return int(count)
+    return store.event_count_since(user_id, cutoff_ms)
 
 
 def get_low_risk_event_count(user_id: str) -> int:
     """
     عدد الأحداث منخفضة المخاطر للمستخدم (تُستخدم لتحديد is_new_user).
     """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM events
-        WHERE user_id = ?
-          AND risk_score <= 35
-        """,
-        (user_id,),
-    )
-
-    result = cur.fetchone()[0]
-    conn.close()
-    return int(result)
+    return store.low_risk_count(user_id)
 
 
 def get_event_stats(*args, **kwargs) -> dict:
@@ -254,78 +914,36 @@ def get_event_stats(*args, **kwargs) -> dict:
             "service_frequency": 0.0,
         }
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    # 1) عدد الأحداث في آخر ساعة وآخر 24 ساعة
-    now_ms = int(datetime.utcnow().timestamp() * 1000)
-    cutoff_1h = now_ms - (60 * 60 * 1000)
-    cutoff_24h = now_ms - (24 * 60 * 60 * 1000)
-
-    cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM events
-        WHERE user_id = ?
-          AND timestamp_ms IS NOT NULL
-          AND timestamp_ms >= ?
-        """,
-        (user_id, cutoff_1h),
+    # 1) عدد الأحداث في آخر ساعة وآخر 24 ساعة بوقت الحدث (من عدادات البصمة)
+    event_dt = kwargs.get("event_dt", args[4] if len(args) > 4 else None)
+    if isinstance(event_dt, str):
+        event_dt = datetime.fromisoformat(event_dt)
+    if event_dt is None:
+        event_dt = datetime.utcnow()
+    now_ms = int(event_dt.timestamp() * 1000)
+
+    profile = get_user_profile(user_id)
+    events_last_1h = profile.count_window("1h", now_ms)
+    events_last_24h = profile.count_window("24h", now_ms)
+
+    # 2) إجمالي عدد الأحداث وعدد الأيام المختلفة + 3) تكرار المدينة/الجهاز/الخدمة
+    total_events, distinct_days, counts = store.event_stats(
+        user_id, {"city": city, "device": device, "service": service}
     )
-    events_last_1h = cur.fetchone()[0]
-
-    cur.execute(
-        """
-        SELECT COUNT(*)
-        FROM events
-        WHERE user_id = ?
-          AND timestamp_ms IS NOT NULL
-          AND timestamp_ms >= ?
-        """,
-        (user_id, cutoff_24h),
-    )
-    events_last_24h = cur.fetchone()[0]
-
-    # 2) إجمالي عدد الأحداث وعدد الأيام المختلفة
-    cur.execute(
-        """
-        SELECT COUNT(*), COUNT(DISTINCT DATE(event_time))
-        FROM events
-        WHERE user_id = ?
-        """,
-        (user_id,),
-    )
-    total_events, distinct_days = cur.fetchone()
-    total_events = total_events or 0
-    distinct_days = distinct_days or 0
 
     if distinct_days > 0:
         avg_daily_events = float(total_events) / float(distinct_days)
     else:
         avg_daily_events = 0.0
 
-    # 3) تكرار المدينة/الجهاز/الخدمة
-    def _freq_for(field_name: str, value: str | None) -> float:
-        if not value or total_events == 0:
+    def _freq_for(field_name: str) -> float:
+        if total_events == 0:
             return 0.0
+        return float(counts[field_name]) / float(total_events)
 
-        cur.execute(
-            f"""
-            SELECT COUNT(*)
-            FROM events
-            WHERE user_id = ?
-              AND {field_name} = ?
-            """,
-            (user_id, value),
-        )
-        count = cur.fetchone()[0] or 0
-        return float(count) / float(total_events)
-
-    city_frequency = _freq_for("city", city)
-    device_frequency = _freq_for("device", device)
-    service_frequency = _freq_for("service", service)
-
-    conn.close()
+    city_frequency = _freq_for("city")
+    device_frequency = _freq_for("device")
+    service_frequency = _freq_for("service")
 
     return {
         "events_last_1h": int(events_last_1h),
@@ -350,58 +968,19 @@ def get_sequence_history(*args, **kwargs):
     if user_id is None:
         return []
 
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT service, event_time
-        FROM events
-        WHERE user_id = ?
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (user_id, int(limit)),
-    )
-
-    rows = cur.fetchall()
-    conn.close()
-
     # نرجع فقط قائمة بالخدمات بالترتيب من الأحدث للأقدم
-    return [r[0] for r in rows]
+    return store.sequence_history(user_id, limit)
 
 
-def get_recent_events(limit: int = 50):
+def get_events_since(since_id: int, limit: int = 50):
     """
-    إرجاع آخر الأحداث (للاستخدام في الـ Dashboard).
-    """
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-
-    cur.execute(
-        """
-        SELECT
-            id,
-            user_id,
-            device,
-            city,
-            region,
-            os,
-            browser,
-            service,
-            event_time,
-            risk_score,
-            ai_risk_score,
-            rules_score,
-            decision
-        FROM events
-        ORDER BY id DESC
-        LIMIT ?
-        """,
-        (limit,),
-    )
+    الأحداث بعد since_id من الأقدم للأحدث (/events?since_id=).
+    """
+    return store.events_since(since_id, limit)
 
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
+def get_recent_events(limit: int = 50):
+    """
+    إرجاع آخر الأحداث (للاستخدام في الـ Dashboard) كقواميس بحقول EVENT_FIELDS.
+    """
+    return store.recent_events(limit)
@@ -0,0 +1,154 @@
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, Iterable, List, Tuple
+
+# ---------------------- البث المباشر للأحداث (Live feed) ---------------------- #
+#
+# حلقة (ring buffer) في الذاكرة بآخر الأحداث المحفوظة، كل حدث مُحوّل لـ JSON مرة واحدة:
+# - database.py ينشر الحدث بعد حفظه (مع الـ id من التخزين)
+# - كل مشترك (/events/stream) يقرأ من الحلقة ما بعد آخر id وصله،
+#   فعدد المحللين المفتوحين لا يضيف أي قراءة على جدول events
+# - مشترك تأخر أكثر من حجم الحلقة يكمل الفجوة من التخزين (events_since)
+# - الحلقة مرتبة بالـ id والمشتركون يتقدمون بالـ id، فالنشر لازم يكون بترتيب الـ id
+#   (StoreFollower مع تخزين مشترك)
+
+# عدد الأحداث المحفوظة في الحلقة
+EVENT_FEED_SIZE = int(os.environ.get("SND_EVENT_FEED_SIZE", "1000"))
+
+# كم ثانية ننتظر id ناقصاً قبل اعتباره لن يظهر (transaction ألغيت).
+# لازم تكون أطول من أطول transaction إدخال على التخزين المشترك
+EVENT_FEED_GAP_SECONDS = float(os.environ.get("SND_EVENT_FEED_GAP_SECONDS", "5"))
+
+
+class EventFeed:
+    """
+    بث داخل العملية: publish من threads الحفظ، والانتظار من threads (Flask)
+    أو من coroutines (ASGI).
+    """
+
+    def __init__(self, size: int = EVENT_FEED_SIZE):
+        self._ring: deque = deque(maxlen=size)  # (id, json)
+        self._cond = threading.Condition()
+        self._async_waiters: set = set()  # {(loop, asyncio.Event)}
+        self.last_id = 0
+        # الحلقة كاملة فقط لما بعد هذا الـ id: آخر id خرج منها،
+        # أو ما قبل أول حدث نُشر (أحداث حُفظت قبل تشغيل العملية)
+        self._evicted_id = 0
+
+    @staticmethod
+    def encode(event: Dict) -> str:
+        return json.dumps(event, ensure_ascii=False, sort_keys=True)
+
+    def publish(self, events: Iterable[Dict]) -> None:
+        with self._cond:
+            ring = self._ring
+            added = False
+            for event in events:
+                event_id = event["id"]
+                if event_id <= self.last_id:
+                    continue
+                if not ring:
+                    self._evicted_id = max(self._evicted_id, event_id - 1)
+                elif len(ring) == ring.maxlen:
+                    self._evicted_id = ring[0][0]
+                ring.append((event_id, self.encode(event)))
+                self.last_id = event_id
+                added = True
+            if not added:
+                return
+            self._cond.notify_all()
+            waiters = list(self._async_waiters)
+
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+
+    def since(self, last_id: int, limit: int = 500) -> Tuple[List[Tuple[int, str]], bool]:
+        """
+        ([(id, json), ...] بعد last_id من الأقدم للأحدث, فجوة؟).
+        الفجوة = أحداث بعد last_id خرجت من الحلقة (يجب إكمالها من التخزين).
+        """
+        with self._cond:
+            if self.last_id <= last_id:
+                return [], False
+            items = []
+            for item in reversed(self._ring):
+                if item[0] <= last_id:
+                    break
+                items.append(item)
+            gap = self._evicted_id > last_id
+        items.reverse()
+        return items[:limit], gap
+
+    def wait(self, last_id: int, timeout: float) -> bool:
+        """
+        انتظار حدث بعد last_id (thread). ترجع False عند انتهاء المهلة.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: self.last_id > last_id, timeout)
+
+    async def wait_async(self, last_id: int, timeout: float) -> bool:
+        """
+        نفس wait لكن بدون حجز thread (خدمة ASGI).
+        """
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._cond:
+            if self.last_id > last_id:
+                return True
+            self._async_waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._cond:
+                self._async_waiters.discard(waiter)
+
+
+class StoreFollower:
+    """
+    متابعة الأحداث الجديدة في تخزين مشترك ونشرها في الحلقة بترتيب الـ id.
+
+    PostgreSQL يعطي الـ id (BIGSERIAL) قبل الـ commit، فقد يظهر id أصغر بعد id أكبر
+    (transactions من عمليات أو عقد أخرى). لو نشرنا الأكبر فوراً لتجاوزه كل المشتركين
+    ولن يصلهم الأصغر أبداً. لذلك ننشر فقط الأحداث المتصلة بعد آخر id منشور، ونتوقف عند
+    أول id ناقص حتى يظهر أو تمر gap_seconds (عندها نعتبره ملغى ونتجاوزه).
+    """
+
+    def __init__(
+        self,
+        feed: EventFeed,
+        read: Callable[[int, int], List[Dict]],
+        gap_seconds: float = EVENT_FEED_GAP_SECONDS,
+        clock: Callable[[], float] = time.monotonic,
+    ):
+        self.feed = feed
+        self.read = read  # events_since(since_id, limit)
+        self.gap_seconds = gap_seconds
+        self.clock = clock
+        self._gaps: Dict[int, float] = {}  # أول id ناقص -> متى لاحظناه
+
+    def poll(self, limit: int = 500) -> int:
+        """
+        قراءة ما بعد آخر id منشور ونشر الجاهز منه. ترجع عدد الأحداث المنشورة.
+        """
+        expected = self.feed.last_id + 1
+        now = self.clock()
+        ready = []
+        for event in self.read(self.feed.last_id, limit):
+            if event["id"] > expected:
+                seen = self._gaps.setdefault(expected, now)
+                if now - seen < self.gap_seconds:
+                    break
+            ready.append(event)
+            expected = event["id"] + 1
+
+        for gap_id in [g for g in self._gaps if g < expected]:
+            del self._gaps[gap_id]
+        self.feed.publish(ready)
+        return len(ready)
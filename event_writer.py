@@ -0,0 +1,152 @@
+import atexit
+import queue
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+# ---------------------- إعدادات الكتابة المؤجلة ---------------------- #
+
+# أقصى عدد أحداث تنتظر الكتابة (بعدها insert_event ينتظر = backpressure)
+WRITE_BEHIND_MAX_QUEUE = 10000
+
+# أقصى عدد أحداث في transaction واحدة (group commit)
+WRITE_BEHIND_BATCH_SIZE = 500
+
+# أقصى مدة (ثواني) ينتظرها الحدث قبل أن يُكتب حتى لو الدفعة ما اكتملت
+WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+
+_STOP = object()
+
+
+class WriteBehindWriter:
+    """
+    كاتب في الخلفية: الأحداث تدخل طابور محدود، و thread واحد يكتبها
+    على دفعات (executemany + commit واحد) عند اكتمال الحجم أو انتهاء المهلة.
+
+    - flush_rows(rows): الدالة التي تكتب الدفعة فعلياً في قاعدة البيانات
+    - lock: يُمسك عند حذف الأحداث من قائمة "المعلّقة" بعد الكتابة (وليس أثناءها)
+    - user_of(row): استخراج user_id من السطر لقائمة المعلّقة لكل مستخدم
+    - begin_user / end_user (اختياري): قبل الكتابة وبعد حذفها من "المعلّقة" لكل مستخدم
+      في الدفعة (ProfileCache.begin_write / end_write حتى لا يُحسب الحدث مرتين
+      أو يضيع لو تزامن مع تحميل البصمة)
+    """
+
+    def __init__(
+        self,
+        flush_rows: Callable[[List[tuple]], None],
+        lock: threading.RLock,
+        user_of: Callable[[tuple], str] = lambda row: row[0],
+        max_queue: int = WRITE_BEHIND_MAX_QUEUE,
+        batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+        flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+        on_error: Optional[Callable[[List[tuple], Exception], None]] = None,
+        begin_user: Optional[Callable[[str], None]] = None,
+        end_user: Optional[Callable[[str], None]] = None,
+    ):
+        self.flush_rows = flush_rows
+        self.lock = lock
+        self.user_of = user_of
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.on_error = on_error
+        self.begin_user = begin_user
+        self.end_user = end_user
+
+        self._queue: "queue.Queue" = queue.Queue(maxsize=max_queue)
+        self._pending: Dict[str, List[tuple]] = {}
+        self._thread = threading.Thread(
+            target=self._run, name="snd-write-behind", daemon=True
+        )
+        self._stopped = False
+        self._thread.start()
+        atexit.register(self.stop)
+
+    # ---------- من جهة الطلب ---------- #
+
+    def register(self, row: tuple) -> None:
+        """
+        تسجيل الحدث كمعلّق (لازم يكون داخل self.lock وقبل submit).
+        """
+        self._pending.setdefault(self.user_of(row), []).append(row)
+
+    def submit(self, row: tuple) -> None:
+        """
+        إضافة الحدث للطابور. لو الطابور ممتلئ ننتظر (backpressure).
+        لازم تُستدعى خارج self.lock حتى لا نمنع الكاتب من التفريغ.
+        """
+        self._queue.put(row)
+
+    def pending_for(self, user_id: str) -> List[tuple]:
+        """
+        الأحداث التي لم تُكتب بعد لهذا المستخدم (لقراءة ما كتبناه قبل وصوله للقاعدة).
+        """
+        return list(self._pending.get(user_id, ()))
+
+    def pending_count(self) -> int:
+        return self._queue.qsize()
+
+    # ---------- الكتابة ---------- #
+
+    def _write(self, rows: List[tuple]) -> None:
+        if not rows:
+            return
+        users = {self.user_of(row) for row in rows}
+        if self.begin_user is not None:
+            for user_id in users:
+                self.begin_user(user_id)
+        error = None
+        try:
+            self.flush_rows(rows)
+        except Exception as e:
+            print(f"[write_behind] فشل حفظ {len(rows)} حدث: {e}")
+            error = e
+        finally:
+            with self.lock:
+                if error is not None and self.on_error is not None:
+                    self.on_error(rows, error)
+                for row in rows:
+                    user_rows = self._pending.get(self.user_of(row))
+                    if user_rows:
+                        user_rows.remove(row)
+                        if not user_rows:
+                            del self._pending[self.user_of(row)]
+                if self.end_user is not None:
+                    for user_id in users:
+                        self.end_user(user_id)
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is _STOP:
+                return
+
+            rows = [item]
+            deadline = time.monotonic() + self.flush_interval
+            stop = False
+            while len(rows) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    item = self._queue.get(timeout=remaining)
+                except queue.Empty:
+                    break
+                if item is _STOP:
+                    stop = True
+                    break
+                rows.append(item)
+
+            self._write(rows)
+            if stop:
+                return
+
+    def stop(self) -> None:
+        """
+        إيقاف الكاتب بعد تفريغ كل الأحداث الموجودة في الطابور (عند الإغلاق).
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        self._queue.put(_STOP)
+        self._thread.join()
+        atexit.unregister(self.stop)
@@ -0,0 +1,467 @@
+import argparse
+import atexit
+import fcntl
+import hashlib
+import json
+import os
+import shutil
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Optional, Sequence
+
+import numpy as np
+
+# ---------------------- مخزن الميزات العمودي (Feature store) ---------------------- #
+#
+# كل حدث يُقيَّم تُكتب ميزاته (FEATURE_KEYS) + بيانات الحدث كأعمدة NumPy
+# (ملف .npy لكل عمود) في segments للإضافة فقط:
+#
+#   features/
+#     manifest.json        ← الـ segments وعدد الصفوف الصالحة في كل واحد (يُستبدل ذرّياً)
+#     seg-.../<column>.npy
+#
+# - التدريب والتحليل يقرأون الأعمدة بـ np.memmap (بدون تحميل الملفات في ذاكرة Python
+#   وبدون إعادة حساب الميزات من جدول events)
+# - كل عملية تكتب في segment خاص بها؛ الصفوف تظهر للقراء فقط بعد تحديث manifest
+# - الـ segments الصغيرة تُدمج بـ: python -m feature_store compact
+#
+# الميزات float32: نفس الدقة التي تحوّل لها أشجار sklearn المصفوفة قبل التدريب.
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# تفعيل الكتابة أثناء التقييم (SND_FEATURE_STORE=1)
+FEATURE_STORE_ENABLED = os.environ.get("SND_FEATURE_STORE", "0") == "1"
+FEATURE_STORE_DIR = os.environ.get("SND_FEATURE_STORE_DIR", os.path.join(BASE_DIR, "features"))
+# عدد الصفوف المحجوزة في كل segment يكتبه الخادم
+FEATURE_SEGMENT_ROWS = int(os.environ.get("SND_FEATURE_SEGMENT_ROWS", "65536"))
+# كل كم ثانية تُكتب الصفوف المنتظرة في الذاكرة إلى الـ segment
+FEATURE_FLUSH_INTERVAL = float(os.environ.get("SND_FEATURE_FLUSH_INTERVAL", "1"))
+# حجم الـ segment الناتج عن الدمج
+FEATURE_COMPACT_ROWS = int(os.environ.get("SND_FEATURE_COMPACT_ROWS", "4194304"))
+
+MANIFEST_FILE = "manifest.json"
+LOCK_FILE = "manifest.lock"
+FORMAT_VERSION = 1
+
+# بيانات الحدث مع كل صف (بهذا الترتيب في append)
+META_COLUMNS = (
+    ("timestamp_ms", np.int64),
+    ("user_key", np.int64),  # hash ثابت لـ user_id (تجميع لكل مستخدم بدون نصوص)
+    ("risk_score", np.float32),
+    ("ai_risk_score", np.float32),
+    ("rules_score", np.float32),
+    ("decision", np.int8),  # رقم في DECISIONS (-1 = غير معروف)
+    ("stored", np.int8),  # 1 = الحدث محفوظ في events (نفس مجموعة تدريب القاعدة)
+)
+FEATURE_DTYPE = np.float32
+
+DECISIONS = ("Allow", "Alert", "Challenge", "Block")
+_DECISION_CODES = {name: i for i, name in enumerate(DECISIONS)}
+
+
+def user_key(user_id: str) -> int:
+    return int.from_bytes(
+        hashlib.blake2b(user_id.encode("utf-8"), digest_size=8).digest(), "little", signed=True
+    )
+
+
+def decision_code(decision: str) -> int:
+    return _DECISION_CODES.get(decision, -1)
+
+
+def _column_dtypes(feature_keys: Sequence[str]) -> Dict[str, np.dtype]:
+    dtypes = {name: np.dtype(dtype) for name, dtype in META_COLUMNS}
+    dtypes.update((key, np.dtype(FEATURE_DTYPE)) for key in feature_keys)
+    return dtypes
+
+
+def _segment_name(suffix: str = "") -> str:
+    return f"seg-{time.time_ns():020d}-{os.getpid()}{suffix}"
+
+
+def _owner_alive(pid: Optional[int]) -> bool:
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class FeatureStore:
+    """
+    قراءة المخزن + تحديث الـ manifest (مشترك بين الكاتب والدمج).
+    """
+
+    def __init__(self, root: str = FEATURE_STORE_DIR):
+        self.root = root
+
+    # ---------- الـ manifest ---------- #
+
+    def manifest(self) -> Dict:
+        try:
+            with open(os.path.join(self.root, MANIFEST_FILE), encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {"format": FORMAT_VERSION, "segments": []}
+
+    @contextmanager
+    def _locked_manifest(self) -> Iterator[Dict]:
+        """
+        قراءة → تعديل → استبدال ذرّي، تحت قفل ملف (عدة عمليات تكتب في نفس المجلد).
+        """
+        os.makedirs(self.root, exist_ok=True)
+        with open(os.path.join(self.root, LOCK_FILE), "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                manifest = self.manifest()
+                yield manifest
+                tmp_path = os.path.join(self.root, f".{MANIFEST_FILE}.{os.getpid()}.tmp")
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump(manifest, f, ensure_ascii=False, indent=1)
+                os.replace(tmp_path, os.path.join(self.root, MANIFEST_FILE))
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def update_segment(self, name: str, **fields) -> None:
+        with self._locked_manifest() as manifest:
+            for seg in manifest["segments"]:
+                if seg["name"] == name:
+                    seg.update(fields)
+                    return
+            manifest["segments"].append(dict(name=name, **fields))
+
+    # ---------- القراءة ---------- #
+
+    def segments(self) -> List[Dict]:
+        return [seg for seg in self.manifest()["segments"] if seg["rows"] > 0]
+
+    def __len__(self) -> int:
+        return sum(seg["rows"] for seg in self.segments())
+
+    def open_segment(self, seg: Dict, columns: Sequence[str]) -> Dict[str, Optional[np.ndarray]]:
+        """
+        {column: memmap بطول الصفوف الصالحة} بدون نسخ. عمود غير موجود في هذا
+        الـ segment (ميزة أُضيفت بعده) = None.
+        """
+        out = {}
+        for name in columns:
+            if name not in seg["columns"]:
+                out[name] = None
+                continue
+            path = os.path.join(self.root, seg["name"], f"{name}.npy")
+            out[name] = np.load(path, mmap_mode="r")[: seg["rows"]]
+        return out
+
+    def iter_segments(self, columns: Sequence[str]) -> Iterator[Dict[str, Optional[np.ndarray]]]:
+        for seg in self.segments():
+            yield self.open_segment(seg, columns)
+
+    def column(self, name: str) -> np.ndarray:
+        """
+        عمود كامل في مصفوفة واحدة (نسخة). للتحليل على أجزاء استخدم iter_segments.
+        """
+        parts = []
+        for seg in self.segments():
+            col = self.open_segment(seg, (name,))[name]
+            if col is None:
+                dtype = _column_dtypes((name,))[name]
+                col = np.zeros(seg["rows"], dtype=dtype)
+            parts.append(col)
+        if not parts:
+            return np.empty(0, dtype=_column_dtypes((name,))[name])
+        return np.concatenate(parts)
+
+    def matrix(
+        self,
+        keys: Sequence[str],
+        stored_only: bool = True,
+        max_rows: Optional[int] = None,
+        random_state: int = 42,
+    ) -> np.ndarray:
+        """
+        مصفوفة (n × len(keys)) float32 بترتيب Fortran (نفس ما تحوّل له أشجار sklearn)
+        تُملأ عموداً عموداً من الـ memmaps. الميزة الناقصة في segment = 0.
+        max_rows: عينة عشوائية منتظمة بدون تكرار (بدون قراءة الصفوف غير المختارة).
+        """
+        segs = []
+        for seg in self.segments():
+            mask = None
+            if stored_only:
+                mask = np.asarray(self.open_segment(seg, ("stored",))["stored"]) == 1
+            segs.append((seg, mask))
+        sizes = [seg["rows"] if mask is None else int(mask.sum()) for seg, mask in segs]
+        total = sum(sizes)
+
+        picked = None
+        if max_rows is not None and total > max_rows:
+            rng = np.random.default_rng(random_state)
+            picked = np.sort(rng.choice(total, size=max_rows, replace=False))
+
+        n_rows = total if picked is None else picked.size
+        X = np.zeros((n_rows, len(keys)), dtype=FEATURE_DTYPE, order="F")
+        offset = 0  # بين صفوف كل الـ segments المختارة
+        row = 0  # في X
+        for (seg, mask), size in zip(segs, sizes):
+            rows = np.flatnonzero(mask) if mask is not None else None
+            if picked is not None:
+                lo, hi = np.searchsorted(picked, (offset, offset + size))
+                local = picked[lo:hi] - offset
+                rows = local if rows is None else rows[local]
+            offset += size
+            count = size if rows is None else rows.size
+            if count == 0:
+                continue
+            cols = self.open_segment(seg, keys)
+            for j, key in enumerate(keys):
+                col = cols[key]
+                if col is not None:
+                    X[row:row + count, j] = col if rows is None else col[rows]
+            row += count
+        return X
+
+    # ---------- الدمج ---------- #
+
+    def compact(self, target_rows: int = FEATURE_COMPACT_ROWS) -> int:
+        """
+        دمج الـ segments المغلقة المتتالية (بنفس الأعمدة) في segments حتى target_rows
+        بحجم مطابق لعدد الصفوف. الكتّاب يستمرون أثناء الدمج؛ الاستبدال في الـ manifest
+        ذرّي والقراء الذين فتحوا الملفات القديمة يكملون عليها.
+        ترجع عدد الـ segments التي دُمجت.
+        """
+        closed = [
+            seg for seg in self.segments()
+            if seg.get("sealed") or not _owner_alive(seg.get("owner"))
+        ]
+
+        # مجموعات متتالية بنفس الأعمدة
+        groups: List[List[Dict]] = []
+        for seg in closed:
+            group = groups[-1] if groups else None
+            if (
+                group
+                and group[-1]["columns"] == seg["columns"]
+                and sum(s["rows"] for s in group) + seg["rows"] <= target_rows
+            ):
+                group.append(seg)
+            else:
+                groups.append([seg])
+        groups = [g for g in groups if len(g) > 1]
+
+        merged = 0
+        for group in groups:
+            columns = group[0]["columns"]
+            rows = sum(seg["rows"] for seg in group)
+            name = _segment_name("-c")
+            path = os.path.join(self.root, name)
+            os.makedirs(path)
+            for column, dtype in columns.items():
+                out = np.lib.format.open_memmap(
+                    os.path.join(path, f"{column}.npy"), mode="w+", dtype=np.dtype(dtype), shape=(rows,)
+                )
+                pos = 0
+                for seg in group:
+                    col = self.open_segment(seg, (column,))[column]
+                    out[pos:pos + col.size] = col
+                    pos += col.size
+                out.flush()
+                del out
+
+            names = {seg["name"] for seg in group}
+            with self._locked_manifest() as manifest:
+                current = {seg["name"] for seg in manifest["segments"]}
+                if not names <= current:
+                    # دمج آخر سبقنا لنفس الـ segments
+                    shutil.rmtree(path, ignore_errors=True)
+                    continue
+                segments = []
+                for seg in manifest["segments"]:
+                    if seg["name"] == group[0]["name"]:
+                        segments.append({
+                            "name": name, "rows": rows, "columns": columns,
+                            "sealed": True, "owner": None,
+                        })
+                    elif seg["name"] not in names:
+                        segments.append(seg)
+                manifest["segments"] = segments
+            for old in names:
+                shutil.rmtree(os.path.join(self.root, old), ignore_errors=True)
+            merged += len(group)
+        return merged
+
+
+class FeatureStoreWriter:
+    """
+    الكتابة من الخادم: append يضيف الصف لقائمة في الذاكرة فقط (مسار الطلب)،
+    و thread في الخلفية يكتب الصفوف في الـ segment الحالي ثم يحدّث الـ manifest.
+    """
+
+    def __init__(
+        self,
+        feature_keys: Sequence[str],
+        root: str = FEATURE_STORE_DIR,
+        segment_rows: int = FEATURE_SEGMENT_ROWS,
+        flush_interval: float = FEATURE_FLUSH_INTERVAL,
+    ):
+        self.store = FeatureStore(root)
+        self.feature_keys = list(feature_keys)
+        self.segment_rows = segment_rows
+        self.flush_interval = flush_interval
+        self.columns = _column_dtypes(self.feature_keys)
+
+        self._buffer: List[tuple] = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._segment: Optional[str] = None
+        self._maps: Dict[str, np.memmap] = {}
+        self._rows = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="snd-feature-store", daemon=True)
+        self._thread.start()
+        atexit.register(self.close)
+
+    def append(self, features: Dict, meta: tuple) -> None:
+        """
+        meta بترتيب META_COLUMNS.
+        """
+        row = meta + tuple(float(features.get(k, 0.0)) for k in self.feature_keys)
+        with self._lock:
+            self._buffer.append(row)
+
+    def _open_segment(self) -> None:
+        name = _segment_name()
+        path = os.path.join(self.store.root, name)
+        os.makedirs(path)
+        self._maps = {
+            column: np.lib.format.open_memmap(
+                os.path.join(path, f"{column}.npy"), mode="w+", dtype=dtype, shape=(self.segment_rows,)
+            )
+            for column, dtype in self.columns.items()
+        }
+        self._segment = name
+        self._rows = 0
+        self.store.update_segment(
+            name, rows=0, sealed=False, owner=os.getpid(),
+            columns={column: dtype.str for column, dtype in self.columns.items()},
+        )
+
+    def _seal(self) -> None:
+        if self._segment is None:
+            return
+        self.store.update_segment(self._segment, rows=self._rows, sealed=True)
+        self._segment = None
+        self._maps = {}
+
+    def flush(self) -> int:
+        with self._flush_lock:
+            with self._lock:
+                rows, self._buffer = self._buffer, []
+            if not rows:
+                return 0
+            names = list(self.columns)
+            data = list(zip(*rows))  # عمود لكل اسم بنفس ترتيب self.columns
+            pos = 0
+            while pos < len(rows):
+                if self._segment is None:
+                    self._open_segment()
+                n = min(len(rows) - pos, self.segment_rows - self._rows)
+                for name, values in zip(names, data):
+                    self._maps[name][self._rows:self._rows + n] = values[pos:pos + n]
+                for mm in self._maps.values():
+                    mm.flush()
+                self._rows += n
+                pos += n
+                # الصفوف تظهر للقراء بعد وصولها للملفات فقط
+                if self._rows >= self.segment_rows:
+                    self._seal()
+                else:
+                    self.store.update_segment(self._segment, rows=self._rows)
+            return len(rows)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"[feature_store] فشل كتابة الميزات: {e}")
+
+    def close(self) -> None:
+        if self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join()
+        self.flush()
+        with self._flush_lock:
+            self._seal()
+        atexit.unregister(self.close)
+
+
+# ---------------------- الكاتب الخاص بالخادم ---------------------- #
+
+_writer: Optional[FeatureStoreWriter] = None
+
+
+def enable_feature_store(feature_keys: Sequence[str], **kwargs) -> FeatureStoreWriter:
+    global _writer
+    if _writer is None:
+        _writer = FeatureStoreWriter(feature_keys, **kwargs)
+    return _writer
+
+
+def disable_feature_store() -> None:
+    global _writer
+    writer, _writer = _writer, None
+    if writer is not None:
+        writer.close()
+
+
+def record_scored_event(
+    features: Dict,
+    user_id: str,
+    timestamp_ms: int,
+    risk_score: float,
+    ai_risk_score: float,
+    rules_score: float,
+    decision: str,
+    stored: bool,
+) -> None:
+    """
+    يُستدعى بعد تقييم كل حدث (لا شيء لو المخزن غير مفعّل).
+    """
+    writer = _writer
+    if writer is None:
+        return
+    writer.append(features, (
+        timestamp_ms, user_key(user_id), risk_score, ai_risk_score, rules_score,
+        decision_code(decision), int(stored),
+    ))
+
+
+def _info(store: FeatureStore, print_fn: Callable = print) -> None:
+    segments = store.segments()
+    sealed = sum(1 for seg in segments if seg.get("sealed"))
+    print_fn(f"[feature_store] {store.root}: {len(store)} صف، {len(segments)} segment ({sealed} مغلق)")
+    for seg in segments:
+        state = "sealed" if seg.get("sealed") else f"open (pid {seg.get('owner')})"
+        print_fn(f"    {seg['name']}  rows={seg['rows']}  columns={len(seg['columns'])}  {state}")
+
+
+if __name__ == "__main__":
+    # python -m feature_store info
+    # python -m feature_store compact [--target-rows N]
+    parser = argparse.ArgumentParser(description="SND columnar feature store")
+    parser.add_argument("command", choices=("info", "compact"))
+    parser.add_argument("--dir", default=FEATURE_STORE_DIR)
+    parser.add_argument("--target-rows", type=int, default=FEATURE_COMPACT_ROWS)
+    args = parser.parse_args()
+
+    feature_store = FeatureStore(args.dir)
+    if args.command == "compact":
+        started = time.perf_counter()
+        merged = feature_store.compact(args.target_rows)
+        print(f"[feature_store] دُمج {merged} segment خلال {time.perf_counter() - started:.2f} ثانية")
+    _info(feature_store)
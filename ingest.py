@@ -0,0 +1,428 @@
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from collections import Counter
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from database import (
+    MAX_STORED_RISK_SCORE,
+    SQLiteEventStore,
+    _INSERT_EVENT_SQL,
+    _load_user_profile,
+    get_connection,
+    init_db,
+    release_connection,
+    store,
+)
+from feature_store import (
+    FEATURE_STORE_ENABLED,
+    disable_feature_store,
+    enable_feature_store,
+    record_scored_event,
+)
+from rollups import backfill_rollups
+from app.model import FEATURE_KEYS, evaluate_events
+from app.policy import get_policy
+from app.processing import Event, features_from_profile, parse_event
+from app.routes import ai_risk_from_raw
+
+# ---------------------- التحميل الجماعي (Bulk ingestion) ---------------------- #
+#
+# تحميل سجل تاريخي (CSV / JSONL، ويقبل .gz) مباشرة في التخزين بدل POST لكل حدث على /score:
+#
+#   python -m ingest history.jsonl more.csv.gz                 # حفظ كما هو (risk_score من الملف أو 0)
+#   python -m ingest history.jsonl --score --bad-rows bad.jsonl  # تقييم كامل عبر النموذج + السياسة
+#
+# - كل سطر يمر على parse_event (نفس تحقق وتطبيع /score)، والأسطر الخاطئة
+#   تُتخطى وتُعدّ حسب السبب (وتُكتب في --bad-rows لو طُلب)
+# - الحفظ على دفعات كبيرة (transaction واحدة لكل --batch-size سطر، executemany)
+# - SQLite: فهارس events و triggers التجميع تُحذف أثناء التحميل ثم تُعاد بنفس تعريفها
+#   + إعادة بناء جداول التجميع مرة واحدة (backfill_rollups) بدل تحديثها سطراً سطراً.
+#   الأفضل أثناء توقف الخدمة (--no-defer للتحميل على قاعدة تخدم طلبات)
+# - --score: الميزات تُبنى في لحظتها من بصمة في الذاكرة لكل مستخدم (تُحمّل من التخزين
+#   عند أول ظهور ثم تتحدث بالأحداث المحفوظة فقط، مثل insert_event)، والتقييم على موجات:
+#   الموجة فيها حدث واحد لكل مستخدم (نفس /score/batch) فالنتيجة مطابقة للتقييم حدثاً حدثاً
+#   بشرط أن الملف مرتب زمنياً لكل مستخدم. فهرس (user_id, timestamp_ms) لا يُؤجل مع --score
+#   لأن تحميل بصمة كل مستخدم موجود يقرأ نافذته منه
+
+# فهرس نافذة السرعة في _load_user_profile: يبقى أثناء التحميل مع --score
+# (بدونه تحميل بصمة كل مستخدم موجود = مسح كامل لجدول events)
+SCORING_INDEXES = ("idx_events_user_ts",)
+
+# عدد الأسطر في كل transaction
+INGEST_BATCH_SIZE = int(os.environ.get("SND_INGEST_BATCH_SIZE", "50000"))
+# كل كم سطر نطبع التقدّم
+INGEST_PROGRESS_ROWS = int(os.environ.get("SND_INGEST_PROGRESS_ROWS", "500000"))
+
+# أعمدة النتيجة في ملف مصدّر: تدخل في أعمدة events وليس في raw_payload
+_OUTCOME_FIELDS = ("timestamp_ms", "risk_score", "ai_risk_score", "rules_score", "decision", "id")
+
+
+class BadRow(ValueError):
+    pass
+
+
+# ---------- القراءة ---------- #
+
+def _open_text(path: str):
+    if path == "-":
+        return sys.stdin
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt", encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def read_records(path: str) -> Iterator[Tuple[int, object]]:
+    """
+    (رقم السطر, سجل) من ملف CSV أو JSONL. سطر JSON تالف يرجع كـ BadRow بدل السجل
+    حتى يُعدّ ويُتخطى بدون إيقاف التحميل.
+    """
+    name = path[:-3] if path.endswith(".gz") else path
+    f = _open_text(path)
+    try:
+        if name.endswith(".csv"):
+            # السطر 1 = العناوين
+            for line_no, record in enumerate(csv.DictReader(f), start=2):
+                yield line_no, record
+            return
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield line_no, json.loads(line)
+            except ValueError as exc:
+                yield line_no, BadRow(f"Invalid JSON: {exc}")
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+
+def _optional_float(record: Dict, field: str) -> Optional[float]:
+    value = record.get(field)
+    if value in (None, ""):
+        return None
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        raise BadRow(f"Invalid {field}: {value!r}")
+
+
+# ---------- الحفظ ---------- #
+
+class _BulkWriter:
+    """
+    حفظ الأسطر (بترتيب EVENT_COLUMNS) على دفعات، مع تأجيل الفهارس والـ triggers في SQLite.
+    keep: أسماء فهارس لا تُؤجل (قراءات أثناء التحميل تحتاجها).
+    """
+
+    def __init__(self, batch_size: int, defer: bool, keep: Tuple[str, ...] = ()):
+        self.batch_size = batch_size
+        self.rows: List[tuple] = []
+        self.written = 0
+        self.conn = None
+        self.deferred: List[Tuple[str, str]] = []  # (type, sql) لإعادة الإنشاء
+        self.keep = keep
+        if isinstance(store, SQLiteEventStore):
+            self.conn = get_connection(store.db_path)
+            if defer:
+                self._defer()
+
+    def _defer(self) -> None:
+        cur = self.conn.cursor()
+        # نفس تعريف الفهارس والـ triggers الموجودة على events (وليس قائمة ثابتة)
+        cur.execute(
+            """
+            SELECT type, name, sql FROM sqlite_master
+            WHERE tbl_name = 'events' AND type IN ('index', 'trigger') AND sql IS NOT NULL
+            """
+        )
+        found = [row for row in cur.fetchall() if row[1] not in self.keep]
+        for kind, name, _ in found:
+            cur.execute(f'DROP {kind.upper()} IF EXISTS "{name}"')
+        self.conn.commit()
+        self.deferred = [(kind, sql) for kind, _, sql in found]
+        if self.deferred:
+            print(f"[ingest] تأجيل {len(self.deferred)} فهرس/trigger حتى نهاية التحميل.")
+
+    def add(self, row: tuple) -> None:
+        self.rows.append(row)
+        if len(self.rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        rows, self.rows = self.rows, []
+        if not rows:
+            return
+        if self.conn is None:
+            store.insert_events(rows)
+        else:
+            self.conn.executemany(_INSERT_EVENT_SQL, rows)
+            self.conn.commit()
+        self.written += len(rows)
+
+    def finish(self) -> Dict[str, float]:
+        """
+        إعادة الفهارس والـ triggers + إعادة بناء جداول التجميع. ترجع مدة كل خطوة.
+        تُستدعى حتى لو فشل التحميل في المنتصف (الأحداث المحفوظة تبقى متسقة).
+        """
+        timings = {}
+        if self.conn is None:
+            return timings
+        try:
+            if self.deferred:
+                started = time.perf_counter()
+                cur = self.conn.cursor()
+                for kind, sql in self.deferred:
+                    if kind == "index":
+                        cur.execute(sql)
+                self.conn.commit()
+                timings["indexes_seconds"] = round(time.perf_counter() - started, 3)
+
+                started = time.perf_counter()
+                for kind, sql in self.deferred:
+                    if kind == "trigger":
+                        cur.execute(sql)
+                self.conn.commit()
+                if any(kind == "trigger" for kind, _ in self.deferred):
+                    backfill_rollups(self.conn)
+                timings["rollups_seconds"] = round(time.perf_counter() - started, 3)
+                self.deferred = []
+        finally:
+            release_connection(self.conn, store.db_path)
+            self.conn = None
+        return timings
+
+
+# ---------- التقييم ---------- #
+
+class _Scorer:
+    """
+    تقييم الأحداث بالنموذج الفعّال + السياسة على موجات (حدث واحد لكل مستخدم في الموجة).
+    """
+
+    def __init__(self):
+        self.policy = get_policy()
+        self.record = record_scored_event if FEATURE_STORE_ENABLED else None
+        if FEATURE_STORE_ENABLED:
+            enable_feature_store(FEATURE_KEYS)
+        self.profiles = {}
+
+    def _profile(self, user_id: str):
+        profile = self.profiles.get(user_id)
+        if profile is None:
+            # مرة واحدة لكل مستخدم: السجل قبل التحميل (الـ triggers مؤجلة أو لا، لا فرق)
+            profile = self.profiles[user_id] = _load_user_profile(user_id)
+        return profile
+
+    def score(self, chunk: List[Event]) -> List[Tuple[float, float, float, str]]:
+        """
+        (ai_risk_score, rules_score, risk_score, decision) لكل حدث بنفس ترتيب chunk.
+        """
+        waves: List[List[int]] = []
+        positions: Dict[str, int] = {}
+        for i, event in enumerate(chunk):
+            position = positions.get(event.user_id, 0)
+            positions[event.user_id] = position + 1
+            if position == len(waves):
+                waves.append([])
+            waves[position].append(i)
+
+        results = [None] * len(chunk)
+        for wave in waves:
+            features_list = [
+                features_from_profile(chunk[i], self._profile(chunk[i].user_id)) for i in wave
+            ]
+            ai_scores = [ai_risk_from_raw(r) for r in evaluate_events(features_list)]
+            rules_scores, risk_scores, decisions, _ = self.policy.evaluate_batch(
+                features_list, ai_scores
+            )
+            for j, i in enumerate(wave):
+                event = chunk[i]
+                risk = float(risk_scores[j])
+                results[i] = (ai_scores[j], float(rules_scores[j]), risk, str(decisions[j]))
+                # البصمة تتحدث بالأحداث المحفوظة فقط (نفس insert_event)
+                if risk <= MAX_STORED_RISK_SCORE:
+                    self._profile(event.user_id).apply_event(
+                        event.device, event.city, event.service,
+                        event.event_time, event.timestamp_ms, risk, event.day,
+                    )
+                if self.record is not None:
+                    self.record(
+                        features_list[j], event.user_id, event.timestamp_ms,
+                        risk, ai_scores[j], results[i][1], results[i][3],
+                        stored=risk <= MAX_STORED_RISK_SCORE,
+                    )
+        return results
+
+    def close(self) -> None:
+        if self.record is not None:
+            disable_feature_store()
+
+
+# ---------- التشغيل ---------- #
+
+def _event_row(event: Event, ai_risk_score, rules_score, risk_score, decision) -> tuple:
+    payload = {k: v for k, v in event.to_dict().items() if k not in _OUTCOME_FIELDS}
+    return (
+        event.user_id,
+        event.device,
+        event.city,
+        event.region,
+        event.os,
+        event.browser,
+        event.service,
+        event.event_time,
+        event.timestamp_ms,
+        risk_score,
+        ai_risk_score,
+        rules_score,
+        decision,
+        json.dumps(payload, ensure_ascii=False),
+    )
+
+
+def ingest_files(
+    paths: List[str],
+    score: bool = False,
+    batch_size: int = INGEST_BATCH_SIZE,
+    defer: bool = True,
+    bad_rows_path: Optional[str] = None,
+    default_decision: str = "Allow",
+) -> Dict:
+    """
+    تحميل الملفات بالترتيب وإرجاع تقرير (أعداد + سرعة + أسباب التخطي).
+    """
+    init_db()
+    report = {
+        "files": paths,
+        "read": 0,
+        "stored": 0,
+        "skipped": 0,
+        "not_stored_high_risk": 0,
+        "skip_reasons": Counter(),
+        "decisions": Counter(),
+    }
+    bad_rows = open(bad_rows_path, "w", encoding="utf-8") if bad_rows_path else None
+    scorer = _Scorer() if score else None
+    writer = _BulkWriter(batch_size, defer, keep=SCORING_INDEXES if score else ())
+    chunk: List[Event] = []
+    outcomes: List[tuple] = []  # بدون --score: النتيجة من الملف لكل حدث في chunk
+
+    def skip(path, line_no, record, reason, detail=None):
+        report["skipped"] += 1
+        report["skip_reasons"][reason] += 1
+        if bad_rows is not None:
+            bad_rows.write(json.dumps(
+                {"file": path, "line": line_no, "error": detail or reason,
+                 "record": None if isinstance(record, BadRow) else record},
+                ensure_ascii=False, default=str,
+            ) + "\n")
+
+    def store_chunk():
+        for event, (ai_risk, rules, risk, decision) in zip(
+            chunk, scorer.score(chunk) if scorer is not None else outcomes
+        ):
+            report["decisions"][decision] += 1
+            if risk > MAX_STORED_RISK_SCORE:
+                report["not_stored_high_risk"] += 1
+                continue
+            writer.add(_event_row(event, ai_risk, rules, risk, decision))
+        chunk.clear()
+        outcomes.clear()
+
+    started = time.perf_counter()
+    next_progress = INGEST_PROGRESS_ROWS
+    try:
+        for path in paths:
+            for line_no, record in read_records(path):
+                report["read"] += 1
+                if isinstance(record, BadRow):
+                    skip(path, line_no, record, "Invalid JSON", str(record))
+                    continue
+
+                event, message = parse_event(record)
+                if event is None:
+                    skip(path, line_no, record, message)
+                    continue
+
+                if scorer is None:
+                    # بدون تقييم: النتيجة من الملف لو موجودة (ملف مصدّر)، وإلا سجل نظيف
+                    try:
+                        risk = _optional_float(record, "risk_score")
+                        outcome = (
+                            _optional_float(record, "ai_risk_score"),
+                            _optional_float(record, "rules_score"),
+                            0.0 if risk is None else risk,
+                            str(record.get("decision") or default_decision),
+                        )
+                    except BadRow as exc:
+                        skip(path, line_no, record, str(exc).split(":")[0], str(exc))
+                        continue
+                    outcomes.append(outcome)
+
+                chunk.append(event)
+                if len(chunk) >= batch_size:
+                    store_chunk()
+
+                if report["read"] >= next_progress:
+                    next_progress += INGEST_PROGRESS_ROWS
+                    elapsed = time.perf_counter() - started
+                    print(f"[ingest] {report['read']} سطر ({report['read'] / elapsed:.0f} سطر/ثانية)")
+
+        store_chunk()
+        writer.flush()
+    finally:
+        if bad_rows is not None:
+            bad_rows.close()
+        if scorer is not None:
+            scorer.close()
+        load_seconds = time.perf_counter() - started
+        report.update(writer.finish())
+
+    elapsed = time.perf_counter() - started
+    report["stored"] = writer.written
+    report["load_seconds"] = round(load_seconds, 3)
+    report["seconds"] = round(elapsed, 3)
+    report["rows_per_second"] = round(report["read"] / elapsed, 1) if elapsed > 0 else None
+    report["skip_reasons"] = dict(report["skip_reasons"].most_common())
+    report["decisions"] = dict(sorted(report["decisions"].items()))
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SND bulk event ingestion")
+    parser.add_argument("files", nargs="+", help="ملفات CSV / JSONL (أو .gz، أو - للإدخال القياسي)")
+    parser.add_argument("--score", action="store_true",
+                        help="تقييم كل حدث بالنموذج والسياسة بدل أخذ النتيجة من الملف")
+    parser.add_argument("--batch-size", type=int, default=INGEST_BATCH_SIZE)
+    parser.add_argument("--no-defer", action="store_true",
+                        help="إبقاء الفهارس والـ triggers أثناء التحميل (قاعدة تخدم طلبات)")
+    parser.add_argument("--bad-rows", default=None, help="كتابة الأسطر المتخطاة مع السبب (JSONL)")
+    parser.add_argument("--default-decision", default="Allow",
+                        help="القرار المحفوظ بدون --score لو الملف بدون decision")
+    args = parser.parse_args()
+
+    report = ingest_files(
+        args.files,
+        score=args.score,
+        batch_size=args.batch_size,
+        defer=not args.no_defer,
+        bad_rows_path=args.bad_rows,
+        default_decision=args.default_decision,
+    )
+    print(
+        f"[ingest] {report['read']} سطر: {report['stored']} محفوظ، {report['skipped']} متخطى، "
+        f"{report['not_stored_high_risk']} عالي المخاطر لم يُحفظ — {report['seconds']} ثانية "
+        f"({report['rows_per_second']} سطر/ثانية)"
+    )
+    for key in ("indexes_seconds", "rollups_seconds"):
+        if key in report:
+            print(f"[ingest] {key}: {report[key]}")
+    if report["skip_reasons"]:
+        print(f"[ingest] أسباب التخطي: {report['skip_reasons']}")
+    if report["decisions"]:
+        print(f"[ingest] القرارات: {report['decisions']}")
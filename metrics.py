@@ -0,0 +1,210 @@
+import os
+import threading
+import time
+from bisect import bisect_left
+from typing import Dict, Iterable, Optional
+
+# ---------------------- إعدادات القياس ---------------------- #
+
+# SND_METRICS=0 يعطّل القياس بالكامل (كل الدوال تصبح no-op تقريباً)
+METRICS_ENABLED = os.environ.get("SND_METRICS", "1") == "1"
+
+# حدود الـ buckets بالثواني (من 50 ميكروثانية إلى 2.5 ثانية)
+LATENCY_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025,
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100)
+
+
+class Histogram:
+    """
+    histogram بسيط بصيغة Prometheus مع label واحد (مثل stage أو endpoint).
+    """
+
+    def __init__(self, name: str, help_text: str, label: str, buckets: Iterable[float]):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self.buckets = tuple(buckets)
+        self._series: Dict[str, list] = {}  # label -> [counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def observe(self, label_value: str, value: float) -> None:
+        idx = bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(label_value)
+            if series is None:
+                series = self._series[label_value] = [0] * (len(self.buckets) + 2)
+            if idx < len(self.buckets):
+                series[idx] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, list(v)) for k, v in self._series.items())
+        for label_value, series in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, series):
+                cumulative += n
+                lines.append(
+                    f'{self.name}_bucket{{{self.label}="{label_value}",le="{bound}"}} {cumulative}'
+                )
+            lines.append(f'{self.name}_bucket{{{self.label}="{label_value}",le="+Inf"}} {series[-1]}')
+            lines.append(f'{self.name}_sum{{{self.label}="{label_value}"}} {series[-2]}')
+            lines.append(f'{self.name}_count{{{self.label}="{label_value}"}} {series[-1]}')
+        return "\n".join(lines)
+
+
+class Counter:
+    """
+    عدّاد بصيغة Prometheus مع label واحد.
+    """
+
+    def __init__(self, name: str, help_text: str, label: str):
+        self.name = name
+        self.help_text = help_text
+        self.label = label
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, label_value: str, amount: float = 1) -> None:
+        with self._lock:
+            self._values[label_value] = self._values.get(label_value, 0) + amount
+
+    def render(self) -> str:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for label_value, value in items:
+            lines.append(f'{self.name}{{{self.label}="{label_value}"}} {value}')
+        return "\n".join(lines)
+
+
+# ---------------------- المقاييس المعرّفة ---------------------- #
+
+STAGE_LATENCY = Histogram(
+    "snd_stage_latency_seconds",
+    "Latency of each /score pipeline stage.",
+    label="stage",
+    buckets=LATENCY_BUCKETS,
+)
+REQUEST_LATENCY = Histogram(
+    "snd_request_latency_seconds",
+    "End-to-end request latency per endpoint.",
+    label="endpoint",
+    buckets=LATENCY_BUCKETS,
+)
+SQL_QUERIES = Histogram(
+    "snd_sql_queries_per_request",
+    "Number of SQL statements executed per request.",
+    label="endpoint",
+    buckets=QUERY_COUNT_BUCKETS,
+)
+DECISIONS = Counter(
+    "snd_decisions_total",
+    "Decisions returned by the decision layer.",
+    label="decision",
+)
+
+REGION_LOOKUPS = Counter(
+    "snd_region_lookups_total",
+    "City to region lookups by result (hit / miss).",
+    label="result",
+)
+
+ALL_METRICS = [STAGE_LATENCY, REQUEST_LATENCY, SQL_QUERIES, DECISIONS, REGION_LOOKUPS]
+
+
+# ---------------------- توقيت المراحل ---------------------- #
+
+class StageTimer:
+    """
+    توقيت مراحل متتالية:
+        timer = stage_timer()
+        ... validate ...
+        timer.lap("validate")
+        ... normalize ...
+        timer.lap("normalize")
+    كل lap يسجل الزمن منذ الـ lap السابق.
+    """
+
+    __slots__ = ("_last",)
+
+    def __init__(self):
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str) -> None:
+        now = time.perf_counter()
+        STAGE_LATENCY.observe(stage, now - self._last)
+        self._last = now
+
+
+class _NoopTimer:
+    __slots__ = ()
+
+    def lap(self, stage: str) -> None:
+        pass
+
+
+_NOOP_TIMER = _NoopTimer()
+
+
+def stage_timer():
+    return StageTimer() if METRICS_ENABLED else _NOOP_TIMER
+
+
+def record_decision(decision: str) -> None:
+    if METRICS_ENABLED:
+        DECISIONS.inc(decision)
+
+
+def record_region_lookup(hit: bool) -> None:
+    REGION_LOOKUPS.inc("hit" if hit else "miss")
+
+
+# ---------------------- قياس مستوى الطلب ---------------------- #
+
+_request = threading.local()
+
+
+def count_query(statement: str) -> None:
+    """
+    trace callback لاتصالات SQLite: يعدّ الاستعلامات في الطلب الحالي.
+    (السطور التي تبدأ بـ "--" هي أوامر داخل الـ triggers فلا نعدّها)
+    """
+    if not statement.startswith("--"):
+        _request.queries = getattr(_request, "queries", 0) + 1
+
+
+def begin_request() -> None:
+    if METRICS_ENABLED:
+        _request.started = time.perf_counter()
+        _request.queries = 0
+
+
+def end_request(endpoint: Optional[str]) -> None:
+    if not METRICS_ENABLED:
+        return
+    started = getattr(_request, "started", None)
+    if started is None:
+        return
+    endpoint = endpoint or "unknown"
+    REQUEST_LATENCY.observe(endpoint, time.perf_counter() - started)
+    SQL_QUERIES.observe(endpoint, getattr(_request, "queries", 0))
+    _request.started = None
+
+
+def observe_request(endpoint: str, seconds: float) -> None:
+    """
+    زمن طلب واحد مباشرة (خدمة ASGI: الطلبات المتزامنة تتشارك نفس الـ thread
+    فلا نستخدم begin_request / end_request، ولا نعدّ الاستعلامات لأنها في threads أخرى).
+    """
+    if METRICS_ENABLED:
+        REQUEST_LATENCY.observe(endpoint, seconds)
+
+
+def render_prometheus() -> str:
+    return "\n".join(m.render() for m in ALL_METRICS) + "\n"
@@ -0,0 +1,296 @@
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Callable, Dict, Optional, Tuple
+
+from sequences import ServiceTransitions
+from velocity import VelocityCounters
+
+# ---------------------- إعدادات الكاش ---------------------- #
+
+# أقصى عدد مستخدمين نحتفظ ببصمتهم في الذاكرة (LRU)
+PROFILE_CACHE_MAX_USERS = 10000
+
+# بعد كم ثانية بدون استخدام نعتبر البصمة قديمة ونعيد تحميلها (TTL)
+PROFILE_CACHE_TTL_SECONDS = 3600
+
+# حد "منخفض المخاطر": التعريف الوحيد (البصمة في الذاكرة + triggers التجميع في rollups
+# و storage_postgres + get_low_risk_event_count)
+LOW_RISK_THRESHOLD = 35
+
+# كم مرة نعيد تحميل البصمة لو تغيّرت بيانات المستخدم أثناء التحميل
+# (بعدها نرجع البصمة بدون حفظها في الكاش، والطلب القادم يعيد التحميل)
+PROFILE_LOAD_RETRIES = 3
+
+
+def sqlite_date(event_time: str) -> Optional[str]:
+    """
+    نفس ناتج date(event_time) في SQLite:
+    - لو فيه timezone نحوله إلى UTC أولاً
+    - لو النص غير صالح نرجع None (مثل NULL في SQLite)
+    """
+    try:
+        dt = datetime.fromisoformat(event_time)
+    except (TypeError, ValueError):
+        return None
+    return sqlite_day(dt)
+
+
+def sqlite_day(dt: datetime) -> str:
+    """
+    sqlite_date لوقت محلَّل مسبقاً (Event في app/processing.py).
+    """
+    if dt.tzinfo is not None:
+        dt = dt.astimezone(timezone.utc)
+    return dt.date().isoformat()
+
+
+class UserProfile:
+    """
+    البصمة السلوكية لمستخدم واحد في الذاكرة:
+    عدادات تراكمية + آخر حدث + عدادات النوافذ المنزلقة (velocity)
+    + انتقالات الخدمات (sequences).
+    """
+
+    __slots__ = (
+        "user_id",
+        "total_events",
+        "low_risk_count",
+        "active_days",
+        "city_counts",
+        "device_counts",
+        "service_counts",
+        "last_event",
+        "velocity",
+        "transitions",
+        "last_access",
+        "loaded_at",
+    )
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.total_events = 0
+        self.low_risk_count = 0
+        self.active_days: set = set()
+        self.city_counts: Dict[str, int] = {}
+        self.device_counts: Dict[str, int] = {}
+        self.service_counts: Dict[str, int] = {}
+        # (event_time_str, device, city, timestamp_ms) بنفس شكل get_last_event
+        self.last_event: Optional[Tuple[str, str, str, int]] = None
+        self.velocity = VelocityCounters()
+        self.transitions = ServiceTransitions()
+        self.last_access = time.monotonic()
+        self.loaded_at = self.last_access
+
+    # ---------- تحديث ---------- #
+
+    def apply_event(
+        self,
+        device: str,
+        city: str,
+        service: str,
+        event_time: str,
+        timestamp_ms: Optional[int],
+        risk_score: float,
+        day: Optional[str] = None,
+    ) -> None:
+        """
+        تحديث البصمة بحدث جديد تم حفظه (O(1) تقريباً).
+        day = sqlite_date(event_time) لو محسوب مسبقاً (بدون تحليل الوقت مرة ثانية).
+        """
+        self.total_events += 1
+        if risk_score <= LOW_RISK_THRESHOLD:
+            self.low_risk_count += 1
+
+        if day is None:
+            day = sqlite_date(event_time)
+        if day is not None:
+            self.active_days.add(day)
+
+        self.city_counts[city] = self.city_counts.get(city, 0) + 1
+        self.device_counts[device] = self.device_counts.get(device, 0) + 1
+        self.service_counts[service] = self.service_counts.get(service, 0) + 1
+
+        self.last_event = (event_time, device, city, timestamp_ms)
+        self.velocity.add(timestamp_ms)
+        self.transitions.add(service)
+
+    # ---------- قراءة ---------- #
+
+    def count_window(self, window: str, now_ms: int) -> int:
+        """
+        عدد الأحداث في النافذة ("5m" / "1h" / "24h" / "7d") المنتهية بوقت الحدث now_ms.
+        """
+        return self.velocity.count(window, now_ms)
+
+
+class _UserSync:
+    """
+    حالة مستخدم أثناء كتابة أو تحميل (تُحذف عندما لا يبقى أي منهما):
+    - writes: كتابات بدأت (begin_write) ولم تنتهِ
+    - loads: تحميلات جارية من القاعدة
+    - epoch: يزيد مع كل بداية/نهاية كتابة و on_insert، فالتحميل يعرف إن شيئاً تغيّر أثناءه
+    """
+
+    __slots__ = ("writes", "loads", "epoch")
+
+    def __init__(self):
+        self.writes = 0
+        self.loads = 0
+        self.epoch = 0
+
+
+class ProfileCache:
+    """
+    مخزن بصمات المستخدمين مع:
+    - تحميل كسول (lazy) من قاعدة البيانات عند أول وصول عن طريق loader
+    - إخلاء LRU عند تجاوز max_users
+    - TTL لإعادة التحميل إذا البصمة ما استُخدمت لفترة
+    - max_age_seconds (اختياري): إعادة التحميل بعد مدة من التحميل حتى لو مستخدمة
+      (تخزين مشترك بين عدة عقد: أحداث العقد الأخرى لا تمر على on_insert هنا)
+
+    الحفظ في القاعدة يتم خارج القفل: الكاتب يحيط الحفظ بـ begin_write / end_write،
+    والتحميل لا يدخل الكاش إلا إذا لم تتقاطع معه أي كتابة لنفس المستخدم
+    (وإلا يعاد التحميل) حتى لا يُحسب الحدث مرتين أو يضيع.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[str], UserProfile],
+        max_users: int = PROFILE_CACHE_MAX_USERS,
+        ttl_seconds: float = PROFILE_CACHE_TTL_SECONDS,
+        max_age_seconds: Optional[float] = None,
+    ):
+        self.loader = loader
+        self.max_users = max_users
+        self.ttl_seconds = ttl_seconds
+        self.max_age_seconds = max_age_seconds
+        self._profiles: "OrderedDict[str, UserProfile]" = OrderedDict()
+        self._sync: Dict[str, _UserSync] = {}
+        # يحمي القواميس فقط (لا يُمسك أثناء قراءة أو كتابة القاعدة)
+        self.lock = threading.RLock()
+
+    def get(self, user_id: str) -> UserProfile:
+        for _ in range(PROFILE_LOAD_RETRIES):
+            with self.lock:
+                profile = self._cached(user_id)
+                if profile is not None:
+                    return profile
+                sync = self._sync.get(user_id)
+                if sync is None:
+                    sync = self._sync[user_id] = _UserSync()
+                sync.loads += 1
+                clean = sync.writes == 0
+                epoch = sync.epoch
+
+            profile = None
+            try:
+                profile = self.loader(user_id)
+            finally:
+                with self.lock:
+                    sync.loads -= 1
+                    clean = clean and profile is not None and sync.epoch == epoch
+                    self._release(user_id, sync)
+                    # نفس القفل الذي فحصنا فيه: لا تدخل كتابة بين الفحص والحفظ في الكاش
+                    # (وتحميل آخر قد يكون سبقنا، الأحدث يكفي)
+                    if clean:
+                        profile.last_access = time.monotonic()
+                        self._profiles[user_id] = profile
+                        self._profiles.move_to_end(user_id)
+                        self._evict()
+            if clean:
+                return profile
+
+        # المستخدم يكتب باستمرار: نستخدم آخر تحميل لهذا الطلب فقط
+        # (قد يختلف بحدث قيد الحفظ) ولا نحفظه في الكاش
+        return profile
+
+    def _cached(self, user_id: str) -> Optional[UserProfile]:
+        now = time.monotonic()
+        profile = self._profiles.get(user_id)
+        if profile is None:
+            return None
+        if (
+            now - profile.last_access > self.ttl_seconds
+            or (self.max_age_seconds is not None
+                and now - profile.loaded_at > self.max_age_seconds)
+        ):
+            del self._profiles[user_id]
+            return None
+        self._profiles.move_to_end(user_id)
+        profile.last_access = now
+        return profile
+
+    def _release(self, user_id: str, sync: _UserSync) -> None:
+        if sync.writes == 0 and sync.loads == 0 and self._sync.get(user_id) is sync:
+            del self._sync[user_id]
+
+    def begin_write(self, user_id: str) -> None:
+        """
+        قبل حفظ حدث لهذا المستخدم في القاعدة (والحفظ نفسه خارج القفل).
+        """
+        with self.lock:
+            sync = self._sync.get(user_id)
+            if sync is None:
+                sync = self._sync[user_id] = _UserSync()
+            sync.writes += 1
+            sync.epoch += 1
+
+    def end_write(self, user_id: str) -> None:
+        """
+        بعد الحفظ (نجح أو فشل) و on_insert.
+        """
+        with self.lock:
+            sync = self._sync.get(user_id)
+            if sync is None:
+                return
+            sync.writes -= 1
+            sync.epoch += 1
+            self._release(user_id, sync)
+
+    def on_insert(
+        self,
+        user_id: str,
+        device: str,
+        city: str,
+        service: str,
+        event_time: str,
+        timestamp_ms: Optional[int],
+        risk_score: float,
+        day: Optional[str] = None,
+    ) -> None:
+        """
+        تُستدعى من insert_event بعد الحفظ.
+        لو المستخدم غير موجود بالكاش ما نسوي شيء: التحميل القادم سيقرأ الحدث من القاعدة
+        (وتحميل جارٍ الآن يُعاد لأنه قد لا يرى الحدث).
+        """
+        with self.lock:
+            sync = self._sync.get(user_id)
+            if sync is not None:
+                sync.epoch += 1
+            profile = self._profiles.get(user_id)
+            if profile is not None:
+                profile.apply_event(
+                    device, city, service, event_time, timestamp_ms, risk_score, day
+                )
+
+    def invalidate(self, user_id: Optional[str] = None) -> None:
+        with self.lock:
+            # التحميلات الجارية قرأت بيانات قبل الإبطال، فلا تدخل الكاش
+            if user_id is None:
+                self._profiles.clear()
+                for sync in self._sync.values():
+                    sync.epoch += 1
+            else:
+                self._profiles.pop(user_id, None)
+                sync = self._sync.get(user_id)
+                if sync is not None:
+                    sync.epoch += 1
+
+    def __len__(self) -> int:
+        return len(self._profiles)
+
+    def _evict(self) -> None:
+        while len(self._profiles) > self.max_users:
+            self._profiles.popitem(last=False)
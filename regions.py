@@ -0,0 +1,300 @@
+import csv
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+from collections import Counter
+from functools import lru_cache
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+# ---------------------- المدينة → المنطقة ---------------------- #
+#
+# مصدر واحد لتحويل المدينة إلى منطقة:
+# - جدول city_region بمفتاح مُطبَّع (PRIMARY KEY = فهرس مباشر)
+# - عند التشغيل يُحمّل الجدول كاملاً في dict، والبحث لكل حدث = dict + lru_cache
+# - تطبيع الأسماء العربية والإنجليزية (التشكيل، الهمزات، "ال" / "al-")
+# - عدّاد للمدن غير المعروفة لمعرفة النواقص في الـ gazetteer
+
+UNKNOWN_REGION = "unknown"
+
+# أقصى عدد أسماء (كما وصلت في الطلب) نحتفظ بنتيجتها في الكاش
+REGION_CACHE_SIZE = 50000
+
+# أقصى عدد أسماء مختلفة نتتبعها في عداد المدن غير المعروفة
+REGION_MISS_TRACK_LIMIT = 1000
+
+# كل كم ثانية نعيد قراءة الجدول في العمليات الشغالة (0 = بدون فحص دوري)
+REGION_RELOAD_INTERVAL = float(os.environ.get("SND_REGION_RELOAD_INTERVAL", "60"))
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS city_region (
+    name_key TEXT PRIMARY KEY,
+    name TEXT NOT NULL,
+    region TEXT NOT NULL
+) WITHOUT ROWID;
+"""
+
+# المدن الأساسية (تُضاف عند إنشاء الجدول لأول مرة)
+SEED_CITIES: List[Tuple[str, Tuple[str, ...]]] = [
+    ("central", ("Riyadh", "الرياض", "Buraydah", "بريدة", "Unaizah", "عنيزة",
+                 "Al Kharj", "الخرج", "Al Majmaah", "المجمعة")),
+    ("west", ("Jeddah", "جدة", "Makkah", "Mecca", "مكة", "مكة المكرمة",
+              "Madinah", "Medina", "المدينة", "المدينة المنورة",
+              "Taif", "الطائف", "Yanbu", "ينبع", "Rabigh", "رابغ")),
+    ("east", ("Dammam", "الدمام", "Khobar", "Al-Khobar", "الخبر", "Dhahran", "الظهران",
+              "Jubail", "الجبيل", "Qatif", "القطيف", "Al-Ahsa", "الأحساء",
+              "Hofuf", "الهفوف", "Hafar Al-Batin", "حفر الباطن")),
+    ("south", ("Abha", "أبها", "Khamis Mushait", "خميس مشيط", "Jazan", "Jizan", "جازان",
+               "Najran", "نجران", "Al Baha", "الباحة", "Bisha", "بيشة")),
+    ("north", ("Tabuk", "تبوك", "Hail", "Ha'il", "حائل", "Arar", "عرعر",
+               "Sakaka", "سكاكا", "Al-Jouf", "الجوف", "Qurayyat", "القريات")),
+]
+
+# ---------- التطبيع ---------- #
+
+# التشكيل + علامات القرآن + التطويل
+_DIACRITICS_RE = re.compile("[\u0610-\u061a\u064b-\u065f\u0670\u06d6-\u06ed\u0640]")
+_ARABIC_FORMS = str.maketrans({
+    "أ": "ا", "إ": "ا", "آ": "ا", "ٱ": "ا",
+    "ؤ": "و", "ئ": "ي", "ى": "ي", "ة": "ه",
+})
+# al-/el- وصيغها الشمسية (ad-, ar-, as-, ash-, at-, az-, an-, adh-, ath-)
+_LATIN_ARTICLE_RE = re.compile(r"\b(?:al|el|ad|adh|an|ar|as|ash|at|ath|az)-|\b(?:al|el)\s+")
+_APOSTROPHES_RE = re.compile("['`\u2019\u02bc]")
+_SEPARATORS_RE = re.compile(r"[\s\-_.,/]+")
+
+
+def normalize_city_name(name: Optional[str]) -> str:
+    """
+    "Al-Khobar" → "khobar"، "الخُبَر" → "خبر"، "مكة المكرمة" → "مكه مكرمه".
+    نفس الدالة للجدول وللبحث، فالمفتاح يتطابق مهما اختلفت الكتابة.
+    """
+    s = unicodedata.normalize("NFKC", name or "").casefold()
+    s = _DIACRITICS_RE.sub("", s).translate(_ARABIC_FORMS)
+    s = _LATIN_ARTICLE_RE.sub("", _APOSTROPHES_RE.sub("", s))
+
+    tokens = []
+    for token in _SEPARATORS_RE.split(s):
+        if not token:
+            continue
+        # "ال" التعريف (مع بقاء حرفين على الأقل)
+        if token.startswith("ال") and len(token) > 3:
+            token = token[2:]
+        tokens.append(token)
+    return " ".join(tokens)
+
+
+# ---------- الجدول ---------- #
+
+def create_city_region_table(cur: sqlite3.Cursor) -> bool:
+    """
+    إنشاء جدول city_region. ترجع True لو أُنشئ الآن (يحتاج seed).
+    الجدول القديم (name_ar / name_en) يُعاد تسميته إلى city_region_legacy
+    وتُنقل أسماؤه للجدول الجديد.
+    """
+    cur.execute(
+        "SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'city_region'"
+    )
+    row = cur.fetchone()
+    if row is not None and "name_key" not in row[0]:
+        # نسخة قديمة من الجدول بأعمدة name_ar / name_en: ننقل بياناتها للشكل الجديد
+        cur.execute("ALTER TABLE city_region RENAME TO city_region_legacy")
+        cur.execute(_SCHEMA)
+        cur.execute("SELECT name_ar, name_en, region FROM city_region_legacy")
+        legacy = cur.fetchall()
+        # المدن الأساسية أولاً ثم بيانات الجدول القديم فوقها
+        seed_city_regions(cur)
+        upsert_city_regions(
+            cur,
+            ((region, name) for name_ar, name_en, region in legacy
+             for name in (name_ar, name_en) if name and region),
+        )
+        return False
+
+    cur.execute(_SCHEMA)
+    return row is None
+
+
+def city_region_records(rows: Iterable[Tuple[str, str]]) -> List[Tuple[str, str, str]]:
+    """
+    (region, name) → [(name_key, name, region), ...] بدون تكرار للمفتاح (الأخير يفوز).
+    """
+    records = {}
+    for region, name in rows:
+        key = normalize_city_name(name)
+        region = (region or "").strip()
+        if key and region:
+            records[key] = (key, name.strip(), region)
+    return list(records.values())
+
+
+def seed_rows() -> List[Tuple[str, str]]:
+    return [(region, name) for region, names in SEED_CITIES for name in names]
+
+
+def upsert_city_regions(cur: sqlite3.Cursor, rows: Iterable[Tuple[str, str]]) -> int:
+    """
+    إضافة/تحديث (region, name) في الجدول بمفتاح مُطبَّع. ترجع عدد الأسماء.
+    """
+    records = city_region_records(rows)
+    cur.executemany(
+        """
+        INSERT INTO city_region (name_key, name, region)
+        VALUES (?, ?, ?)
+        ON CONFLICT (name_key) DO UPDATE SET
+            name = excluded.name,
+            region = excluded.region
+        """,
+        records,
+    )
+    return len(records)
+
+
+def seed_city_regions(cur: sqlite3.Cursor) -> int:
+    return upsert_city_regions(cur, seed_rows())
+
+
+def read_gazetteer(path: str) -> List[Tuple[str, str]]:
+    """
+    قراءة gazetteer بصيغة CSV (بعنوان أعمدة):
+        region,name_ar,name_en,aliases
+        central,الرياض,Riyadh,Ar-Riyadh|Riyad
+    الأعمدة name_ar / name_en / name / aliases كلها اختيارية (aliases مفصولة بـ |).
+    ترجع [(region, name), ...].
+    """
+    rows = []
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        reader = csv.DictReader(f)
+        if not reader.fieldnames or "region" not in reader.fieldnames:
+            raise ValueError(f"{path}: missing 'region' column")
+        for record in reader:
+            region = (record.get("region") or "").strip()
+            names = [record.get(col) for col in ("name", "name_ar", "name_en")]
+            names += (record.get("aliases") or "").split("|")
+            rows.extend((region, n) for n in names if n and n.strip())
+    return rows
+
+
+# ---------- البحث في الذاكرة ---------- #
+
+class RegionResolver:
+    """
+    loader(): يرجع {name_key: region} من الجدول (يُستدعى مرة واحدة ثم عند refresh).
+    resolve(city) = lru_cache على الاسم الخام → تطبيع → dict.
+
+    الجدول والكاش الخاص به يُنشران معاً بإسناد مرجع واحد، فنتيجة من جدول قديم
+    لا تدخل كاش الجدول الجديد. عدّادات المدن غير المعروفة تحت self._lock.
+    """
+
+    def __init__(
+        self,
+        loader: Callable[[], Dict[str, str]],
+        cache_size: int = REGION_CACHE_SIZE,
+        on_lookup: Optional[Callable[[bool], None]] = None,
+    ):
+        self.loader = loader
+        self.cache_size = cache_size
+        self.on_lookup = on_lookup
+        self._regions: Optional[Dict[str, str]] = None
+        self._lookup: Optional[Callable[[str], Tuple[str, str]]] = None
+        self._lock = threading.Lock()
+        self._reloader: Optional[threading.Thread] = None
+        self.misses = 0
+        self.miss_names: Counter = Counter()
+
+    def _make_lookup(self, regions: Dict[str, str]) -> Callable[[str], Tuple[str, str]]:
+        def lookup(city: str) -> Tuple[str, str]:
+            # (المنطقة، المفتاح المُطبَّع) حتى تُعدّ المدن غير المعروفة في resolve لكل طلب
+            key = normalize_city_name(city)
+            return regions.get(key, UNKNOWN_REGION), key
+
+        return lru_cache(maxsize=self.cache_size)(lookup)
+
+    def _get_lookup(self) -> Callable[[str], Tuple[str, str]]:
+        lookup = self._lookup
+        if lookup is None:
+            with self._lock:
+                if self._lookup is None:
+                    self._regions = self.loader()
+                    self._lookup = self._make_lookup(self._regions)
+                lookup = self._lookup
+        return lookup
+
+    def resolve(self, city: Optional[str]) -> str:
+        region, key = self._get_lookup()(city or "")
+        hit = region != UNKNOWN_REGION
+        if not hit:
+            with self._lock:
+                self.misses += 1
+                if key and (key in self.miss_names or len(self.miss_names) < REGION_MISS_TRACK_LIMIT):
+                    self.miss_names[key] += 1
+        if self.on_lookup is not None:
+            self.on_lookup(hit)
+        return region
+
+    def refresh(self) -> bool:
+        """
+        إعادة تحميل الجدول (بعد تحميل gazetteer جديد مثلاً).
+        ترجع True لو تغيّر الجدول (وعندها فقط يُفرّغ الكاش).
+        """
+        regions = self.loader()
+        with self._lock:
+            if regions == self._regions:
+                return False
+            self._regions = regions
+            self._lookup = self._make_lookup(regions)
+        return True
+
+    def _reload_loop(self, interval: float) -> None:
+        while True:
+            time.sleep(interval)
+            try:
+                if self.refresh():
+                    print(f"[regions] تم تحديث جدول المناطق ({len(self._regions)} اسم)")
+            except Exception as e:
+                print(f"[regions] فشل تحديث جدول المناطق، نكمل بالحالي: {e}")
+
+    def start_reloader(self, interval: float = REGION_RELOAD_INTERVAL) -> None:
+        """
+        فحص دوري للجدول في الخلفية: gazetteer جديد (python -m regions load)
+        يصل للعمليات الشغالة بدون إعادة تشغيل.
+        """
+        if interval <= 0 or self._reloader is not None:
+            return
+        self._reloader = threading.Thread(
+            target=self._reload_loop, args=(interval,), name="snd-region-reloader", daemon=True
+        )
+        self._reloader.start()
+
+    def top_misses(self, n: int = 20) -> List[Tuple[str, int]]:
+        """
+        أكثر الأسماء (المُطبَّعة) التي لم نجد لها منطقة.
+        """
+        with self._lock:
+            return self.miss_names.most_common(n)
+
+
+if __name__ == "__main__":
+    # تحميل gazetteer كامل إلى قاعدة البيانات:
+    # python -m regions load gazetteer.csv
+    from database import init_db, store
+
+    if len(sys.argv) != 3 or sys.argv[1] != "load":
+        print("usage: python -m regions load <gazetteer.csv>")
+        sys.exit(2)
+
+    init_db()
+    started = time.perf_counter()
+    rows = read_gazetteer(sys.argv[2])
+    count = store.upsert_city_regions(rows)
+    print(
+        f"[regions] تم تحميل {count} اسم ({store.name}) "
+        f"خلال {time.perf_counter() - started:.2f} ثانية"
+    )
+    print(
+        f"[regions] الخدمة الشغالة تلتقط التحديث خلال {REGION_RELOAD_INTERVAL:g} ثانية "
+        f"(SND_REGION_RELOAD_INTERVAL، أو أعد تشغيلها لو 0)"
+    )
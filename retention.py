@@ -0,0 +1,293 @@
+import argparse
+import glob
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime, timezone
+from typing import Dict, List, Optional, Tuple
+
+from rollups import compact_events
+from velocity import LONGEST_WINDOW_MS
+
+# ---------------------- الاحتفاظ بالأحداث (Retention) ---------------------- #
+#
+# جدول events يبقى "ساخن": فيه الأحداث الحديثة فقط (ما تحتاجه نوافذ السرعة،
+# آخر حدث لكل مستخدم، /events، والتدريب على الفترة الحالية).
+# الأحداث الأقدم من RETENTION_DAYS:
+#   1) تُنسخ إلى ملف أرشيف شهري مستقل: archive/events_YYYY_MM.db
+#      (نسخ احتياطي / حذف / نقل شهر كامل = ملف واحد، بدون VACUUM للقاعدة الرئيسية)
+#   2) مجاميعها تُضاف إلى compacted_* (rollups.py) حتى تبقى backfill_rollups صحيحة
+#   3) تُحذف من events على دفعات صغيرة (كل دفعة transaction قصيرة، فالكتابة الحية لا تتوقف)
+# جداول التجميع (user_stats ...) لا تتغير: هي أصلاً تحتوي هذه الأحداث،
+# فالميزات لا تتأثر. آخر حدث لكل مستخدم لا يُحذف أبداً (user_stats.last_event_id).
+#
+# التشغيل (خارج أوقات الذروة):
+#   python -m retention                 # أرشفة + حذف الأقدم من 90 يوم
+#   python -m retention --mode delete   # حذف بدون أرشيف (المجاميع تبقى)
+#   python -m retention --dry-run       # عدد الأحداث المتأثرة لكل شهر فقط
+
+RETENTION_DAYS = int(os.environ.get("SND_RETENTION_DAYS", "90"))
+RETENTION_BATCH_SIZE = int(os.environ.get("SND_RETENTION_BATCH_SIZE", "5000"))
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ARCHIVE_DIR = os.environ.get("SND_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
+
+_DAY_MS = 24 * 3600 * 1000
+
+# أقل فترة احتفاظ مسموحة = أكبر نافذة سرعة (طوابعها تُحمّل من events) + يوم احتياط
+MIN_RETENTION_DAYS = LONGEST_WINDOW_MS // _DAY_MS + 1
+
+_EVENT_COLUMNS = (
+    "id, user_id, device, city, region, os, browser, service, event_time, "
+    "timestamp_ms, risk_score, ai_risk_score, rules_score, decision, raw_payload"
+)
+
+_ARCHIVE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS {schema}.events (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    device TEXT NOT NULL,
+    city TEXT NOT NULL,
+    region TEXT,
+    os TEXT,
+    browser TEXT,
+    service TEXT NOT NULL,
+    event_time TEXT NOT NULL,
+    timestamp_ms INTEGER,
+    risk_score REAL NOT NULL,
+    ai_risk_score REAL,
+    rules_score REAL,
+    decision TEXT NOT NULL,
+    raw_payload TEXT
+);
+CREATE INDEX IF NOT EXISTS {schema}.idx_events_user_ts ON events (user_id, timestamp_ms);
+"""
+
+
+def month_bounds(timestamp_ms: int) -> Tuple[str, int, int]:
+    """
+    الشهر (UTC) الذي يقع فيه timestamp_ms: ("2025_01", بدايته, بداية الشهر التالي).
+    """
+    dt = datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc)
+    start = datetime(dt.year, dt.month, 1, tzinfo=timezone.utc)
+    if dt.month == 12:
+        end = datetime(dt.year + 1, 1, 1, tzinfo=timezone.utc)
+    else:
+        end = datetime(dt.year, dt.month + 1, 1, tzinfo=timezone.utc)
+    return (
+        f"{dt.year:04d}_{dt.month:02d}",
+        int(start.timestamp() * 1000),
+        int(end.timestamp() * 1000),
+    )
+
+
+def archive_path(month: str, archive_dir: Optional[str] = None) -> str:
+    return os.path.join(archive_dir or ARCHIVE_DIR, f"events_{month}.db")
+
+
+def _select_batch(cur: sqlite3.Cursor, start_ms: int, end_ms: int, limit: int) -> int:
+    """
+    تعبئة temp.retention_batch بدفعة من أحداث الشهر (بدون آخر حدث لكل مستخدم).
+    """
+    cur.execute("DELETE FROM temp.retention_batch")
+    cur.execute(
+        """
+        INSERT INTO temp.retention_batch (id)
+        SELECT id FROM main.events
+        WHERE timestamp_ms >= ? AND timestamp_ms < ?
+          AND id NOT IN (SELECT last_event_id FROM user_stats WHERE last_event_id IS NOT NULL)
+        ORDER BY id
+        LIMIT ?
+        """,
+        (start_ms, end_ms, limit),
+    )
+    return cur.rowcount
+
+
+def _expire_month(
+    conn: sqlite3.Connection,
+    month: str,
+    start_ms: int,
+    end_ms: int,
+    archive: bool,
+    drop_payload: bool,
+    batch_size: int,
+    archive_dir: Optional[str],
+) -> int:
+    cur = conn.cursor()
+    if archive:
+        os.makedirs(archive_dir or ARCHIVE_DIR, exist_ok=True)
+        cur.execute("ATTACH DATABASE ? AS arch", (archive_path(month, archive_dir),))
+        cur.executescript(_ARCHIVE_SCHEMA.format(schema="arch"))
+
+    columns = ", ".join(
+        "NULL" if drop_payload and col == "raw_payload" else f"e.{col}"
+        for col in _EVENT_COLUMNS.split(", ")
+    )
+    moved = 0
+    try:
+        while _select_batch(cur, start_ms, end_ms, batch_size) > 0:
+            if archive:
+                # الأرشيف أولاً وبـ OR IGNORE: لو توقف التشغيل بين الخطوتين،
+                # إعادة التشغيل لا تكرر الأحداث في الأرشيف
+                cur.execute(
+                    f"""
+                    INSERT OR IGNORE INTO arch.events ({_EVENT_COLUMNS})
+                    SELECT {columns}
+                    FROM main.events e
+                    JOIN temp.retention_batch b ON b.id = e.id
+                    """
+                )
+                conn.commit()
+
+            # المجاميع + الحذف في نفس transaction على القاعدة الرئيسية
+            compact_events(cur, "temp.retention_batch")
+            cur.execute(
+                "DELETE FROM main.events WHERE id IN (SELECT id FROM temp.retention_batch)"
+            )
+            moved += cur.rowcount
+            conn.commit()
+    finally:
+        if archive:
+            conn.commit()
+            cur.execute("DETACH DATABASE arch")
+    return moved
+
+
+def expire_events(
+    db_path: str,
+    keep_days: int = RETENTION_DAYS,
+    mode: str = "archive",
+    drop_payload: bool = False,
+    batch_size: int = RETENTION_BATCH_SIZE,
+    archive_dir: Optional[str] = None,
+    now_ms: Optional[int] = None,
+    dry_run: bool = False,
+) -> Dict[str, int]:
+    """
+    تطبيق سياسة الاحتفاظ على events: كل حدث أقدم من keep_days
+    (بالنسبة لـ now_ms، أو آخر حدث في القاعدة لو لم يُحدد) يُؤرشف (mode="archive")
+    أو يُحذف فقط (mode="delete"). ترجع {"YYYY_MM": عدد الأحداث}.
+    """
+    if keep_days < MIN_RETENTION_DAYS:
+        raise ValueError(
+            f"keep_days={keep_days} أقل من أكبر نافذة سرعة ({MIN_RETENTION_DAYS} يوم)"
+        )
+    if mode not in ("archive", "delete"):
+        raise ValueError(f"unknown retention mode: {mode}")
+
+    # اتصال مستقل (ATTACH / DETACH لا تُترك على اتصالات الـ pool)
+    conn = sqlite3.connect(db_path, timeout=30.0)
+    try:
+        cur = conn.cursor()
+        if now_ms is None:
+            cur.execute("SELECT MAX(timestamp_ms) FROM events")
+            now_ms = cur.fetchone()[0]
+            if now_ms is None:
+                return {}
+        cutoff_ms = now_ms - keep_days * _DAY_MS
+
+        cur.execute("SELECT MIN(timestamp_ms) FROM events WHERE timestamp_ms < ?", (cutoff_ms,))
+        oldest = cur.fetchone()[0]
+        if oldest is None:
+            return {}
+
+        cur.execute("CREATE TEMP TABLE IF NOT EXISTS retention_batch (id INTEGER PRIMARY KEY)")
+        conn.commit()
+
+        report: Dict[str, int] = {}
+        ts = oldest
+        while ts < cutoff_ms:
+            month, start_ms, end_ms = month_bounds(ts)
+            end_ms = min(end_ms, cutoff_ms)
+            if dry_run:
+                count = _select_batch(cur, start_ms, end_ms, -1)
+                conn.rollback()
+            else:
+                count = _expire_month(
+                    conn, month, start_ms, end_ms,
+                    archive=(mode == "archive"),
+                    drop_payload=drop_payload,
+                    batch_size=batch_size,
+                    archive_dir=archive_dir,
+                )
+            if count:
+                report[month] = count
+            ts = end_ms
+        return report
+    finally:
+        conn.close()
+
+
+def archive_files(archive_dir: Optional[str] = None) -> List[str]:
+    return sorted(glob.glob(os.path.join(archive_dir or ARCHIVE_DIR, "events_*.db")))
+
+
+def attach_archives(
+    conn: sqlite3.Connection,
+    months: Optional[List[str]] = None,
+    archive_dir: Optional[str] = None,
+) -> str:
+    """
+    ربط ملفات الأرشيف الشهرية بالاتصال + TEMP VIEW events_all
+    (events الساخن + الأرشيف) للتحليل أو التدريب على فترة أطول.
+    months: ["2025_01", ...] أو None لكل الملفات. ترجع اسم الـ view.
+    ملاحظة: SQLite يحدّ عدد قواعد ATTACH (الافتراضي 10) فالأفضل تحديد الأشهر.
+    """
+    paths = archive_files(archive_dir)
+    if months is not None:
+        wanted = {archive_path(m, archive_dir) for m in months}
+        paths = [p for p in paths if p in wanted]
+
+    selects = [f"SELECT {_EVENT_COLUMNS} FROM main.events"]
+    for i, path in enumerate(paths):
+        schema = f"archive_{i}"
+        conn.execute("ATTACH DATABASE ? AS " + schema, (path,))
+        selects.append(f"SELECT {_EVENT_COLUMNS} FROM {schema}.events")
+
+    conn.execute("DROP VIEW IF EXISTS temp.events_all")
+    conn.execute("CREATE TEMP VIEW events_all AS " + " UNION ALL ".join(selects))
+    return "events_all"
+
+
+if __name__ == "__main__":
+    from database import init_db, sqlite_db_path
+
+    parser = argparse.ArgumentParser(description="SND event retention")
+    parser.add_argument("--keep-days", type=int, default=RETENTION_DAYS)
+    parser.add_argument("--mode", choices=("archive", "delete"), default="archive")
+    parser.add_argument("--drop-payload", action="store_true",
+                        help="archive without raw_payload")
+    parser.add_argument("--batch-size", type=int, default=RETENTION_BATCH_SIZE)
+    parser.add_argument("--archive-dir", default=ARCHIVE_DIR)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+
+    try:
+        db_path = sqlite_db_path()
+    except ValueError as e:
+        print(f"[retention] {e}")
+        sys.exit(2)
+
+    # init_db يضمن وجود جداول compacted_* على القواعد القديمة
+    init_db()
+    started = time.perf_counter()
+    print(f"[retention] {db_path}: الاحتفاظ بآخر {args.keep_days} يوم ({args.mode})")
+    report = expire_events(
+        db_path,
+        keep_days=args.keep_days,
+        mode=args.mode,
+        drop_payload=args.drop_payload,
+        batch_size=args.batch_size,
+        archive_dir=args.archive_dir,
+        dry_run=args.dry_run,
+    )
+    for month, count in report.items():
+        target = archive_path(month, args.archive_dir) if args.mode == "archive" else "-"
+        print(f"[retention]   {month}: {count} حدث → {target}")
+    print(
+        f"[retention] تم خلال {time.perf_counter() - started:.2f} ثانية، "
+        f"المجموع: {sum(report.values())} حدث"
+        + (" (dry run)" if args.dry_run else "")
+    )
@@ -0,0 +1,397 @@
+import sqlite3
+import sys
+import time
+
+from profile_cache import LOW_RISK_THRESHOLD
+
+# ---------------------- جداول التجميع (Rollups) ---------------------- #
+#
+# بدل حساب COUNT(DISTINCT date(event_time)) و COUNT(*) لكل مدينة/جهاز/خدمة
+# على كامل سجل المستخدم، نحتفظ بجداول تجميع صغيرة تُحدَّث مع كل INSERT
+# (عن طريق trigger داخل نفس الـ transaction) وتُقرأ بفهرس مباشرة.
+# low_risk_count يستخدم نفس LOW_RISK_THRESHOLD الذي تعدّ به البصمة في الذاكرة.
+
+ROLLUP_TABLES = (
+    "user_stats",
+    "user_daily_stats",
+    "user_city_counts",
+    "user_device_counts",
+    "user_service_counts",
+    "user_service_ngrams",
+    "user_service_tail",
+)
+
+_SCHEMA = [
+    # إجماليات المستخدم + آخر حدث
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id TEXT PRIMARY KEY,
+        total_events INTEGER NOT NULL DEFAULT 0,
+        low_risk_count INTEGER NOT NULL DEFAULT 0,
+        max_ts INTEGER,
+        last_event_id INTEGER
+    );
+    """,
+    # عدد الأحداث لكل يوم (avg_daily_events = total_events / عدد الأيام)
+    """
+    CREATE TABLE IF NOT EXISTS user_daily_stats (
+        user_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_city_counts (
+        user_id TEXT NOT NULL,
+        city TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, city)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_device_counts (
+        user_id TEXT NOT NULL,
+        device TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, device)
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_service_counts (
+        user_id TEXT NOT NULL,
+        service TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, service)
+    );
+    """,
+    # انتقالات الخدمات (sequences.py): prev2 = '' → bigram (prev1 → service)،
+    # غير ذلك trigram (prev2 → prev1 → service)
+    """
+    CREATE TABLE IF NOT EXISTS user_service_ngrams (
+        user_id TEXT NOT NULL,
+        prev2 TEXT NOT NULL,
+        prev1 TEXT NOT NULL,
+        service TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, prev2, prev1, service)
+    ) WITHOUT ROWID;
+    """,
+    # آخر خدمتين لكل مستخدم (بدل ORDER BY id DESC على سجله مع كل INSERT)
+    """
+    CREATE TABLE IF NOT EXISTS user_service_tail (
+        user_id TEXT PRIMARY KEY,
+        last_service TEXT NOT NULL,
+        prev_service TEXT
+    );
+    """,
+    # ما تم ضغطه من أحداث حذفتها سياسة الاحتفاظ (retention.py):
+    # الأحداث الخام تُحذف لكن مجاميعها تبقى هنا حتى تقدر backfill_rollups
+    # تعيد بناء جداول التجميع بدون فقد التاريخ القديم
+    """
+    CREATE TABLE IF NOT EXISTS compacted_user_stats (
+        user_id TEXT PRIMARY KEY,
+        total_events INTEGER NOT NULL DEFAULT 0,
+        low_risk_count INTEGER NOT NULL DEFAULT 0,
+        max_ts INTEGER
+    );
+    """,
+    # kind: day / city / device / service
+    """
+    CREATE TABLE IF NOT EXISTS compacted_counts (
+        user_id TEXT NOT NULL,
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, kind, value)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS compacted_service_ngrams (
+        user_id TEXT NOT NULL,
+        prev2 TEXT NOT NULL,
+        prev1 TEXT NOT NULL,
+        service TEXT NOT NULL,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, prev2, prev1, service)
+    ) WITHOUT ROWID;
+    """,
+    # الـ trigger يحدّث كل الجداول في نفس transaction الإدخال
+    f"""
+    CREATE TRIGGER IF NOT EXISTS trg_events_rollups
+    AFTER INSERT ON events
+    BEGIN
+        INSERT INTO user_stats (user_id, total_events, low_risk_count, max_ts, last_event_id)
+        VALUES (NEW.user_id, 1, NEW.risk_score <= {LOW_RISK_THRESHOLD}, NEW.timestamp_ms, NEW.id)
+        ON CONFLICT (user_id) DO UPDATE SET
+            total_events = total_events + 1,
+            low_risk_count = low_risk_count + excluded.low_risk_count,
+            max_ts = CASE
+                WHEN excluded.max_ts IS NULL THEN max_ts
+                WHEN max_ts IS NULL OR excluded.max_ts > max_ts THEN excluded.max_ts
+                ELSE max_ts
+            END,
+            last_event_id = excluded.last_event_id;
+
+        INSERT INTO user_daily_stats (user_id, day, event_count)
+        SELECT NEW.user_id, date(NEW.event_time), 1
+        WHERE date(NEW.event_time) IS NOT NULL
+        ON CONFLICT (user_id, day) DO UPDATE SET event_count = event_count + 1;
+
+        INSERT INTO user_city_counts (user_id, city, event_count)
+        VALUES (NEW.user_id, NEW.city, 1)
+        ON CONFLICT (user_id, city) DO UPDATE SET event_count = event_count + 1;
+
+        INSERT INTO user_device_counts (user_id, device, event_count)
+        VALUES (NEW.user_id, NEW.device, 1)
+        ON CONFLICT (user_id, device) DO UPDATE SET event_count = event_count + 1;
+
+        INSERT INTO user_service_counts (user_id, service, event_count)
+        VALUES (NEW.user_id, NEW.service, 1)
+        ON CONFLICT (user_id, service) DO UPDATE SET event_count = event_count + 1;
+    END;
+    """,
+    # trigger مستقل حتى يُضاف أيضاً لقواعد أُنشئ فيها trg_events_rollups قبل التسلسلات.
+    # الانتقالات تُقرأ من آخر خدمتين قبل تحديثهما (في SET القيم القديمة للصف)
+    """
+    CREATE TRIGGER IF NOT EXISTS trg_events_service_ngrams
+    AFTER INSERT ON events
+    BEGIN
+        INSERT INTO user_service_ngrams (user_id, prev2, prev1, service, event_count)
+        SELECT NEW.user_id, '', last_service, NEW.service, 1
+        FROM user_service_tail
+        WHERE user_id = NEW.user_id
+        ON CONFLICT (user_id, prev2, prev1, service) DO UPDATE SET event_count = event_count + 1;
+
+        INSERT INTO user_service_ngrams (user_id, prev2, prev1, service, event_count)
+        SELECT NEW.user_id, prev_service, last_service, NEW.service, 1
+        FROM user_service_tail
+        WHERE user_id = NEW.user_id AND prev_service IS NOT NULL
+        ON CONFLICT (user_id, prev2, prev1, service) DO UPDATE SET event_count = event_count + 1;
+
+        INSERT INTO user_service_tail (user_id, last_service, prev_service)
+        VALUES (NEW.user_id, NEW.service, NULL)
+        ON CONFLICT (user_id) DO UPDATE SET
+            prev_service = last_service,
+            last_service = excluded.last_service;
+    END;
+    """,
+]
+
+# انتقالات الخدمات بترتيب الإدخال (id) لكل مستخدم: LAG بدل الـ trigger عند إعادة البناء
+_SEQUENCE_CTE = """
+    WITH seq AS (
+        SELECT e.user_id, e.service,
+               LAG(e.service, 1) OVER w AS prev1,
+               LAG(e.service, 2) OVER w AS prev2
+        FROM events e
+        {join}
+        WINDOW w AS (PARTITION BY e.user_id ORDER BY e.id)
+    ),
+    grams AS (
+        SELECT user_id, '' AS prev2, prev1, service FROM seq WHERE prev1 IS NOT NULL
+        UNION ALL
+        SELECT user_id, prev2, prev1, service FROM seq WHERE prev2 IS NOT NULL
+    )
+"""
+
+
+def create_rollup_tables(cur: sqlite3.Cursor) -> bool:
+    """
+    إنشاء جداول التجميع + الـ trigger.
+    ترجع True لو الجداول أُنشئت الآن لأول مرة (يعني تحتاج backfill).
+    """
+    # user_service_tail: قواعد أُنشئت قبل جداول التسلسل تحتاج backfill أيضاً
+    cur.execute(
+        """
+        SELECT COUNT(*) FROM sqlite_master
+        WHERE type = 'table' AND name IN ('user_stats', 'user_service_tail')
+        """
+    )
+    existed = cur.fetchone()[0] == 2
+
+    for stmt in _SCHEMA:
+        cur.execute(stmt)
+
+    return not existed
+
+
+def backfill_rollups(conn: sqlite3.Connection) -> int:
+    """
+    إعادة بناء جداول التجميع بالكامل من جدول events (لقواعد بيانات موجودة مسبقاً).
+    العملية idempotent: تمسح الجداول وتعيد حسابها في transaction واحدة.
+    ترجع عدد المستخدمين.
+    """
+    cur = conn.cursor()
+
+    for table in ROLLUP_TABLES:
+        cur.execute(f"DELETE FROM {table}")
+
+    # events الحالية + ما ضُغط سابقاً (compacted_*) بعد حذف الأحداث القديمة
+    cur.execute(
+        f"""
+        INSERT INTO user_stats (user_id, total_events, low_risk_count, max_ts, last_event_id)
+        SELECT user_id, SUM(total), SUM(low_risk), MAX(max_ts), MAX(last_id)
+        FROM (
+            SELECT user_id, COUNT(*) AS total, SUM(risk_score <= {LOW_RISK_THRESHOLD}) AS low_risk,
+                   MAX(timestamp_ms) AS max_ts, MAX(id) AS last_id
+            FROM events
+            GROUP BY user_id
+            UNION ALL
+            SELECT user_id, total_events, low_risk_count, max_ts, NULL
+            FROM compacted_user_stats
+        )
+        GROUP BY user_id
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO user_daily_stats (user_id, day, event_count)
+        SELECT user_id, day, SUM(n)
+        FROM (
+            SELECT user_id, date(event_time) AS day, COUNT(*) AS n
+            FROM events
+            WHERE date(event_time) IS NOT NULL
+            GROUP BY user_id, date(event_time)
+            UNION ALL
+            SELECT user_id, value, event_count
+            FROM compacted_counts
+            WHERE kind = 'day'
+        )
+        GROUP BY user_id, day
+        """
+    )
+    for field_name in ("city", "device", "service"):
+        cur.execute(
+            f"""
+            INSERT INTO user_{field_name}_counts (user_id, {field_name}, event_count)
+            SELECT user_id, value, SUM(n)
+            FROM (
+                SELECT user_id, {field_name} AS value, COUNT(*) AS n
+                FROM events
+                GROUP BY user_id, {field_name}
+                UNION ALL
+                SELECT user_id, value, event_count
+                FROM compacted_counts
+                WHERE kind = '{field_name}'
+            )
+            GROUP BY user_id, value
+            """
+        )
+
+    cur.execute(
+        _SEQUENCE_CTE.format(join="")
+        + """
+        INSERT INTO user_service_ngrams (user_id, prev2, prev1, service, event_count)
+        SELECT user_id, prev2, prev1, service, SUM(n)
+        FROM (
+            SELECT user_id, prev2, prev1, service, COUNT(*) AS n
+            FROM grams
+            GROUP BY user_id, prev2, prev1, service
+            UNION ALL
+            SELECT user_id, prev2, prev1, service, event_count
+            FROM compacted_service_ngrams
+        )
+        GROUP BY user_id, prev2, prev1, service
+        """
+    )
+    cur.execute(
+        """
+        INSERT INTO user_service_tail (user_id, last_service, prev_service)
+        SELECT user_id, MAX(CASE WHEN rn = 1 THEN service END), MAX(CASE WHEN rn = 2 THEN service END)
+        FROM (
+            SELECT user_id, service,
+                   ROW_NUMBER() OVER (PARTITION BY user_id ORDER BY id DESC) AS rn
+            FROM events
+        )
+        WHERE rn <= 2
+        GROUP BY user_id
+        """
+    )
+
+    conn.commit()
+
+    cur.execute("SELECT COUNT(*) FROM user_stats")
+    return int(cur.fetchone()[0])
+
+
+def compact_events(cur: sqlite3.Cursor, batch_table: str) -> None:
+    """
+    إضافة مجاميع الأحداث المذكورة في batch_table (عمود id) إلى compacted_*
+    قبل حذفها من events (يُستدعى داخل نفس transaction الحذف).
+    جداول التجميع نفسها لا تتغير: هي أصلاً تحتوي هذه الأحداث.
+    """
+    cur.execute(
+        f"""
+        INSERT INTO compacted_user_stats (user_id, total_events, low_risk_count, max_ts)
+        SELECT e.user_id, COUNT(*), SUM(e.risk_score <= {LOW_RISK_THRESHOLD}), MAX(e.timestamp_ms)
+        FROM events e
+        JOIN {batch_table} b ON b.id = e.id
+        WHERE 1
+        GROUP BY e.user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            total_events = total_events + excluded.total_events,
+            low_risk_count = low_risk_count + excluded.low_risk_count,
+            max_ts = CASE
+                WHEN excluded.max_ts IS NULL THEN max_ts
+                WHEN max_ts IS NULL OR excluded.max_ts > max_ts THEN excluded.max_ts
+                ELSE max_ts
+            END
+        """
+    )
+    for kind, expr in (
+        ("day", "date(e.event_time)"),
+        ("city", "e.city"),
+        ("device", "e.device"),
+        ("service", "e.service"),
+    ):
+        cur.execute(
+            f"""
+            INSERT INTO compacted_counts (user_id, kind, value, event_count)
+            SELECT e.user_id, '{kind}', {expr}, COUNT(*)
+            FROM events e
+            JOIN {batch_table} b ON b.id = e.id
+            WHERE {expr} IS NOT NULL
+            GROUP BY e.user_id, {expr}
+            ON CONFLICT (user_id, kind, value) DO UPDATE SET
+                event_count = event_count + excluded.event_count
+            """
+        )
+    # الانتقالات داخل الدفعة فقط: ما يبدأ في دفعة سابقة وينتهي هنا (أول حدثين
+    # لكل مستخدم) لا يُضغط. user_service_ngrams نفسه لا يتأثر؛ الفرق يظهر فقط
+    # لو أُعيد البناء بـ backfill_rollups بعد الحذف
+    cur.execute(
+        _SEQUENCE_CTE.format(join=f"JOIN {batch_table} b ON b.id = e.id")
+        + """
+        INSERT INTO compacted_service_ngrams (user_id, prev2, prev1, service, event_count)
+        SELECT user_id, prev2, prev1, service, COUNT(*)
+        FROM grams
+        WHERE 1
+        GROUP BY user_id, prev2, prev1, service
+        ON CONFLICT (user_id, prev2, prev1, service) DO UPDATE SET
+            event_count = event_count + excluded.event_count
+        """
+    )
+
+
+if __name__ == "__main__":
+    # إعادة بناء جداول التجميع لقاعدة بيانات موجودة:
+    # python -m rollups
+    from database import get_connection, init_db, release_connection, sqlite_db_path
+
+    try:
+        db_path = sqlite_db_path()
+    except ValueError as e:
+        print(f"[rollups] {e}")
+        sys.exit(2)
+
+    print(f"[rollups] بدء إعادة بناء جداول التجميع من: {db_path}")
+    init_db()
+    started = time.perf_counter()
+    conn = get_connection(db_path)
+    users = backfill_rollups(conn)
+    release_connection(conn, db_path)
+    print(
+        f"[rollups] تم خلال {time.perf_counter() - started:.2f} ثانية، "
+        f"عدد المستخدمين: {users}"
+    )
@@ -0,0 +1,82 @@
+from typing import Dict, Iterable, Optional, Tuple
+
+# ---------------------- تسلسل الخدمات (Service transitions) ---------------------- #
+#
+# لكل مستخدم: عدادات الانتقال بين الخدمات + آخر خدمتين، بدل قراءة سجله كل مرة:
+# - bigram:  (الخدمة السابقة → الحالية)        مثل login → change_mobile
+# - trigram: (الخدمتين السابقتين → الحالية)    مثل login → change_mobile → reset_password
+# التحديث والتقييم = عمليات قاموس (O(1) لكل حدث) مهما كان طول السجل.
+#
+# في القاعدة: user_service_ngrams (نفس الجدول للنوعين، prev2 = '' يعني bigram)
+# و user_service_tail (آخر خدمتين)، ويحدّثهما trigger مع كل INSERT (rollups.py).
+
+# قيمة prev2 لصفوف الـ bigram (الخدمات لا تكون فارغة بعد validate_event)
+BIGRAM_PREV = ""
+
+
+class ServiceTransitions:
+    """
+    انتقالات خدمات مستخدم واحد.
+    """
+
+    __slots__ = ("last", "prev", "ngrams", "outgoing")
+
+    def __init__(self):
+        self.last: Optional[str] = None  # آخر خدمة
+        self.prev: Optional[str] = None  # الخدمة قبلها
+        # {(prev2, prev1, service): count} — prev2 = BIGRAM_PREV للـ bigram
+        self.ngrams: Dict[Tuple[str, str, str], int] = {}
+        # {prev1: عدد الانتقالات الخارجة منها} (مقام احتمال الـ bigram)
+        self.outgoing: Dict[str, int] = {}
+
+    def add(self, service: str) -> None:
+        """
+        نفس ما يفعله الـ trigger في القاعدة لحدث جديد.
+        """
+        last = self.last
+        if last is not None:
+            ngrams = self.ngrams
+            key = (BIGRAM_PREV, last, service)
+            ngrams[key] = ngrams.get(key, 0) + 1
+            self.outgoing[last] = self.outgoing.get(last, 0) + 1
+            if self.prev is not None:
+                key = (self.prev, last, service)
+                ngrams[key] = ngrams.get(key, 0) + 1
+        self.prev = last
+        self.last = service
+
+    def load(self, rows: Iterable[Tuple[str, str, str, int]],
+             tail: Tuple[Optional[str], Optional[str]]) -> None:
+        """
+        تعبئة من القاعدة: صفوف (prev2, prev1, service, count) + (آخر خدمة, التي قبلها).
+        """
+        for prev2, prev1, service, n in rows:
+            self.ngrams[(prev2, prev1, service)] = n
+            if prev2 == BIGRAM_PREV:
+                self.outgoing[prev1] = self.outgoing.get(prev1, 0) + n
+        self.last, self.prev = tail
+
+    def features(self, service: str) -> Tuple[float, float]:
+        """
+        (transition_rarity, sequence_novelty) للخدمة الحالية بعد آخر خدمتين:
+        - transition_rarity = 1 - P(service | آخر خدمة) من سجل المستخدم نفسه
+          (1 لو آخر خدمة لم يخرج منها أي انتقال قبل)
+        - sequence_novelty: 0 = التسلسل الثلاثي تكرر قبل، 0.5 = الانتقال الأخير فقط معروف،
+          1 = انتقال جديد كلياً
+        بدون خدمة سابقة (أول حدث) الاثنين 0: لا يوجد انتقال نقيّمه.
+        """
+        last = self.last
+        if last is None:
+            return 0.0, 0.0
+
+        bigram = self.ngrams.get((BIGRAM_PREV, last, service), 0)
+        outgoing = self.outgoing.get(last, 0)
+        rarity = 1.0 - bigram / outgoing if outgoing else 1.0
+
+        if self.prev is not None and self.ngrams.get((self.prev, last, service), 0):
+            novelty = 0.0
+        elif bigram:
+            novelty = 0.5 if self.prev is not None else 0.0
+        else:
+            novelty = 1.0
+        return rarity, novelty
@@ -0,0 +1,49 @@
+import argparse
+import os
+
+# ---------------------- تشغيل خدمة ASGI للإنتاج ---------------------- #
+#
+#   python serve.py --workers 4 --port 8000
+#
+# كل worker عملية مستقلة (نموذج + كاش بصمات خاص بها)، ولذلك مع أكثر من worker
+# يُعامل التخزين كمشترك: البصمات تُعاد قراءتها دورياً (SND_PROFILE_MAX_AGE_SECONDS).
+# المتطلبات: pip install uvicorn (run.py يبقى لتشغيل Flask أثناء التطوير)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SND ASGI scoring service")
+    parser.add_argument("--host", default=os.environ.get("SND_HOST", "127.0.0.1"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("SND_PORT", "8000")))
+    parser.add_argument("--workers", type=int,
+                        default=int(os.environ.get("SND_WORKERS", str(os.cpu_count() or 1))),
+                        help="عدد العمليات (worker processes)")
+    parser.add_argument("--model-threads", type=int, help="SND_ASGI_MODEL_THREADS لكل عملية")
+    parser.add_argument("--db-threads", type=int, help="SND_ASGI_DB_THREADS لكل عملية")
+    parser.add_argument("--log-level", default="warning")
+    args = parser.parse_args()
+
+    if os.environ.get("SND_ANOMALY_ENGINE") == "online" and args.workers > 1:
+        # حالة Half-Space Trees في عملية واحدة (app/model.py: start_online_model)
+        raise SystemExit("SND_ANOMALY_ENGINE=online needs a single worker: use --workers 1")
+
+    try:
+        import uvicorn
+    except ImportError:
+        raise SystemExit("ASGI service needs: pip install uvicorn")
+
+    # تُقرأ في كل عملية عند استيراد app.asgi / database
+    os.environ["SND_WORKER_PROCESSES"] = str(args.workers)
+    if args.model_threads:
+        os.environ["SND_ASGI_MODEL_THREADS"] = str(args.model_threads)
+    if args.db_threads:
+        os.environ["SND_ASGI_DB_THREADS"] = str(args.db_threads)
+
+    print(f"[serve] SND ASGI على http://{args.host}:{args.port} ({args.workers} workers)")
+    uvicorn.run(
+        "app.asgi:application",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        lifespan="on",
+        log_level=args.log_level,
+        access_log=False,
+    )
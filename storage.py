@@ -0,0 +1,147 @@
+from typing import Dict, Iterable, List, NamedTuple, Optional, Sequence, Tuple
+
+# ---------------------- واجهة التخزين (Storage backend) ---------------------- #
+#
+# database.py لا يكتب SQL مباشرة في دواله العامة، بل يمررها لـ EventStore:
+# - SQLiteEventStore (database.py): ملف واحد على نفس الجهاز (الافتراضي)
+# - PostgresEventStore (storage_postgres.py): سجل مشترك لعدة عقد scoring
+#
+# الاختيار من SND_DATABASE_URL:
+#   (فارغ)                      → SQLite في DB_PATH
+#   sqlite:///path/to/events.db → SQLite في مسار محدد
+#   postgresql://user@host/db   → PostgreSQL
+#
+# أي تنفيذ جديد لازم ينجح في: python -m storage_conformance --url ...
+
+# ترتيب الأعمدة في كل سطر يُمرر لـ insert_events (نفس ترتيب insert_event)
+EVENT_COLUMNS = (
+    "user_id",
+    "device",
+    "city",
+    "region",
+    "os",
+    "browser",
+    "service",
+    "event_time",
+    "timestamp_ms",
+    "risk_score",
+    "ai_risk_score",
+    "rules_score",
+    "decision",
+    "raw_payload",
+)
+
+# حقول الحدث كما تُعرض في /events و /events/stream (recent_events / events_since)
+EVENT_FIELDS = (
+    "id",
+    "user_id",
+    "device",
+    "city",
+    "region",
+    "os",
+    "browser",
+    "service",
+    "event_time",
+    "risk_score",
+    "decision",
+)
+
+# الحقول التي لها جداول عدّ لكل مستخدم (user_<field>_counts)
+COUNT_FIELDS = ("city", "device", "service")
+
+
+class ProfileRows(NamedTuple):
+    """
+    كل ما تحتاجه بصمة المستخدم من التخزين (قراءة واحدة عند تحميل البصمة).
+    """
+
+    total_events: int
+    low_risk_count: int
+    active_days: List[str]
+    city_counts: List[Tuple[str, int]]
+    device_counts: List[Tuple[str, int]]
+    service_counts: List[Tuple[str, int]]
+    # (event_time_str, device, city, timestamp_ms) أو None
+    last_event: Optional[tuple]
+    # طوابع الأحداث داخل أطول نافذة سرعة من أحدث طابع (تصاعدياً، آخر limit فقط)
+    window_timestamps: List[int]
+    # انتقالات الخدمات: [(prev2, prev1, service, count), ...] (prev2 = '' للـ bigram)
+    service_ngrams: List[Tuple[str, str, str, int]] = []
+    # (آخر خدمة, التي قبلها)
+    service_tail: Tuple[Optional[str], Optional[str]] = (None, None)
+
+
+class EventStore:
+    """
+    الواجهة المشتركة لكل أنواع التخزين.
+    shared=True يعني أن عقداً أخرى تكتب في نفس السجل
+    (كاش البصمة يُعاد تحميله دورياً بدل الاعتماد على الإدخال المحلي فقط).
+    """
+
+    name = "base"
+    shared = False
+
+    def init_schema(self) -> None:
+        """
+        إنشاء الجداول والفهارس وجداول التجميع (مرة عند التشغيل، آمنة للتكرار).
+        """
+        raise NotImplementedError
+
+    def insert_events(self, rows: Sequence[tuple]) -> List[int]:
+        """
+        حفظ دفعة أحداث (أسطر بترتيب EVENT_COLUMNS) في transaction واحدة.
+        ترجع id كل حدث بنفس الترتيب (للبث المباشر /events/stream).
+        """
+        raise NotImplementedError
+
+    def load_profile(self, user_id: str, window_ms: int, limit: int) -> Optional[ProfileRows]:
+        """
+        بيانات البصمة من جداول التجميع + طوابع آخر window_ms (بحد limit)، أو None لمستخدم جديد.
+        """
+        raise NotImplementedError
+
+    def last_event(self, user_id: str) -> Optional[tuple]:
+        raise NotImplementedError
+
+    def event_count_since(self, user_id: str, since_ms: int) -> int:
+        raise NotImplementedError
+
+    def low_risk_count(self, user_id: str) -> int:
+        raise NotImplementedError
+
+    def event_stats(self, user_id: str,
+                    values: Dict[str, Optional[str]]) -> Tuple[int, int, Dict[str, int]]:
+        """
+        (إجمالي الأحداث, عدد الأيام المختلفة, {"city": عدد أحداث هذه المدينة, ...}).
+        """
+        raise NotImplementedError
+
+    def recent_events(self, limit: int) -> List[Dict]:
+        """
+        آخر limit أحداث من الأحدث للأقدم: [{EVENT_FIELDS...}, ...].
+        """
+        raise NotImplementedError
+
+    def events_since(self, since_id: int, limit: int) -> List[Dict]:
+        """
+        الأحداث بعد since_id من الأقدم للأحدث (cursor لـ /events?since_id=).
+        """
+        raise NotImplementedError
+
+    def sequence_history(self, user_id: str, limit: int) -> List[str]:
+        """
+        آخر الخدمات للمستخدم من الأحدث للأقدم.
+        """
+        raise NotImplementedError
+
+    def city_regions(self) -> Dict[str, str]:
+        """
+        جدول city_region كاملاً: {name_key: region}.
+        """
+        raise NotImplementedError
+
+    def upsert_city_regions(self, rows: Iterable[Tuple[str, str]]) -> int:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        pass
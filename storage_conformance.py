@@ -0,0 +1,251 @@
+import argparse
+import os
+import random
+import sys
+import tempfile
+from collections import Counter
+from typing import Callable, List, Optional, Tuple
+
+from profile_cache import LOW_RISK_THRESHOLD, sqlite_date
+from sequences import BIGRAM_PREV
+from storage import COUNT_FIELDS, EVENT_FIELDS, EventStore
+from velocity import LONGEST_WINDOW_MS, VELOCITY_MAX_EVENTS
+
+# ---------------------- اختبار التوافق بين أنواع التخزين ---------------------- #
+#
+# نفس السيناريو يُكتب في كل تخزين (EventStore) ثم تُقارن كل دوال الواجهة
+# مع نموذج مرجعي بسيط في Python (قوائم وعدادات).
+#
+#   python -m storage_conformance                               # SQLite في مجلد مؤقت
+#   python -m storage_conformance --url postgresql://localhost/snd
+#
+# مع PostgreSQL يُنشأ schema مؤقت (search_path) ويُحذف بعد الانتهاء،
+# فلا يلمس جداول القاعدة نفسها.
+
+_USERS = [f"user_{i}" for i in range(12)]
+_DEVICES = ["iphone", "galaxy", "macbook", "windows-pc"]
+_CITIES = ["riyadh", "jeddah", "dammam", "abha", "الرياض"]
+_SERVICES = ["login", "view_profile", "pay_bills", "reset_password", "change_mobile"]
+_TZ = ["", "+03:00", "Z", "-05:00"]
+
+
+def scenario(n_events: int = 1500, seed: int = 7) -> List[tuple]:
+    """
+    أحداث حتمية بترتيب EVENT_COLUMNS: أوقات بـ timezone وبدونها،
+    timestamp_ms فارغ أحياناً، وأحداث غير مرتبة زمنياً.
+    """
+    rng = random.Random(seed)
+    base_ms = 1735689600000  # 2025-01-01T00:00:00Z
+    rows = []
+    for _ in range(n_events):
+        ts = base_ms + rng.randrange(0, 40 * 24 * 3600 * 1000)
+        seconds = ts // 1000
+        day, rem = divmod(seconds - base_ms // 1000, 86400)
+        event_time = (
+            f"2025-{1 + day // 31:02d}-{1 + day % 28:02d}T"
+            f"{rem // 3600:02d}:{rem % 3600 // 60:02d}:{rem % 60:02d}{rng.choice(_TZ)}"
+        )
+        rows.append((
+            rng.choice(_USERS),
+            rng.choice(_DEVICES),
+            rng.choice(_CITIES),
+            "central",
+            "ios",
+            "safari",
+            rng.choice(_SERVICES),
+            event_time,
+            None if rng.random() < 0.05 else ts,
+            round(rng.uniform(0, 95), 2),
+            round(rng.uniform(0, 100), 2),
+            round(rng.uniform(0, 100), 2),
+            rng.choice(["Allow", "Alert", "Challenge"]),
+            "{}",
+        ))
+    return rows
+
+
+class _Reference:
+    """
+    النموذج المرجعي: نفس الإجابات محسوبة مباشرة من قائمة الأحداث.
+    """
+
+    def __init__(self, rows: List[tuple]):
+        self.rows = rows
+
+    def of(self, user_id: str) -> List[tuple]:
+        return [r for r in self.rows if r[0] == user_id]
+
+    def profile(self, user_id: str):
+        rows = self.of(user_id)
+        if not rows:
+            return None
+        last = rows[-1]
+        stamps = [r[8] for r in rows if r[8] is not None]
+        window_ts = []
+        if stamps:
+            low = max(stamps) - LONGEST_WINDOW_MS
+            window_ts = sorted(t for t in stamps if t >= low)[-VELOCITY_MAX_EVENTS:]
+        services = [r[6] for r in rows]
+        ngrams = Counter((BIGRAM_PREV, a, b) for a, b in zip(services, services[1:]))
+        ngrams.update(zip(services, services[1:], services[2:]))
+        return (
+            len(rows),
+            sum(1 for r in rows if r[9] <= LOW_RISK_THRESHOLD),
+            sorted({d for d in (sqlite_date(r[7]) for r in rows) if d is not None}),
+            {field: sorted(Counter(r[i] for r in rows).items())
+             for field, i in (("city", 2), ("device", 1), ("service", 6))},
+            (last[7], last[1], last[2], last[8]),
+            window_ts,
+            sorted(key + (n,) for key, n in ngrams.items()),
+            (services[-1], services[-2] if len(services) > 1 else None),
+        )
+
+
+def _profile_key(rows) -> Optional[tuple]:
+    if rows is None:
+        return None
+    return (
+        rows.total_events,
+        rows.low_risk_count,
+        sorted(rows.active_days),
+        {field: sorted(getattr(rows, f"{field}_counts")) for field in COUNT_FIELDS},
+        tuple(rows.last_event) if rows.last_event else None,
+        list(rows.window_timestamps),
+        sorted(tuple(g) for g in rows.service_ngrams),
+        tuple(rows.service_tail),
+    )
+
+
+def run_conformance(store: EventStore, n_events: int = 1500) -> Tuple[int, List[str]]:
+    """
+    تشغيل السيناريو على تخزين فارغ. ترجع (عدد الفحوص, قائمة الأخطاء).
+    """
+    failures: List[str] = []
+    checks = 0
+
+    def check(name: str, got, expected) -> None:
+        nonlocal checks
+        checks += 1
+        if got != expected:
+            failures.append(f"{name}: got {got!r}, expected {expected!r}")
+
+    store.init_schema()
+    store.init_schema()  # آمنة للتكرار
+
+    rows = scenario(n_events)
+    ref = _Reference(rows)
+    # حدث واحد + دفعات بأحجام مختلفة (نفس مسار insert_event و write-behind)
+    ids = list(store.insert_events(rows[:1]))
+    pos, size = 1, 1
+    while pos < len(rows):
+        ids += store.insert_events(rows[pos:pos + size])
+        pos += size
+        size = min(size * 3, 500)
+    check("insert_events ids", (len(ids), ids == sorted(set(ids))), (len(rows), True))
+
+    for user_id in _USERS + ["missing_user"]:
+        user_rows = ref.of(user_id)
+        check(f"load_profile({user_id})",
+              _profile_key(store.load_profile(user_id, LONGEST_WINDOW_MS, VELOCITY_MAX_EVENTS)),
+              ref.profile(user_id))
+
+        last = user_rows[-1] if user_rows else None
+        check(f"last_event({user_id})",
+              tuple(store.last_event(user_id) or ()) or None,
+              (last[7], last[1], last[2], last[8]) if last else None)
+
+        stamps = sorted(r[8] for r in user_rows if r[8] is not None)
+        since = stamps[len(stamps) // 2] if stamps else 0
+        check(f"event_count_since({user_id})",
+              store.event_count_since(user_id, since),
+              sum(1 for t in stamps if t >= since))
+
+        check(f"low_risk_count({user_id})",
+              store.low_risk_count(user_id),
+              sum(1 for r in user_rows if r[9] <= LOW_RISK_THRESHOLD))
+
+        values = {"city": _CITIES[0], "device": _DEVICES[1], "service": ""}
+        days = {d for d in (sqlite_date(r[7]) for r in user_rows) if d is not None}
+        check(f"event_stats({user_id})",
+              store.event_stats(user_id, values),
+              (len(user_rows), len(days), {
+                  "city": sum(1 for r in user_rows if r[2] == _CITIES[0]),
+                  "device": sum(1 for r in user_rows if r[1] == _DEVICES[1]),
+                  "service": 0,
+              }))
+
+        check(f"sequence_history({user_id})",
+              list(store.sequence_history(user_id, 7)),
+              [r[6] for r in reversed(user_rows)][:7])
+
+    def as_event(event_id: int, r: tuple) -> dict:
+        return dict(zip(EVENT_FIELDS, (event_id,) + tuple(r[:8]) + (r[9], r[12])))
+
+    expected_events = [as_event(i, r) for i, r in zip(ids, rows)]
+    check("recent_events", store.recent_events(25), expected_events[::-1][:25])
+    check("events_since(0)", store.events_since(0, 40), expected_events[:40])
+    middle = ids[len(ids) // 2]
+    check("events_since(middle)", store.events_since(middle, 10),
+          [e for e in expected_events if e["id"] > middle][:10])
+    check("events_since(last)", store.events_since(ids[-1], 10), [])
+
+    regions = store.city_regions()
+    check("city_regions seeded", regions.get("رياض"), "central")
+    check("upsert_city_regions", store.upsert_city_regions([("north", "Al-Ula"), ("north", "العلا")]), 2)
+    check("city_regions after upsert", store.city_regions().get("ula"), "north")
+
+    return checks, failures
+
+
+# ---------- التشغيل ---------- #
+
+def _sqlite_store() -> Tuple[EventStore, Callable[[], None]]:
+    from database import SQLiteEventStore, close_all_connections
+
+    path = os.path.join(tempfile.mkdtemp(prefix="snd-conformance-"), "events.db")
+    return SQLiteEventStore(path), close_all_connections
+
+
+def _postgres_store(url: str) -> Tuple[EventStore, Callable[[], None]]:
+    import psycopg
+    from psycopg.conninfo import make_conninfo
+
+    from storage_postgres import PostgresEventStore
+
+    schema = f"snd_conformance_{os.getpid()}"
+    with psycopg.connect(url, autocommit=True) as conn:
+        conn.execute(f"CREATE SCHEMA {schema}")
+    store = PostgresEventStore(make_conninfo(url, options=f"-csearch_path={schema}"))
+
+    def cleanup():
+        store.close()
+        with psycopg.connect(url, autocommit=True) as conn:
+            conn.execute(f"DROP SCHEMA {schema} CASCADE")
+
+    return store, cleanup
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="SND storage conformance suite")
+    parser.add_argument("--url", action="append", default=[],
+                        help="postgresql://... (يمكن تكراره)؛ SQLite يُختبر دائماً")
+    parser.add_argument("--events", type=int, default=1500)
+    args = parser.parse_args()
+
+    targets: List[Tuple[str, Callable]] = [("sqlite", _sqlite_store)]
+    targets += [(url, lambda url=url: _postgres_store(url)) for url in args.url]
+
+    ok = True
+    for label, factory in targets:
+        store, cleanup = factory()
+        try:
+            checks, failures = run_conformance(store, args.events)
+        finally:
+            cleanup()
+        status = "ok" if not failures else f"{len(failures)} FAILED"
+        print(f"[conformance] {store.name} ({label}): {checks} checks, {status}")
+        for failure in failures[:20]:
+            print(f"    - {failure}")
+        ok = ok and not failures
+
+    sys.exit(0 if ok else 1)
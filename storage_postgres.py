@@ -0,0 +1,445 @@
+import os
+from typing import Dict, List, Optional
+
+from profile_cache import LOW_RISK_THRESHOLD, sqlite_date
+from regions import city_region_records, seed_rows
+from storage import COUNT_FIELDS, EVENT_FIELDS, EventStore, ProfileRows
+
+# ---------------------- التخزين: PostgreSQL ---------------------- #
+#
+# سجل أحداث مشترك لعدة عقد scoring (SND_DATABASE_URL=postgresql://...):
+# - pool اتصالات (psycopg_pool) لكل عقدة
+# - الإدخال على دفعات (executemany في pipeline واحد)
+# - نفس الفهارس وجداول التجميع، والـ trigger مكتوب بـ PL/pgSQL
+# - event_day يُحسب في Python (نفس date(event_time) في SQLite) ويُحفظ مع الحدث
+#
+# المتطلبات (غير موجودة في requirements.txt لأن SQLite يكفي لعقدة واحدة):
+#   pip install "psycopg[binary]" psycopg_pool
+
+PG_POOL_MIN_SIZE = int(os.environ.get("SND_PG_POOL_MIN", "1"))
+PG_POOL_MAX_SIZE = int(os.environ.get("SND_PG_POOL_MAX", "16"))
+PG_POOL_TIMEOUT = float(os.environ.get("SND_PG_POOL_TIMEOUT", "10"))
+
+_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS events (
+        id BIGSERIAL PRIMARY KEY,
+        user_id TEXT NOT NULL,
+        device TEXT NOT NULL,
+        city TEXT NOT NULL,
+        region TEXT,
+        os TEXT,
+        browser TEXT,
+        service TEXT NOT NULL,
+        event_time TEXT NOT NULL,
+        timestamp_ms BIGINT,
+        risk_score DOUBLE PRECISION NOT NULL,
+        ai_risk_score DOUBLE PRECISION,
+        rules_score DOUBLE PRECISION,
+        decision TEXT NOT NULL,
+        raw_payload TEXT,
+        event_day TEXT
+    )
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_events_user_ts ON events (user_id, timestamp_ms)",
+    "CREATE INDEX IF NOT EXISTS idx_events_user_service ON events (user_id, service)",
+    "CREATE INDEX IF NOT EXISTS idx_events_user_city_device ON events (user_id, city, device)",
+    # في SQLite الـ rowid جزء من كل فهرس؛ هنا نحتاجه صراحة لآخر الأحداث لكل مستخدم
+    "CREATE INDEX IF NOT EXISTS idx_events_user_id ON events (user_id, id)",
+    """
+    CREATE TABLE IF NOT EXISTS user_stats (
+        user_id TEXT PRIMARY KEY,
+        total_events BIGINT NOT NULL DEFAULT 0,
+        low_risk_count BIGINT NOT NULL DEFAULT 0,
+        max_ts BIGINT,
+        last_event_id BIGINT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_daily_stats (
+        user_id TEXT NOT NULL,
+        day TEXT NOT NULL,
+        event_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, day)
+    )
+    """,
+] + [
+    f"""
+    CREATE TABLE IF NOT EXISTS user_{field}_counts (
+        user_id TEXT NOT NULL,
+        {field} TEXT NOT NULL,
+        event_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, {field})
+    )
+    """
+    for field in COUNT_FIELDS
+] + [
+    """
+    CREATE TABLE IF NOT EXISTS user_service_ngrams (
+        user_id TEXT NOT NULL,
+        prev2 TEXT NOT NULL,
+        prev1 TEXT NOT NULL,
+        service TEXT NOT NULL,
+        event_count BIGINT NOT NULL DEFAULT 0,
+        PRIMARY KEY (user_id, prev2, prev1, service)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS user_service_tail (
+        user_id TEXT PRIMARY KEY,
+        last_service TEXT NOT NULL,
+        prev_service TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS city_region (
+        name_key TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        region TEXT NOT NULL
+    )
+    """,
+    # نفس trg_events_rollups + trg_events_service_ngrams في rollups.py
+    f"""
+    CREATE OR REPLACE FUNCTION snd_events_rollups() RETURNS trigger AS $$
+    DECLARE
+        tail user_service_tail%ROWTYPE;
+    BEGIN
+        INSERT INTO user_stats AS s (user_id, total_events, low_risk_count, max_ts, last_event_id)
+        VALUES (NEW.user_id, 1, (NEW.risk_score <= {LOW_RISK_THRESHOLD})::int, NEW.timestamp_ms, NEW.id)
+        ON CONFLICT (user_id) DO UPDATE SET
+            total_events = s.total_events + 1,
+            low_risk_count = s.low_risk_count + EXCLUDED.low_risk_count,
+            max_ts = GREATEST(s.max_ts, EXCLUDED.max_ts),
+            last_event_id = GREATEST(s.last_event_id, EXCLUDED.last_event_id);
+
+        IF NEW.event_day IS NOT NULL THEN
+            INSERT INTO user_daily_stats AS d (user_id, day, event_count)
+            VALUES (NEW.user_id, NEW.event_day, 1)
+            ON CONFLICT (user_id, day) DO UPDATE SET event_count = d.event_count + 1;
+        END IF;
+
+        INSERT INTO user_city_counts AS c (user_id, city, event_count)
+        VALUES (NEW.user_id, NEW.city, 1)
+        ON CONFLICT (user_id, city) DO UPDATE SET event_count = c.event_count + 1;
+
+        INSERT INTO user_device_counts AS c (user_id, device, event_count)
+        VALUES (NEW.user_id, NEW.device, 1)
+        ON CONFLICT (user_id, device) DO UPDATE SET event_count = c.event_count + 1;
+
+        INSERT INTO user_service_counts AS c (user_id, service, event_count)
+        VALUES (NEW.user_id, NEW.service, 1)
+        ON CONFLICT (user_id, service) DO UPDATE SET event_count = c.event_count + 1;
+
+        -- FOR UPDATE: عقدتان تكتبان لنفس المستخدم تمران على آخر خدمتين بالتتابع
+        SELECT * INTO tail FROM user_service_tail WHERE user_id = NEW.user_id FOR UPDATE;
+        IF FOUND THEN
+            INSERT INTO user_service_ngrams AS g (user_id, prev2, prev1, service, event_count)
+            VALUES (NEW.user_id, '', tail.last_service, NEW.service, 1)
+            ON CONFLICT (user_id, prev2, prev1, service) DO UPDATE SET event_count = g.event_count + 1;
+
+            IF tail.prev_service IS NOT NULL THEN
+                INSERT INTO user_service_ngrams AS g (user_id, prev2, prev1, service, event_count)
+                VALUES (NEW.user_id, tail.prev_service, tail.last_service, NEW.service, 1)
+                ON CONFLICT (user_id, prev2, prev1, service) DO UPDATE SET event_count = g.event_count + 1;
+            END IF;
+
+            UPDATE user_service_tail
+            SET prev_service = last_service, last_service = NEW.service
+            WHERE user_id = NEW.user_id;
+        ELSE
+            INSERT INTO user_service_tail AS t (user_id, last_service, prev_service)
+            VALUES (NEW.user_id, NEW.service, NULL)
+            ON CONFLICT (user_id) DO UPDATE SET
+                prev_service = t.last_service,
+                last_service = EXCLUDED.last_service;
+        END IF;
+
+        RETURN NULL;
+    END
+    $$ LANGUAGE plpgsql
+    """,
+    "DROP TRIGGER IF EXISTS trg_events_rollups ON events",
+    """
+    CREATE TRIGGER trg_events_rollups
+    AFTER INSERT ON events
+    FOR EACH ROW EXECUTE FUNCTION snd_events_rollups()
+    """,
+]
+
+_INSERT_EVENT_SQL = """
+    INSERT INTO events (
+        user_id, device, city, region, os, browser, service, event_time,
+        timestamp_ms, risk_score, ai_risk_score, rules_score, decision,
+        raw_payload, event_day
+    )
+    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+"""
+
+_EVENT_FIELDS_SQL = ", ".join(EVENT_FIELDS)
+
+_UPSERT_REGION_SQL = """
+    INSERT INTO city_region (name_key, name, region)
+    VALUES (%s, %s, %s)
+    ON CONFLICT (name_key) DO UPDATE SET
+        name = EXCLUDED.name,
+        region = EXCLUDED.region
+"""
+
+
+class PostgresEventStore(EventStore):
+    """
+    تخزين مشترك على PostgreSQL. كل الاستعلامات بنفس معنى SQLiteEventStore.
+    """
+
+    name = "postgresql"
+    shared = True
+
+    def __init__(
+        self,
+        url: str,
+        min_size: int = PG_POOL_MIN_SIZE,
+        max_size: int = PG_POOL_MAX_SIZE,
+    ):
+        try:
+            from psycopg_pool import ConnectionPool
+        except ImportError as exc:
+            raise RuntimeError(
+                'PostgreSQL storage needs: pip install "psycopg[binary]" psycopg_pool'
+            ) from exc
+
+        self.url = url
+        self.pool = ConnectionPool(
+            url,
+            min_size=min_size,
+            max_size=max_size,
+            timeout=PG_POOL_TIMEOUT,
+            name="snd-events",
+            open=True,
+        )
+
+    def init_schema(self) -> None:
+        with self.pool.connection() as conn:
+            # عدة عقد تبدأ معاً: قفل واحد حتى لا يتسابق إنشاء الجداول والـ trigger
+            conn.execute("SELECT pg_advisory_xact_lock(hashtext('snd_init_schema'))")
+            for stmt in _SCHEMA:
+                conn.execute(stmt)
+            seeded = conn.execute("SELECT 1 FROM city_region LIMIT 1").fetchone()
+            if seeded is None:
+                conn.cursor().executemany(_UPSERT_REGION_SQL, city_region_records(seed_rows()))
+
+    def insert_events(self, rows) -> List[int]:
+        # event_day = date(event_time) بنفس قواعد SQLite (UTC لو فيه timezone)
+        params = [tuple(row) + (sqlite_date(row[7]),) for row in rows]
+        ids = []
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.executemany(_INSERT_EVENT_SQL + " RETURNING id", params, returning=True)
+            # نتيجة لكل سطر بنفس ترتيب الإدخال
+            while True:
+                ids.append(cur.fetchone()[0])
+                if not cur.nextset():
+                    break
+        return ids
+
+    def load_profile(self, user_id, window_ms, limit):
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT total_events, low_risk_count, max_ts, last_event_id
+                FROM user_stats
+                WHERE user_id = %s
+                """,
+                (user_id,),
+            )
+            row = cur.fetchone()
+            if row is None:
+                return None
+            total_events, low_risk_count, max_ts, last_event_id = row
+
+            cur.execute("SELECT day FROM user_daily_stats WHERE user_id = %s", (user_id,))
+            active_days = [r[0] for r in cur.fetchall()]
+
+            counts = {}
+            for field_name in COUNT_FIELDS:
+                cur.execute(
+                    f"""
+                    SELECT {field_name}, event_count
+                    FROM user_{field_name}_counts
+                    WHERE user_id = %s
+                    """,
+                    (user_id,),
+                )
+                counts[field_name] = [(value, int(n)) for value, n in cur.fetchall()]
+
+            cur.execute(
+                "SELECT event_time, device, city, timestamp_ms FROM events WHERE id = %s",
+                (last_event_id,),
+            )
+            last_event = cur.fetchone()
+
+            cur.execute(
+                """
+                SELECT prev2, prev1, service, event_count
+                FROM user_service_ngrams
+                WHERE user_id = %s
+                """,
+                (user_id,),
+            )
+            service_ngrams = [(p2, p1, svc, int(n)) for p2, p1, svc, n in cur.fetchall()]
+
+            cur.execute(
+                "SELECT last_service, prev_service FROM user_service_tail WHERE user_id = %s",
+                (user_id,),
+            )
+            service_tail = cur.fetchone() or (None, None)
+
+            window_timestamps = []
+            if max_ts is not None:
+                cur.execute(
+                    """
+                    SELECT timestamp_ms
+                    FROM events
+                    WHERE user_id = %s
+                      AND timestamp_ms >= %s
+                    ORDER BY timestamp_ms DESC
+                    LIMIT %s
+                    """,
+                    (user_id, max_ts - window_ms, limit),
+                )
+                window_timestamps = [int(r[0]) for r in reversed(cur.fetchall())]
+
+        return ProfileRows(
+            total_events=int(total_events or 0),
+            low_risk_count=int(low_risk_count or 0),
+            active_days=active_days,
+            city_counts=counts["city"],
+            device_counts=counts["device"],
+            service_counts=counts["service"],
+            last_event=tuple(last_event) if last_event else None,
+            window_timestamps=window_timestamps,
+            service_ngrams=service_ngrams,
+            service_tail=tuple(service_tail),
+        )
+
+    def last_event(self, user_id) -> Optional[tuple]:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                """
+                SELECT event_time, device, city, timestamp_ms
+                FROM events
+                WHERE user_id = %s
+                ORDER BY id DESC
+                LIMIT 1
+                """,
+                (user_id,),
+            ).fetchone()
+        return tuple(row) if row else None
+
+    def event_count_since(self, user_id, since_ms) -> int:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                """
+                SELECT COUNT(*)
+                FROM events
+                WHERE user_id = %s
+                  AND timestamp_ms IS NOT NULL
+                  AND timestamp_ms >= %s
+                """,
+                (user_id, since_ms),
+            ).fetchone()
+        return int(row[0])
+
+    def low_risk_count(self, user_id) -> int:
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT low_risk_count FROM user_stats WHERE user_id = %s", (user_id,)
+            ).fetchone()
+        return int(row[0]) if row else 0
+
+    def event_stats(self, user_id, values):
+        with self.pool.connection() as conn:
+            cur = conn.cursor()
+            cur.execute(
+                """
+                SELECT
+                    (SELECT total_events FROM user_stats WHERE user_id = %s),
+                    (SELECT COUNT(*) FROM user_daily_stats WHERE user_id = %s)
+                """,
+                (user_id, user_id),
+            )
+            total_events, distinct_days = cur.fetchone()
+
+            counts: Dict[str, int] = {}
+            for field_name, value in values.items():
+                if not value:
+                    counts[field_name] = 0
+                    continue
+                cur.execute(
+                    f"""
+                    SELECT event_count
+                    FROM user_{field_name}_counts
+                    WHERE user_id = %s
+                      AND {field_name} = %s
+                    """,
+                    (user_id, value),
+                )
+                row = cur.fetchone()
+                counts[field_name] = int(row[0]) if row else 0
+
+        return int(total_events or 0), int(distinct_days or 0), counts
+
+    def recent_events(self, limit):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT {_EVENT_FIELDS_SQL}
+                FROM events
+                ORDER BY id DESC
+                LIMIT %s
+                """,
+                (limit,),
+            ).fetchall()
+        return [dict(zip(EVENT_FIELDS, r)) for r in rows]
+
+    def events_since(self, since_id, limit):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                f"""
+                SELECT {_EVENT_FIELDS_SQL}
+                FROM events
+                WHERE id > %s
+                ORDER BY id
+                LIMIT %s
+                """,
+                (since_id, limit),
+            ).fetchall()
+        return [dict(zip(EVENT_FIELDS, r)) for r in rows]
+
+    def sequence_history(self, user_id, limit):
+        with self.pool.connection() as conn:
+            rows = conn.execute(
+                """
+                SELECT service
+                FROM events
+                WHERE user_id = %s
+                ORDER BY id DESC
+                LIMIT %s
+                """,
+                (user_id, int(limit)),
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    def city_regions(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute("SELECT name_key, region FROM city_region").fetchall()
+        return dict(rows)
+
+    def upsert_city_regions(self, rows) -> int:
+        records = city_region_records(rows)
+        with self.pool.connection() as conn:
+            conn.cursor().executemany(_UPSERT_REGION_SQL, records)
+        return len(records)
+
+    def close(self) -> None:
+        self.pool.close()
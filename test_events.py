@@ -1,14 +1,30 @@
-import requests
 import time
 from datetime import datetime, timedelta
 
 URL = "http://127.0.0.1:5000/score"
 
+# القيم المستخدمة في السيناريو (يعاد استخدامها في benchmark.py)
+CITIES = ["Riyadh", "Jeddah", "Dammam", "Medina", "Abha", "Tabuk"]
+DEVICES = ["iPhone", "Galaxy", "Huawei", "MacBook", "Windows-PC", "Windows-Laptop"]
+SERVICES = [
+    "view_profile",
+    "login",
+    "pay_bills",
+    "e-service",
+    "otp_request",
+    "renew_id",
+    "renew_license",
+    "reset_password",
+    "change_mobile",
+]
+
 # -----------------------
 # Helpers
 # -----------------------
 
 def send(user, device, city, service, minutes_ago=0):
+    import requests
+
     event_time = datetime.now() - timedelta(minutes=minutes_ago)
     payload = {
         "user_id": user,
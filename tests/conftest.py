@@ -0,0 +1,26 @@
+import os
+import sys
+import tempfile
+
+import pytest
+
+# الاختبارات لا تلمس events.db الخاص بالمشروع: التخزين يُختار عند استيراد database.py
+# فلازم نحدده قبل أي استيراد
+_TMP = tempfile.mkdtemp(prefix="snd-tests-")
+os.environ["SND_DATABASE_URL"] = "sqlite:///" + os.path.join(_TMP, "events.db")
+os.environ.setdefault("SND_FEATURE_STORE_DIR", os.path.join(_TMP, "features"))
+os.environ.setdefault("SND_ARCHIVE_DIR", os.path.join(_TMP, "archive"))
+os.environ.setdefault("SND_MODEL_REGISTRY", os.path.join(_TMP, "models"))
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+if ROOT not in sys.path:
+    sys.path.insert(0, ROOT)
+
+
+@pytest.fixture(scope="session", autouse=True)
+def _schema():
+    import database
+
+    database.init_db()
+    yield
+    database.close_all_connections()
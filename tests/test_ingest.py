@@ -0,0 +1,48 @@
+import json
+
+import database
+import ingest
+
+
+def _indexes():
+    conn = database.get_connection(database.store.db_path)
+    try:
+        rows = conn.execute(
+            "SELECT name FROM sqlite_master WHERE tbl_name = 'events' AND type = 'index'"
+            " AND sql IS NOT NULL"
+        ).fetchall()
+    finally:
+        database.release_connection(conn, database.store.db_path)
+    return {r[0] for r in rows}
+
+
+def test_scored_ingest_keeps_window_index_for_existing_users(tmp_path, monkeypatch):
+    database.insert_event("ingest-existing", "iphone", "riyadh", "central", "ios", "safari",
+                          "login", "2025-10-01T09:00:00", 1759309200000, 5.0, 0.0, 0.0, "Allow", "{}")
+    before = _indexes()
+    assert "idx_events_user_ts" in before
+
+    # أثناء التقييم: بصمة كل مستخدم موجود تُقرأ بفهرس النافذة (وليس مسحاً كاملاً)
+    seen = []
+    load_profile = ingest._load_user_profile
+
+    def load_and_check(user_id):
+        seen.append((user_id, _indexes()))
+        return load_profile(user_id)
+
+    monkeypatch.setattr(ingest, "_load_user_profile", load_and_check)
+
+    path = tmp_path / "history.jsonl"
+    with open(path, "w", encoding="utf-8") as f:
+        for minute in range(3):
+            f.write(json.dumps({
+                "user_id": "ingest-existing", "device": "iphone", "city": "riyadh",
+                "service": "login", "event_time": f"2025-10-02T09:0{minute}:00",
+            }) + "\n")
+
+    report = ingest.ingest_files([str(path)], score=True)
+    assert report["read"] == 3
+    assert [user for user, _ in seen] == ["ingest-existing"]
+    during = seen[0][1]
+    assert during == set(ingest.SCORING_INDEXES)
+    assert _indexes() == before
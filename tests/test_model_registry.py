@@ -0,0 +1,93 @@
+import os
+import threading
+
+import numpy as np
+import pytest
+from sklearn.ensemble import IsolationForest
+
+import database
+from app import model as model_module
+from app.model_registry import ModelRegistry
+from storage_conformance import scenario
+
+
+def _forest(seed=0):
+    X = np.random.default_rng(seed).random((300, 4))
+    return IsolationForest(n_estimators=20, random_state=seed).fit(X), X
+
+
+def test_publish_activate_and_load(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    assert registry.active_version() is None
+
+    first, X = _forest(0)
+    v1 = registry.publish(first, {"feature_keys": ["a", "b", "c", "d"]})
+    v2 = registry.publish(_forest(1)[0], {"feature_keys": ["a", "b", "c", "d"]}, activate=False)
+    assert (v1, v2) == ("v0001", "v0002")
+    assert registry.versions() == [v1, v2]
+    assert registry.active_version() == v1
+
+    loaded = registry.load(v1)
+    assert loaded.version == v1 and loaded.feature_keys == ["a", "b", "c", "d"]
+    np.testing.assert_allclose(loaded.model.decision_function(X), first.decision_function(X))
+
+    registry.activate(v2)
+    assert registry.active_version() == v2
+    with pytest.raises(ValueError):
+        registry.activate("v0099")
+
+
+def test_train_model_defaults_to_service_database(tmp_path, monkeypatch):
+    db_path = str(tmp_path / "service.db")
+    store = database.SQLiteEventStore(db_path)
+    store.init_schema()
+    store.insert_events(scenario(300))
+
+    registry = ModelRegistry(str(tmp_path / "models"))
+    # SND_DATABASE_URL=sqlite:///... : قاعدة الخدمة هي store.db_path وليست DB_PATH
+    monkeypatch.setattr(database, "store", store)
+    monkeypatch.setattr(model_module, "registry", registry)
+    # مجلد آخر بدون events.db: التدريب لازم يقرأ قاعدة الخدمة وليس المجلد الحالي
+    workdir = tmp_path / "elsewhere"
+    workdir.mkdir()
+    monkeypatch.chdir(workdir)
+
+    version = model_module.train_model()
+    meta = registry.metadata(version)
+    assert meta["db_path"] == os.path.abspath(db_path)
+    assert meta["training_rows"] > 0
+    assert not os.path.exists(workdir / "events.db")
+
+
+def test_train_model_refuses_non_sqlite_store(monkeypatch):
+    class _SharedStore:
+        name = "postgresql"
+
+    monkeypatch.setattr(database, "store", _SharedStore())
+    with pytest.raises(ValueError, match="SQLite only"):
+        model_module.train_model()
+
+
+def test_concurrent_activations_publish_whole_versions(tmp_path):
+    registry = ModelRegistry(str(tmp_path / "models"))
+    versions = [registry.publish(_forest(i)[0], {"feature_keys": ["a", "b", "c", "d"]}) for i in (0, 1)]
+
+    errors, seen = [], set()
+
+    def activate(version):
+        try:
+            for _ in range(200):
+                registry.activate(version)
+                seen.add(registry.active_version())
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=activate, args=(v,)) for v in versions for _ in range(2)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert seen <= set(versions)
+    assert not [name for name in os.listdir(registry.root) if name.endswith(".tmp")]
@@ -0,0 +1,119 @@
+import threading
+
+import numpy as np
+import pytest
+
+from app.online_model import ONLINE_TYPICAL_SCORE, HalfSpaceForest, limits_for
+
+LIMITS = [(0.0, 1.0, False), (0.0, 100.0, True), (0.0, 10.0, False)]
+
+
+def _rows(n, seed=0):
+    return np.random.default_rng(seed).random((n, 3)) * [1.0, 100.0, 10.0]
+
+
+def test_ready_after_first_window_and_calibrated():
+    model = HalfSpaceForest(LIMITS, window_size=200)
+    X = _rows(400)
+    model.learn(X[:199])
+    assert not model.ready
+    model.learn(X[199:200])
+    assert model.ready and model.windows_completed == 1
+
+    scores = model.decision_function(X[:200])
+    # المعايرة على النافذة نفسها: الوسيط ≈ ONLINE_TYPICAL_SCORE و contamination تحت الصفر
+    assert abs(float(np.median(scores)) - ONLINE_TYPICAL_SCORE) < 1e-6
+    assert 0 < (scores < 0).mean() <= model.contamination + 0.01
+
+
+def test_scores_during_rotation_use_one_reference():
+    """
+    التقييم المتزامن مع تبديل النافذة: كل نتيجة لازم تطابق مرجعاً منشوراً كاملاً
+    (كتلته مع معايرته)، وليس كتلة نافذة مع معايرة نافذة أخرى.
+    """
+    model = HalfSpaceForest(LIMITS, window_size=20, n_trees=5, depth=6)
+    probe = _rows(1, seed=99)
+    model.learn(_rows(20, seed=1))
+
+    published = [model._ref]
+    seen = []
+    done = threading.Event()
+
+    def reader():
+        while not done.is_set():
+            seen.append(float(model.decision_function(probe)[0]))
+
+    thread = threading.Thread(target=reader)
+    thread.start()
+    try:
+        for row in _rows(4000, seed=2):
+            model.learn(row)
+            if model._ref is not published[-1]:
+                published.append(model._ref)
+    finally:
+        done.set()
+        thread.join()
+
+    valid = set()
+    for ref in published:
+        log_mass = model._log_mass(model._scale_rows(probe), ref.mass)
+        valid.add(float(np.clip((log_mass - ref.offset) * ref.scale, -0.5, 0.5)[0]))
+    assert seen
+    assert set(seen) <= valid
+
+
+def test_save_and_restore_continue_the_same_stream(tmp_path):
+    path = str(tmp_path / "online_state.npz")
+    X = _rows(700, seed=3)
+    model = HalfSpaceForest(LIMITS, window_size=200)
+    model.learn(X[:450])
+    model.save(path)
+
+    restored = HalfSpaceForest(LIMITS, window_size=200)
+    assert restored.load(path)
+    assert (restored.samples_seen, restored.windows_completed) == (450, 2)
+    probe = _rows(50, seed=4)
+    np.testing.assert_array_equal(restored.decision_function(probe), model.decision_function(probe))
+
+    # النافذة الجارية محفوظة أيضاً: التبديل القادم يعطي نفس المرجع
+    model.learn(X[450:])
+    restored.learn(X[450:])
+    np.testing.assert_array_equal(restored.decision_function(probe), model.decision_function(probe))
+
+
+def test_restore_ignores_state_from_other_settings(tmp_path):
+    path = str(tmp_path / "online_state.npz")
+    model = HalfSpaceForest(LIMITS, window_size=200)
+    model.learn(_rows(300))
+    model.save(path)
+
+    other = HalfSpaceForest(LIMITS, window_size=200, depth=8)
+    assert not other.load(path)
+    assert other.samples_seen == 0 and not other.ready
+
+
+def test_service_restores_saved_state_and_refuses_several_workers(tmp_path, monkeypatch):
+    from app import model as model_module
+
+    limits = limits_for(model_module.FEATURE_KEYS, model_module.ONLINE_FEATURE_LIMITS)
+    monkeypatch.setattr(model_module, "ONLINE_STATE_PATH", str(tmp_path / "online_state.npz"))
+    monkeypatch.setattr(model_module, "_online_saved_samples", 0)
+    monkeypatch.setattr(model_module, "_online_saver", None)
+    monkeypatch.delenv("SND_WORKER_PROCESSES", raising=False)
+
+    learned = HalfSpaceForest(limits, window_size=50)
+    learned.learn(np.random.default_rng(5).random((120, len(limits))))
+    monkeypatch.setattr(model_module, "online_model", learned)
+    assert model_module.save_online_model()
+    assert not model_module.save_online_model()  # لا جديد منذ آخر حفظ
+
+    # إعادة تشغيل: نموذج جديد في الذاكرة يستعيد ما حُفظ
+    fresh = HalfSpaceForest(limits, window_size=50)
+    monkeypatch.setattr(model_module, "online_model", fresh)
+    model_module.start_online_model(interval=0)
+    assert fresh.samples_seen == 120 and fresh.ready
+
+    monkeypatch.setattr(model_module, "_online_saver", None)
+    monkeypatch.setenv("SND_WORKER_PROCESSES", "4")
+    with pytest.raises(RuntimeError, match="single worker"):
+        model_module.start_online_model(interval=0)
@@ -0,0 +1,102 @@
+import json
+import os
+import shutil
+
+import numpy as np
+import pytest
+
+from app import policy as policy_module
+
+
+@pytest.fixture
+def policy_path(tmp_path, monkeypatch):
+    path = str(tmp_path / "policy.json")
+    monkeypatch.setattr(policy_module, "POLICY_PATH", path)
+    monkeypatch.setattr(policy_module, "_active", None)
+    monkeypatch.setattr(policy_module, "_active_mtime", None)
+    monkeypatch.setattr(policy_module, "_failed_mtime", None)
+    return path
+
+
+def _shipped_spec():
+    with open(policy_module.SHIPPED_POLICY_PATH, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _write(path, spec, mtime_ns):
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(spec, f)
+    os.utime(path, ns=(mtime_ns, mtime_ns))
+
+
+def test_missing_file_uses_shipped_policy(policy_path):
+    policy = policy_module.get_policy()
+    assert policy.source == policy_module.SHIPPED_POLICY_PATH
+    assert policy.version == _shipped_spec()["version"]
+
+    # الملف يظهر لاحقاً: الفحص الدوري يحمّله
+    _write(policy_path, dict(_shipped_spec(), version="local"), 1_000_000_000)
+    assert policy_module.reload_policy()
+    assert policy_module.get_policy().source == policy_path
+
+
+def test_invalid_file_keeps_last_good_policy(policy_path):
+    _write(policy_path, dict(_shipped_spec(), version="good"), 1_000_000_000)
+    assert policy_module.get_policy().version == "good"
+
+    # spec بشكل خاطئ يرمي AttributeError داخل CompiledPolicy
+    bad = dict(_shipped_spec(), version="bad", rules_score=["not", "a", "mapping"])
+    _write(policy_path, bad, 2_000_000_000)
+    assert not policy_module.reload_policy()
+    assert policy_module.get_policy().version == "good"
+    assert policy_module._failed_mtime == 2_000_000_000
+
+    os.remove(policy_path)
+    assert not policy_module.reload_policy()
+    assert policy_module.get_policy().version == "good"
+
+
+def test_invalid_file_at_startup_uses_shipped_policy(policy_path):
+    _write(policy_path, ["not", "a", "policy"], 1_000_000_000)
+    assert policy_module.get_policy().source == policy_module.SHIPPED_POLICY_PATH
+    # لا إعادة محاولة مع كل طلب حتى يتغير الملف
+    assert not policy_module.reload_policy()
+
+
+def test_invalid_shipped_file_uses_minimal_fallback(policy_path, monkeypatch):
+    monkeypatch.setattr(policy_module, "SHIPPED_POLICY_PATH", policy_path)
+    shutil.copy(os.devnull, policy_path)
+    policy = policy_module.get_policy()
+    assert policy.source == "fallback"
+    assert [policy.evaluate({}, score)[2] for score in (10, 50, 70, 90)] == [
+        "Allow", "Alert", "Challenge", "Block",
+    ]
+
+
+def test_batch_evaluation_matches_single_events():
+    policy = policy_module.CompiledPolicy(_shipped_spec())
+
+    rng = np.random.default_rng(0)
+    features_list = [
+        {
+            "is_known_city": int(rng.integers(2)),
+            "is_new_device": int(rng.integers(2)),
+            "is_sensitive_service": int(rng.integers(2)),
+            "is_new_user": int(rng.integers(2)),
+            "time_window": str(rng.choice(["morning", "night", "late_night"])),
+            "events_last_1h": int(rng.integers(8)),
+            "events_last_24h": int(rng.integers(30)),
+            "avg_daily_events": float(rng.integers(80)),
+            "city_frequency": int(rng.integers(1, 3)),
+            "device_frequency": int(rng.integers(1, 3)),
+            "service_frequency": int(rng.integers(1, 3)),
+        }
+        for _ in range(200)
+    ]
+    ai_scores = rng.uniform(0, 100, len(features_list))
+
+    batch = policy.evaluate_batch(features_list, ai_scores)
+    for i, features in enumerate(features_list):
+        expected = policy.evaluate(features, float(ai_scores[i]))
+        assert (batch[0][i], batch[1][i], batch[2][i]) == pytest.approx(expected[:3])
+        assert list(batch[3][i]) == list(expected[3])
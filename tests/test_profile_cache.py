@@ -0,0 +1,191 @@
+import random
+import threading
+
+import pytest
+
+import database
+from profile_cache import ProfileCache, UserProfile
+from storage_conformance import scenario
+
+
+def _snapshot(profile, stamps):
+    """
+    كل ما يقرأه build_features من البصمة، في شكل قابل للمقارنة.
+    """
+    return (
+        profile.total_events,
+        profile.low_risk_count,
+        sorted(profile.active_days),
+        profile.city_counts,
+        profile.device_counts,
+        profile.service_counts,
+        profile.last_event,
+        [profile.velocity.counts(t) for t in stamps],
+        (profile.transitions.last, profile.transitions.prev, dict(profile.transitions.ngrams)),
+    )
+
+
+def _insert(row):
+    database.insert_event(*row)
+
+
+def _rows_for(prefix, n_events=600, seed=11):
+    # نفس سيناريو اختبار التوافق (timezones مختلفة، timestamp فارغ، أحداث غير مرتبة)
+    # لكن بمستخدمين خاصين بهذا الاختبار
+    return [(f"{prefix}-{r[0]}",) + r[1:] for r in scenario(n_events, seed)]
+
+
+def _assert_cache_matches_cold_load(rows):
+    users = sorted({r[0] for r in rows})
+    stamps = sorted({r[8] for r in rows if r[8] is not None})[::50]
+    for user_id in users:
+        cached = database.get_user_profile(user_id)
+        cold = database._load_user_profile(user_id)
+        assert _snapshot(cached, stamps) == _snapshot(cold, stamps), user_id
+
+
+def test_incremental_profile_matches_cold_load():
+    rows = _rows_for("inc")
+    # البصمة في الكاش من أول حدث ثم تتحدث بـ on_insert فقط
+    for user_id in {r[0] for r in rows}:
+        database.get_user_profile(user_id)
+    for row in rows:
+        _insert(row)
+    _assert_cache_matches_cold_load(rows)
+
+
+def test_high_risk_events_are_not_stored_or_counted():
+    row = ("risky-user",) + scenario(1)[0][1:]
+    database.get_user_profile("risky-user")
+    _insert(row[:9] + (database.MAX_STORED_RISK_SCORE + 1,) + row[10:])
+    assert database.get_user_profile("risky-user").total_events == 0
+    assert database._load_user_profile("risky-user").total_events == 0
+
+
+@pytest.mark.parametrize("write_behind", [False, True])
+def test_concurrent_writes_and_loads_do_not_double_count(write_behind):
+    """
+    الحفظ يتم خارج قفل الكاش: تحميل بارد متزامن مع الكتابة (بعد إبطال البصمة)
+    لازم لا يحسب الحدث مرتين ولا يسقطه.
+    """
+    prefix = "wb" if write_behind else "sync"
+    rows = _rows_for(prefix, n_events=1600, seed=5)
+    users = sorted({r[0] for r in rows})
+    chunks = [rows[i::8] for i in range(8)]
+
+    def worker(chunk, seed):
+        rng = random.Random(seed)
+        for row in chunk:
+            _insert(row)
+            user_id = rng.choice(users)
+            if rng.random() < 0.3:
+                database.profile_cache.invalidate(user_id)
+            database.get_user_profile(user_id)
+
+    if write_behind:
+        database.enable_write_behind()
+    try:
+        threads = [threading.Thread(target=worker, args=(c, i)) for i, c in enumerate(chunks)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+    finally:
+        if write_behind:
+            database.disable_write_behind()
+
+    for user_id in users:
+        cached = database.get_user_profile(user_id)
+        cold = database._load_user_profile(user_id)
+        # الأحداث من threads مختلفة بترتيب غير محدد: نقارن العدادات التي لا تعتمد على الترتيب
+        assert (cached.total_events, cached.low_risk_count, cached.city_counts,
+                cached.device_counts, cached.service_counts, sorted(cached.active_days)) == \
+               (cold.total_events, cold.low_risk_count, cold.city_counts,
+                cold.device_counts, cold.service_counts, sorted(cold.active_days)), user_id
+        assert cold.total_events == sum(1 for r in rows if r[0] == user_id)
+    assert database.profile_cache._sync == {}
+
+
+def test_write_behind_reads_its_own_writes():
+    rows = _rows_for("ryw", n_events=40)
+    writer = database.enable_write_behind(flush_interval=60, batch_size=10000)
+    try:
+        for row in rows:
+            _insert(row)
+        # لم يُكتب شيء بعد: التحميل البارد يرى الأحداث المعلّقة
+        user_id = rows[0][0]
+        assert writer.pending_for(user_id)
+        expected = sum(1 for r in rows if r[0] == user_id)
+        database.profile_cache.invalidate(user_id)
+        assert database.get_user_profile(user_id).total_events == expected
+    finally:
+        database.disable_write_behind()
+    assert database._load_user_profile(user_id).total_events == expected
+
+
+
+class _FakeStore:
+    """
+    "قاعدة" في الذاكرة لـ ProfileCache: loader يقرأ لقطة ثم يشغّل hook
+    (كتابة متزامنة في نفس اللحظة بين القراءة وإدخال البصمة في الكاش).
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.during_load = None
+
+    def load(self, user_id):
+        profile = UserProfile(user_id)
+        for row in [r for r in self.rows if r[0] == user_id]:
+            profile.apply_event(*row[1:])
+        hook, self.during_load = self.during_load, None
+        if hook is not None:
+            hook()
+        return profile
+
+    def write(self, cache, row, commit_only=False):
+        cache.begin_write(row[0])
+        self.rows.append(row)
+        if not commit_only:
+            self.finish(cache, row)
+
+    @staticmethod
+    def finish(cache, row):
+        cache.on_insert(row[0], *row[1:])
+        cache.end_write(row[0])
+
+
+_ROW = ("u1", "iphone", "riyadh", "login", "2025-01-01T10:00:00", 1735725600000, 10.0)
+
+
+def test_write_committed_during_load_is_not_lost():
+    db = _FakeStore()
+    cache = ProfileCache(loader=db.load)
+    # اللقطة قُرئت قبل الحدث، والحدث حُفظ و on_insert تجاهله (البصمة ليست في الكاش بعد)
+    db.during_load = lambda: db.write(cache, _ROW)
+    assert cache.get("u1").total_events == 1
+    assert cache.get("u1").total_events == 1
+
+
+def test_write_in_flight_during_load_is_not_double_counted():
+    db = _FakeStore()
+    cache = ProfileCache(loader=db.load)
+    # الحدث محفوظ (التحميل يراه) لكن on_insert لم يصل بعد
+    db.write(cache, _ROW, commit_only=True)
+    assert cache.get("u1").total_events == 1
+    db.finish(cache, _ROW)
+    assert cache.get("u1").total_events == 1
+
+
+def test_invalidate_during_load_discards_stale_profile():
+    db = _FakeStore()
+    cache = ProfileCache(loader=db.load)
+    db.rows.append(_ROW)
+
+    def purge():
+        db.rows.clear()
+        cache.invalidate()
+
+    db.during_load = purge
+    cache.get("u1")
+    assert cache.get("u1").total_events == 0
@@ -0,0 +1,70 @@
+import sys
+import threading
+
+import database
+import regions
+from regions import UNKNOWN_REGION, RegionResolver, normalize_city_name
+
+
+def test_normalized_lookup():
+    resolver = RegionResolver(lambda: {normalize_city_name("Al-Khobar"): "east"})
+    assert resolver.resolve("الخُبَر") == UNKNOWN_REGION
+    assert resolver.resolve("al khobar") == "east"
+    assert resolver.resolve("Khobar") == "east"
+
+
+def test_concurrent_misses_are_counted_exactly(monkeypatch):
+    monkeypatch.setattr(regions, "REGION_MISS_TRACK_LIMIT", 50)
+    resolver = RegionResolver(dict)
+    threads, per_thread = 8, 500
+    barrier = threading.Barrier(threads)
+
+    def worker(n):
+        barrier.wait()
+        for i in range(per_thread):
+            resolver.resolve(f"city {n} {i % 100}")
+
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    try:
+        pool = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+        for t in pool:
+            t.start()
+        for t in pool:
+            t.join()
+    finally:
+        sys.setswitchinterval(interval)
+
+    assert resolver.misses == threads * per_thread
+    assert len(resolver.miss_names) == 50
+    # كل اسم وصل 5 مرات (مرة من الحساب ثم 4 من الكاش)
+    assert set(resolver.miss_names.values()) == {per_thread // 100}
+
+
+def test_repeated_miss_is_counted_every_time():
+    resolver = RegionResolver(dict)
+    for _ in range(5):
+        assert resolver.resolve("Atlantis") == UNKNOWN_REGION
+    resolver.resolve("El Dorado")
+    assert resolver.misses == 6
+    assert resolver.top_misses() == [("atlantis", 5), ("dorado", 1)]
+
+
+def test_refresh_reaches_running_resolver():
+    table = {normalize_city_name("Riyadh"): "central"}
+    resolver = RegionResolver(lambda: dict(table))
+    assert resolver.resolve("AlUla") == UNKNOWN_REGION
+
+    table[normalize_city_name("AlUla")] = "north"
+    assert resolver.refresh()
+    assert resolver.resolve("AlUla") == "north"
+    # بدون تغيير لا نفرّغ الكاش
+    assert not resolver.refresh()
+
+
+def test_gazetteer_load_is_picked_up_by_service():
+    assert database.resolve_region("Tayma") == UNKNOWN_REGION
+    database.store.upsert_city_regions([("north", "Tayma"), ("north", "تيماء")])
+    # ما يفعله الفحص الدوري (start_region_reloader) في العمليات الشغالة
+    assert database.region_resolver.refresh()
+    assert database.resolve_region("تيماء") == "north"
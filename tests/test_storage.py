@@ -0,0 +1,30 @@
+import os
+
+import pytest
+
+from storage_conformance import _postgres_store, _sqlite_store, run_conformance
+
+# PostgreSQL اختياري: SND_TEST_POSTGRES_URL=postgresql://... python -m pytest
+POSTGRES_URL = os.environ.get("SND_TEST_POSTGRES_URL", "")
+
+
+def _run(factory):
+    store, cleanup = factory()
+    try:
+        return run_conformance(store)
+    finally:
+        cleanup()
+
+
+def test_sqlite_conformance():
+    checks, failures = _run(_sqlite_store)
+    assert checks > 50
+    assert failures == []
+
+
+@pytest.mark.skipif(not POSTGRES_URL, reason="SND_TEST_POSTGRES_URL غير محدد")
+def test_postgres_conformance():
+    pytest.importorskip("psycopg")
+    checks, failures = _run(lambda: _postgres_store(POSTGRES_URL))
+    assert checks > 50
+    assert failures == []
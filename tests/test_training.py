@@ -0,0 +1,38 @@
+import numpy as np
+
+import database
+from app import model as model_module
+from storage_conformance import scenario
+
+
+def _service_db(tmp_path, rows):
+    db_path = str(tmp_path / "service.db")
+    store = database.SQLiteEventStore(db_path)
+    store.init_schema()
+    store.insert_events(rows)
+    return db_path, store
+
+
+def test_parallel_matrix_matches_sequential(tmp_path):
+    db_path, _ = _service_db(tmp_path, scenario(600))
+    expected = model_module.load_training_matrix(db_path)
+    got = model_module.load_training_matrix_parallel(db_path, workers=3)
+    np.testing.assert_array_equal(got, expected)
+
+
+def test_parallel_matrix_ignores_events_inserted_during_training(tmp_path, monkeypatch):
+    rows = scenario(900)
+    db_path, store = _service_db(tmp_path, rows[:600])
+    expected = model_module.load_training_matrix(db_path)
+
+    assign_shards = model_module._assign_shards
+
+    def assign_then_insert(conn, n_shards, max_id=None):
+        shards = assign_shards(conn, n_shards, max_id)
+        # الخدمة تكتب أحداثاً بعد حساب الأحجام وقبل أن تقرأ الـ workers
+        store.insert_events(rows[600:])
+        return shards
+
+    monkeypatch.setattr(model_module, "_assign_shards", assign_then_insert)
+    got = model_module.load_training_matrix_parallel(db_path, workers=3)
+    np.testing.assert_array_equal(got, expected)
@@ -0,0 +1,70 @@
+import random
+
+import database
+import velocity
+from velocity import WINDOW_SPECS, VelocityCounters
+
+MINUTE = 60 * 1000
+
+
+def _baseline(stamps, window_ms, now_ms):
+    # نفس تعريف الاستعلام الأصلي: timestamp_ms >= now - window
+    return sum(1 for t in stamps if t >= now_ms - window_ms)
+
+
+def test_oldest_partial_minute_is_counted():
+    now = 1_760_000_000_000 + 17_345  # ليس على حد دقيقة
+    counters = VelocityCounters()
+    for minutes_ago in range(60, 50, -1):
+        counters.add(now - minutes_ago * MINUTE)
+    assert counters.count("1h", now) == 10
+    assert counters.count("1h", now + 1) == 9
+    assert counters.count("5m", now) == 0
+
+
+def test_counts_match_baseline_with_late_events():
+    rng = random.Random(4)
+    base = 1_760_000_000_000
+    counters = VelocityCounters()
+    stamps = []
+    for i in range(3000):
+        t = base + i * rng.randrange(1, 15 * MINUTE)
+        if rng.random() < 0.1:
+            t -= rng.randrange(0, 30 * 60 * MINUTE)  # حدث متأخر
+        counters.add(t)
+        stamps.append(t)
+        if i % 7 == 0:
+            newest = max(stamps)
+            for now in (t, newest, t - rng.randrange(0, 3 * 60 * MINUTE)):
+                for name, ms in WINDOW_SPECS:
+                    # الطوابع محفوظة لأطول نافذة من أحدث حدث فقط
+                    if now - ms >= newest - velocity.LONGEST_WINDOW_MS:
+                        # أكثر من VELOCITY_MAX_EVENTS في النافذة: العدّ يتشبع عند الحد
+                        expected = min(_baseline(stamps, ms, now), velocity.VELOCITY_MAX_EVENTS)
+                        assert counters.count(name, now) == expected
+
+
+def test_memory_is_capped(monkeypatch):
+    monkeypatch.setattr(velocity, "VELOCITY_MAX_EVENTS", 100)
+    counters = VelocityCounters()
+    now = 1_760_000_000_000
+    for i in range(1000):
+        counters.add(now + i)
+    assert counters.count("5m", now + 999) == 100
+    assert len(counters._ts) <= 200
+
+
+def test_cold_load_matches_sql_baseline():
+    rng = random.Random(9)
+    now = 1_760_000_000_000
+    stamps = sorted(now - rng.randrange(0, 9 * 24 * 60 * MINUTE) for _ in range(400))
+    for t in stamps:
+        database.insert_event("velocity-user", "iphone", "riyadh", "central", "ios", "safari",
+                              "login", "2025-10-09T10:00:00", t, 5.0, 0.0, 0.0, "Allow", "{}")
+    profile = database._load_user_profile("velocity-user")
+    for probe in (now, stamps[-1], stamps[200], stamps[-1] - 30 * MINUTE):
+        for name, ms in WINDOW_SPECS:
+            if probe - ms < stamps[-1] - velocity.LONGEST_WINDOW_MS:
+                continue
+            expected = database.store.event_count_since("velocity-user", probe - ms)
+            assert profile.count_window(name, probe) == expected, (name, probe)
@@ -0,0 +1,112 @@
+import os
+from array import array
+from bisect import bisect_left, insort
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# ---------------------- عدادات السرعة (Velocity) ---------------------- #
+#
+# لكل مستخدم مصفوفة array مضغوطة ومرتبة بطوابع أحداثه داخل أطول نافذة
+# (5 دقائق / ساعة / يوم / أسبوع ...) مشتركة بين كل النوافذ:
+# - العدّ بوقت الحدث: bisect واحد لكل نافذة (O(log n))، ونفس تعريف الاستعلام الأصلي بالضبط
+#   (timestamp_ms >= now - window، ومعها أي أحداث بعد now)
+# - الإضافة: append للأحداث المرتبة زمنياً (insort للمتأخرة) + قص ما خرج من أطول نافذة
+# - نحتفظ بآخر VELOCITY_MAX_EVENTS طابع فقط: كل نافذة = min(العدد الفعلي, VELOCITY_MAX_EVENTS)
+#   (الميزات تتشبع قبل ذلك بكثير: events_last_24h حدها 500 في النموذج المتعلّم، والقواعد عند 24)
+# - الذاكرة: الجزء المقصوص يُحذف فعلياً عندما يتجاوز نصف المصفوفة، فأسوأ حالة لكل مستخدم
+#   2 × VELOCITY_MAX_EVENTS × 8 bytes = 16 KB بالافتراضي، أي لكل عملية حتى
+#   PROFILE_CACHE_MAX_USERS (10000) × 16 KB ≈ 160 MB لو كل المستخدمين بهذا النشاط
+# - العدّ دقيق ما دامت بداية النافذة (now - window) داخل أطول نافذة من أحدث حدث
+#   (حدث متأخر جداً مع نافذة طويلة لا يرى ما قبل ذلك)
+#
+# (خانات زمنية ثابتة العرض أرخص لكنها تسقط جزء الخانة الأقدم الذي ما زال داخل النافذة،
+# والنموذج والسياسة معايَران على العدّ الدقيق)
+
+_UNITS_MS = {"s": 1000, "m": 60 * 1000, "h": 3600 * 1000, "d": 24 * 3600 * 1000}
+
+# أقصى عدد طوابع نحتفظ بها لكل مستخدم (بعدها تُسقط الأقدم، فعدّ أي نافذة يتشبع عند هذا الحد)
+VELOCITY_MAX_EVENTS = int(os.environ.get("SND_VELOCITY_MAX_EVENTS", "1000"))
+
+# 1h و 24h مطلوبتان دائماً (ميزات النموذج والقواعد)
+REQUIRED_WINDOWS = ("1h", "24h")
+
+VELOCITY_WINDOWS: Tuple[str, ...] = tuple(
+    w.strip()
+    for w in os.environ.get("SND_VELOCITY_WINDOWS", "5m,1h,24h,7d").split(",")
+    if w.strip()
+)
+
+
+def window_ms(name: str) -> int:
+    """
+    "5m" → 300000 ، "24h" → 86400000 ...
+    """
+    return int(name[:-1]) * _UNITS_MS[name[-1]]
+
+
+def _window_specs() -> List[Tuple[str, int]]:
+    names = list(VELOCITY_WINDOWS)
+    for name in REQUIRED_WINDOWS:
+        if name not in names:
+            names.append(name)
+    specs = [(name, window_ms(name)) for name in names]
+    return sorted(specs, key=lambda s: s[1])
+
+
+# [(اسم النافذة, طولها بالـ ms)] من الأصغر للأكبر
+WINDOW_SPECS = _window_specs()
+
+# الطوابع الأقدم من (أحدث طابع - هذا) لا تدخل أي نافذة
+LONGEST_WINDOW_MS = WINDOW_SPECS[-1][1]
+
+
+class VelocityCounters:
+    """
+    عدادات النوافذ المنزلقة لمستخدم واحد.
+    """
+
+    __slots__ = ("_ts", "_start")
+
+    def __init__(self):
+        self._ts = array("q")
+        self._start = 0  # أول طابع ما زال داخل أطول نافذة (القص بدون نسخ في كل إضافة)
+
+    def add(self, timestamp_ms: Optional[int]) -> None:
+        if timestamp_ms is None:
+            return
+        ts = self._ts
+        if not ts or timestamp_ms >= ts[-1]:
+            ts.append(timestamp_ms)
+            self._trim()
+        elif timestamp_ms >= ts[-1] - LONGEST_WINDOW_MS:
+            # حدث متأخر لكنه داخل النافذة
+            insort(ts, timestamp_ms, self._start)
+            self._trim()
+
+    def _trim(self) -> None:
+        ts = self._ts
+        start = bisect_left(ts, ts[-1] - LONGEST_WINDOW_MS, self._start)
+        start = max(start, len(ts) - VELOCITY_MAX_EVENTS)
+        if start > len(ts) // 2:
+            del ts[:start]
+            start = 0
+        self._start = start
+
+    def count(self, window: str, now_ms: int) -> int:
+        return len(self._ts) - bisect_left(self._ts, now_ms - _WINDOW_MS[window], self._start)
+
+    def counts(self, now_ms: int) -> Dict[str, int]:
+        """
+        {"5m": ..., "1h": ..., "24h": ..., "7d": ...} بوقت الحدث now_ms.
+        """
+        ts, start, n = self._ts, self._start, len(self._ts)
+        return {name: n - bisect_left(ts, now_ms - ms, start) for name, ms in WINDOW_SPECS}
+
+    def load(self, timestamps: Iterable[int]) -> None:
+        """
+        تعبئة من التخزين: طوابع أطول نافذة (ProfileRows.window_timestamps، مرتبة).
+        """
+        for timestamp_ms in timestamps:
+            self.add(timestamp_ms)
+
+
+_WINDOW_MS: Dict[str, int] = dict(WINDOW_SPECS)